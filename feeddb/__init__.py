@@ -0,0 +1,27 @@
+"""
+Schema shared by the firehose, the web service and the scheduler: the peewee models, bound to a
+``DatabaseProxy`` each service initializes with its own connection, the versioned migrations
+the firehose applies at startup, the maintenance of the daily post partitions and the connection
+pool every service connects through.
+"""
+
+from . import partitions
+from .models import BaseModel, db, Post, Requests, SessionState, SubscriptionState
+from .migrations import migrate, MIGRATIONS, TRENDING_MIN_INTERACTIONS
+from .pool import PooledDatabase, PoolExhausted, PoolStats
+
+__all__ = [
+    'BaseModel',
+    'db',
+    'migrate',
+    'MIGRATIONS',
+    'partitions',
+    'PooledDatabase',
+    'PoolExhausted',
+    'PoolStats',
+    'Post',
+    'Requests',
+    'SessionState',
+    'SubscriptionState',
+    'TRENDING_MIN_INTERACTIONS',
+]
@@ -0,0 +1,222 @@
+import time
+from datetime import timedelta
+from typing import Callable, List, NamedTuple
+
+import peewee
+
+from . import partitions
+from .models import db, Post, Requests, SessionState, SubscriptionState
+
+# Lowest hot score the trending queries ask for; the partial trending index only holds posts at or
+# above it, so feed thresholds must not go below this value
+TRENDING_MIN_INTERACTIONS = 10
+
+# Session-level advisory lock taken while migrating, so shards and replicas starting together
+# apply each migration once
+_LOCK_KEY = 0x63666462  # 'cfdb'
+
+_VERSION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+)
+"""
+
+
+class Migration(NamedTuple):
+    """
+    One schema change.
+
+    Args:
+        version: Position in the migration history; versions are applied in ascending order.
+        description: Recorded in ``schema_migrations`` and logged when applied.
+        apply: Runs the change against the database.
+        transactional: False for changes that cannot run in a transaction, such as
+            ``CREATE INDEX CONCURRENTLY``; those must be safe to re-run after a failure.
+    """
+
+    version: int
+    description: str
+    apply: Callable
+    transactional: bool = True
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, transactional: bool = True):
+    """Register the decorated function as migration ``version``, described by its docstring's first line."""
+    def register(apply):
+        MIGRATIONS.append(Migration(version, apply.__doc__.strip().splitlines()[0], apply, transactional))
+        return apply
+    return register
+
+
+def create_index_concurrently(name: str, definition: str) -> None:
+    """
+    Build an index without blocking writes. A build interrupted earlier leaves an invalid
+    index behind, which is dropped and rebuilt.
+    """
+    row = db.execute_sql('SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s)', (name,)).fetchone()
+    if row is not None:
+        if row[0]:
+            return
+        db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    db.execute_sql(f'CREATE INDEX CONCURRENTLY {name} ON {definition}')
+
+
+def drop_index_concurrently(name: str) -> None:
+    try:
+        db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    except peewee.NotSupportedError:
+        # Some PostgreSQL-compatible databases only drop indexes the blocking way
+        db.execute_sql(f'DROP INDEX IF EXISTS {name}')
+
+
+@migration(1)
+def initial_schema():
+    """Base tables and the post columns added before versioned migrations"""
+    db.create_tables([Post, SubscriptionState, SessionState, Requests])
+    for sql in (
+        'ALTER TABLE post ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE post ADD COLUMN IF NOT EXISTS repost_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE post ADD COLUMN IF NOT EXISTS reply_count INTEGER NOT NULL DEFAULT 0',
+        # Posts stored before filter profiles existed belong to the first one
+        'ALTER TABLE post ADD COLUMN IF NOT EXISTS feeds BIGINT NOT NULL DEFAULT 1',
+    ):
+        db.execute_sql(sql)
+
+
+@migration(2, transactional=False)
+def feed_indexes():
+    """Composite indexes in the feed orderings, replacing the single-column ones"""
+    # Explicit sort orders keep the leading column range-ordered; YugabyteDB hash-shards the first
+    # column of an index without one, which is why the old single-column indexes never served
+    # ORDER BY or range filters there.
+    # Chronological feed and cursor pagination: ORDER BY indexed_at DESC, cid DESC; also serves the
+    # indexed_at range scans of the scheduler jobs
+    create_index_concurrently('post_indexed_at_cid', 'post (indexed_at DESC, cid DESC)')
+    # Trending: WHERE interactions >= threshold AND indexed_at > since
+    # ORDER BY interactions DESC, indexed_at DESC, cid DESC. Most posts never trend, so the partial
+    # index stays small, and with feeds included counting trending posts is an index-only scan
+    create_index_concurrently(
+        'post_trending',
+        f'post (interactions DESC, indexed_at DESC, cid DESC) INCLUDE (feeds) WHERE interactions >= {TRENDING_MIN_INTERACTIONS}',
+    )
+    # Every write maintained these, and no query needs them any more
+    drop_index_concurrently('post_indexed_at')
+    drop_index_concurrently('post_interactions')
+
+
+# Built on the new table before the swap, under temporary names because index names are unique
+# per schema; indexes on the parent are created on every partition, and on every partition
+# attached later
+_PARTITIONED_POST_INDEXES = (
+    ('post_partitioned_uri', 'post_uri', 'CREATE UNIQUE INDEX {name} ON post_partitioned (uri, indexed_at)'),
+    ('post_partitioned_author', 'post_author', 'CREATE INDEX {name} ON post_partitioned (author)'),
+    ('post_partitioned_indexed_at_cid', 'post_indexed_at_cid',
+     'CREATE INDEX {name} ON post_partitioned (indexed_at DESC, cid DESC)'),
+    ('post_partitioned_trending', 'post_trending',
+     'CREATE INDEX {name} ON post_partitioned (interactions DESC, indexed_at DESC, cid DESC) INCLUDE (feeds) '
+     f'WHERE interactions >= {TRENDING_MIN_INTERACTIONS}'),
+)
+
+
+@migration(3)
+def partition_post_by_day():
+    """
+    Rebuild post as a table partitioned by day on indexed_at
+
+    The copy is a snapshot of ``post``: the scheduler jobs must be paused while it runs, because
+    the hydrate and score updates they make to the old table after the snapshot are lost.
+    """
+    # Partitioned tables enforce uniqueness per partition, so the key becomes (uri, indexed_at); the
+    # firehose stamps posts with the relay's commit time, which a replay repeats. The copy keeps one
+    # row per URI (the most interactions, then the oldest). Only the firehose inserts posts and it
+    # runs this before it starts streaming. Readers keep reading through the copy and the index
+    # builds; only the final drop and renames take the exclusive lock.
+    if partitions.is_partitioned():
+        return
+    if db.execute_sql("SELECT to_regclass('post')").fetchone()[0] is None:
+        # Interrupted between dropping the old table and renaming the new one (databases without
+        # transactional DDL): the new table is complete, so only the swap is left
+        _swap_in_partitioned_post()
+        return
+
+    db.execute_sql('DROP TABLE IF EXISTS post_partitioned')
+    db.execute_sql('CREATE TABLE post_partitioned (LIKE post INCLUDING DEFAULTS) PARTITION BY RANGE (indexed_at)')
+    today = partitions._today()
+    first = db.execute_sql('SELECT min(indexed_at)::date FROM post').fetchone()[0] or today
+    for i in range((today - first).days + partitions.DAYS_AHEAD + 1):
+        partitions.create_partition(first + timedelta(days=i), parent='post_partitioned')
+    db.execute_sql('INSERT INTO post_partitioned SELECT DISTINCT ON (uri) * FROM post ORDER BY uri, interactions DESC, id')
+
+    db.execute_sql('ALTER TABLE post_partitioned ADD CONSTRAINT post_partitioned_pkey PRIMARY KEY (id, indexed_at)')
+    for name, _, definition in _PARTITIONED_POST_INDEXES:
+        db.execute_sql(definition.format(name=name))
+
+    # The id sequence would otherwise be dropped with the old table
+    db.execute_sql('ALTER SEQUENCE post_id_seq OWNED BY post_partitioned.id')
+    db.execute_sql('DROP TABLE post')
+    _swap_in_partitioned_post()
+
+
+def _swap_in_partitioned_post():
+    # Catalog-only renames, so the exclusive lock taken by dropping the old table is held briefly
+    db.execute_sql('ALTER TABLE post_partitioned RENAME TO post')
+    db.execute_sql('ALTER TABLE post RENAME CONSTRAINT post_partitioned_pkey TO post_pkey')
+    for name, final_name, _ in _PARTITIONED_POST_INDEXES:
+        db.execute_sql(f'ALTER INDEX {name} RENAME TO {final_name}')
+
+
+def applied_versions() -> List[int]:
+    db.execute_sql(_VERSION_TABLE_SQL)
+    return [version for (version,) in db.execute_sql('SELECT version FROM schema_migrations ORDER BY version')]
+
+
+def migrate(poll_interval: float = 1.0) -> List[Migration]:
+    """
+    Apply every pending migration in version order and return the ones applied.
+
+    The database must be connected in autocommit mode (peewee's default) so non-transactional
+    migrations can build indexes concurrently. The advisory lock is polled rather than waited on:
+    a session blocked on it would hold a snapshot that ``CREATE INDEX CONCURRENTLY`` waits for.
+    """
+    locked = _lock(poll_interval)
+    try:
+        applied = set(applied_versions())
+        done = []
+        for step in sorted(MIGRATIONS, key=lambda m: m.version):
+            if step.version in applied:
+                continue
+            if step.transactional:
+                with db.atomic():
+                    step.apply()
+                    _record(step)
+            else:
+                step.apply()
+                _record(step)
+            done.append(step)
+        return done
+    finally:
+        if locked:
+            db.execute_sql('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
+
+
+def _lock(poll_interval: float) -> bool:
+    """Take the migration lock; returns False when the database has no advisory locks."""
+    try:
+        while not db.execute_sql('SELECT pg_try_advisory_lock(%s)', (_LOCK_KEY,)).fetchone()[0]:
+            time.sleep(poll_interval)
+    except peewee.NotSupportedError:
+        # Every migration is idempotent, so racing starters only repeat work
+        return False
+    return True
+
+
+def _record(step: Migration) -> None:
+    db.execute_sql(
+        'INSERT INTO schema_migrations (version, description) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+        (step.version, step.description),
+    )
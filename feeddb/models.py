@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+import peewee
+
+# Every service binds the shared models to its own connection with db.initialize(...)
+db = peewee.DatabaseProxy()
+
+# Database Models
+class BaseModel(peewee.Model):
+    class Meta:
+        database = db
+
+class Post(BaseModel):
+    # indexed_at and interactions are covered by the composite feed indexes of migration 2; once
+    # migration 3 partitions the table by day, uri is unique together with indexed_at
+    uri = peewee.CharField(unique=True)
+    cid = peewee.CharField()
+    reply_parent = peewee.CharField(null=True, default=None)
+    reply_root = peewee.CharField(null=True, default=None)
+    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc))
+    author = peewee.CharField(null=True, default=None, index=True)
+    interactions = peewee.BigIntegerField(default=0)
+    text = peewee.TextField(null=True, default=None)
+    like_count = peewee.IntegerField(default=0)
+    repost_count = peewee.IntegerField(default=0)
+    reply_count = peewee.IntegerField(default=0)
+    feeds = peewee.BigIntegerField(default=1)  # bit i set when the post belongs to the i-th filter profile
+
+class SubscriptionState(BaseModel):
+    service = peewee.CharField(unique=True)
+    cursor = peewee.BigIntegerField()
+    last_indexed_at = peewee.DateTimeField(null=True, default=None)
+
+class SessionState(BaseModel):
+    service = peewee.CharField(unique=True)
+    session_string = peewee.TextField(null=True)
+
+# table for storing dids
+class Requests(BaseModel):
+    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc), index=True)
+    did = peewee.CharField(null=True, default=None, index=True)
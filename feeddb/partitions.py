@@ -0,0 +1,119 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional
+
+import peewee
+
+from .models import db
+
+# Days of partitions kept ready ahead of today, so a few days without maintenance never leave
+# inserts without a partition
+DAYS_AHEAD = 7
+
+# Try-lock shared by every maintainer (firehose thread, scheduler job); a busy lock skips the round
+_LOCK_KEY = 0x63666470  # 'cfdp'
+
+_PARTITIONED_SQL = "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('post')"
+_PARTITIONS_SQL = """
+SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'post'::regclass
+"""
+
+
+def partition_name(day: date) -> str:
+    return f'post_p{day:%Y%m%d}'
+
+
+def _bounds(day: date) -> str:
+    # indexed_at holds UTC timestamps without time zone
+    return f"FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def is_partitioned() -> bool:
+    return db.execute_sql(_PARTITIONED_SQL).fetchone() is not None
+
+
+def partition_days() -> List[date]:
+    """Days that currently have a partition, oldest first."""
+    days = []
+    for (name,) in db.execute_sql(_PARTITIONS_SQL).fetchall():
+        try:
+            days.append(datetime.strptime(name, 'post_p%Y%m%d').date())
+        except ValueError:
+            continue
+    return sorted(days)
+
+
+def is_missing_partition(error: Exception) -> bool:
+    """Whether an insert failed because no partition covers one of its rows."""
+    return 'no partition of relation' in str(error)
+
+
+def create_partition(day: date, parent: str = 'post') -> None:
+    """Create the partition of ``day`` directly; only for tables nothing else is using yet."""
+    db.execute_sql(f'CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF {parent} FOR VALUES {_bounds(day)}')
+
+
+def attach_partition(day: date) -> None:
+    """
+    Add the partition of ``day`` to the live table. The empty table is created on its own and
+    then attached, which only takes a SHARE UPDATE EXCLUSIVE lock on ``post``, so reads and
+    writes carry on (``CREATE TABLE ... PARTITION OF`` would lock the whole table).
+    """
+    name = partition_name(day)
+    with db.atomic():
+        db.execute_sql(f'CREATE TABLE IF NOT EXISTS {name} (LIKE post INCLUDING DEFAULTS)')
+        db.execute_sql(f'ALTER TABLE post ATTACH PARTITION {name} FOR VALUES {_bounds(day)}')
+
+
+def drop_partition(day: date) -> None:
+    name = partition_name(day)
+    try:
+        # Waits for running queries instead of locking them out; not allowed in a transaction
+        db.execute_sql(f'ALTER TABLE post DETACH PARTITION {name} CONCURRENTLY')
+    except (peewee.NotSupportedError, peewee.ProgrammingError):
+        # Before PostgreSQL 14 (and on some compatible databases) only the brief blocking detach exists
+        db.execute_sql(f'ALTER TABLE post DETACH PARTITION {name}')
+    db.execute_sql(f'DROP TABLE {name}')
+
+
+def maintain(retention_days: Optional[int] = None, since: Optional[date] = None,
+             days_ahead: int = DAYS_AHEAD) -> Optional[dict]:
+    """
+    Create the missing daily partitions from ``since`` (default today) to ``days_ahead`` days
+    ahead, and drop the partitions that ended more than ``retention_days`` days ago (none when
+    None). Returns the days created and dropped, or None when another maintainer holds the lock
+    or the table isn't partitioned yet.
+    """
+    if not is_partitioned():
+        return None
+    try:
+        if not db.execute_sql('SELECT pg_try_advisory_lock(%s)', (_LOCK_KEY,)).fetchone()[0]:
+            return None
+        locked = True
+    except peewee.NotSupportedError:
+        locked = False
+
+    try:
+        today = _today()
+        existing = set(partition_days())
+        start = min(since, today) if since else today
+        wanted = [start + timedelta(days=i) for i in range((today - start).days + days_ahead + 1)]
+        created = [day for day in wanted if day not in existing]
+        for day in created:
+            attach_partition(day)
+
+        dropped = []
+        if retention_days is not None:
+            # A partition goes once every post in it is older than the retention window
+            cutoff = today - timedelta(days=retention_days)
+            dropped = [day for day in sorted(existing) if day < cutoff]
+            for day in dropped:
+                drop_partition(day)
+        return {'created': created, 'dropped': dropped}
+    finally:
+        if locked:
+            db.execute_sql('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
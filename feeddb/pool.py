@@ -0,0 +1,144 @@
+import threading
+import time
+
+import peewee
+from playhouse.pool import MaxConnectionsExceeded, PooledPostgresqlDatabase
+
+
+class PoolExhausted(peewee.OperationalError, MaxConnectionsExceeded):
+    """No connection became free within the pool's wait timeout."""
+
+
+class PoolStats:
+    """Checkout and connection counters of a PooledDatabase."""
+
+    __slots__ = ('checkouts', 'wait_total', 'max_wait', 'timeouts', 'created', 'recycled', 'broken', '_lock')
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0  # seconds spent in connect(), including opening new connections
+        self.max_wait = 0.0
+        self.timeouts = 0      # checkouts that gave up because the pool stayed exhausted
+        self.created = 0
+        self.recycled = 0      # closed for reaching the maximum age
+        self.broken = 0        # dropped by the server or failing the liveness check
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def incr(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self) -> dict:
+        return {
+            'checkouts': self.checkouts,
+            'avg_wait': self.wait_total / (self.checkouts or 1),
+            'max_wait': self.max_wait,
+            'timeouts': self.timeouts,
+            'created': self.created,
+            'recycled': self.recycled,
+            'broken': self.broken,
+        }
+
+
+class PooledDatabase(PooledPostgresqlDatabase):
+    """
+    Postgres connection pool shared by the services.
+
+    Each thread checks a connection out with ``connect()`` and returns it with ``close()``
+    (the web service does both per request). On top of peewee's pool it:
+
+    - checks a connection is still alive before handing it out again, so connections killed
+      by a server restart or a YugabyteDB failover are replaced instead of failing the next
+      query. Connections returned less than ``ping_after`` seconds ago skip the ``SELECT 1``
+      round trip; 0 checks every checkout.
+    - closes connections older than ``max_age`` seconds when they are checked in or out, so
+      connections move over to new or rebalanced servers (None keeps them forever).
+    - counts checkouts, time spent waiting for a connection and replaced connections in
+      ``stats``.
+
+    These hooks override private parts of ``playhouse.pool``, so peewee is pinned in every
+    requirements file and ``tests/test_pool.py`` checks they still exist before an upgrade.
+
+    Args:
+        database: Database name.
+        max_connections: Connections open at most; further checkouts wait for one to return.
+        max_age: Seconds after which a connection is closed instead of reused.
+        timeout: Seconds a checkout waits for a free connection before raising
+            ``PoolExhausted`` (0 waits forever, None fails at once).
+        ping_after: Idle seconds after which a connection is checked before reuse.
+        read_only: Open every connection as a read-only session, e.g. for a replica.
+    """
+
+    def __init__(self, database, max_connections: int = 10, max_age: float = None, timeout: float = None,
+                 ping_after: float = 30, read_only: bool = False, **kwargs):
+        self.stats = PoolStats()
+        self._ping_after = ping_after
+        self._read_only = read_only
+        self._returned = {}  # connection key -> monotonic time it was last checked in
+        super().__init__(database, max_connections=max_connections, stale_timeout=max_age, timeout=timeout, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        start = time.monotonic()
+        try:
+            opened = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded as e:
+            # An OperationalError, so callers handle it like any other unavailable database
+            self.stats.incr('timeouts')
+            raise PoolExhausted(str(e)) from None
+        if opened:
+            self.stats.record_wait(time.monotonic() - start)
+        return opened
+
+    def _connect(self):
+        with self._pool_lock:
+            idle = {self.conn_key(conn) for _, _, conn in self._connections}
+            conn = super()._connect()
+        if self.conn_key(conn) not in idle:
+            self.stats.incr('created')
+            if self._read_only:
+                conn.set_session(readonly=True)
+        return conn
+
+    def _is_stale(self, timestamp):
+        stale = super()._is_stale(timestamp)
+        if stale:
+            self.stats.incr('recycled')
+        return stale
+
+    def _is_closed(self, conn):
+        key = self.conn_key(conn)
+        returned = self._returned.pop(key, None)
+        if conn.closed:
+            closed = True
+        elif returned is not None and time.monotonic() - returned < self._ping_after:
+            # Recently used without errors; a dead connection would have failed to check in
+            closed = False
+        else:
+            closed = self._adapter.is_connection_closed(conn)
+        if closed:
+            self.stats.incr('broken')
+        return closed
+
+    def _can_reuse(self, conn):
+        reusable = super()._can_reuse(conn)
+        if reusable:
+            self._returned[self.conn_key(conn)] = time.monotonic()
+        else:
+            self.stats.incr('broken')
+        return reusable
+
+    def _close_raw(self, conn):
+        self._returned.pop(self.conn_key(conn), None)
+        super()._close_raw(conn)
+
+    def pool_stats(self) -> dict:
+        """``stats`` plus the current number of connections in use and idle in the pool."""
+        with self._pool_lock:
+            in_use, idle = len(self._in_use), len(self._connections)
+        return {**self.stats.as_dict(), 'in_use': in_use, 'idle': idle, 'max_connections': self._max_connections}
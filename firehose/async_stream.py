@@ -0,0 +1,417 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from time import monotonic, perf_counter
+from typing import Callable, List, Optional, Sequence
+
+import asyncpg
+from atproto import AsyncFirehoseSubscribeReposClient, firehose_models, models
+from atproto.exceptions import FirehoseError
+
+import metrics
+from catchup import CatchUpMonitor
+from checkpoint import Checkpointer
+from data_stream import _decode_message, ensure_partitions, init_database
+from database import db, partitions, SubscriptionState
+from records import PostRow
+from utils import config
+from utils.logger import logger
+from watermark import SeqWatermark
+from writer import WriterStats
+
+# Sentinel pushed through the receive queue to shut down decode tasks
+_STOP = object()
+
+# Attempts per flush before the batch is given up on, with exponential backoff between them
+_FLUSH_ATTEMPTS = 3
+_FLUSH_BACKOFF = 1  # seconds
+
+# Errors caused by the rows rather than the database; such a batch is written again one row at a
+# time and the rejected rows are skipped, since retrying can't store them
+_ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, ValueError, TypeError)
+
+# One round trip per flush: the batch is sent as column arrays and unnested server-side
+_INSERT_SQL = """
+INSERT INTO post (uri, cid, reply_parent, reply_root, indexed_at, author, interactions, text, feeds,
+                  like_count, repost_count, reply_count)
+SELECT u.*, 0, 0, 0
+FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::timestamp[], $6::text[], $7::bigint[], $8::text[],
+            $9::bigint[]) AS u
+ON CONFLICT DO NOTHING
+"""
+_DELETE_SQL = 'DELETE FROM post WHERE uri = ANY($1::text[])'
+
+
+class AsyncBulkWriter:
+    """
+    asyncio counterpart of ``writer.BulkWriter``: buffers filtered results and flushes them
+    with asyncpg once ``batch_size`` rows are waiting or the oldest has waited ``max_latency``
+    seconds. Event tokens are handed to ``on_flushed`` after their flush has committed; a flush
+    that fails every attempt keeps its events, so the cursor stays before them. Rows the database
+    rejects are skipped one by one instead, like ``writer.BulkWriter`` does.
+
+    Args:
+        pool: asyncpg connection pool.
+        batch_size: Number of buffered rows (posts plus deletions) that triggers a flush.
+        max_latency: Maximum seconds a buffered row waits before it is flushed.
+        queue_size: Maximum number of submitted results waiting to be buffered.
+        on_flushed: Called with the event tokens of every flush once it has committed.
+        prepare: Applied to the posts of every flush before they are written, e.g. to classify them.
+        executor: Thread pool ``prepare`` runs on, so it never blocks the event loop (default:
+            the loop's default executor).
+    """
+
+    def __init__(
+        self,
+        pool: 'asyncpg.Pool',
+        batch_size: int = 500,
+        max_latency: float = 2.0,
+        queue_size: int = 1000,
+        on_flushed: Optional[Callable[[list], None]] = None,
+        prepare: Optional[Callable[[List[PostRow]], List[PostRow]]] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self._pool = pool
+        self._prepare = prepare
+        self._executor = executor
+        self._batch_size = max(1, batch_size)
+        self._max_latency = max_latency
+        self._on_flushed = on_flushed
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+
+        self._posts: List[PostRow] = []
+        self._deletes: List[str] = []
+        self._events: list = []
+        self._oldest: Optional[float] = None
+
+        self.stats = WriterStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def configure(self, batch_size: int, max_latency: float) -> None:
+        """Change the flush thresholds; the new values apply from the next buffered row."""
+        self._batch_size = max(1, batch_size)
+        self._max_latency = max_latency
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str], events: Sequence = ()) -> None:
+        """Queue filtered results for the next flush. Waits when the writer is backed up."""
+        await self._queue.put((posts_to_create, post_uris_to_delete, events))
+
+    async def stop(self) -> None:
+        """Flush everything submitted so far and stop the writer task."""
+        if self._task:
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            timeout = None
+            if self._oldest is not None:
+                timeout = max(0.0, self._oldest + self._max_latency - monotonic())
+
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is _STOP:
+                await self._flush()
+                return
+
+            if item is not None:
+                posts_to_create, post_uris_to_delete, events = item
+                if self._oldest is None:
+                    self._oldest = monotonic()
+                self._posts.extend(posts_to_create)
+                self._deletes.extend(post_uris_to_delete)
+                self._events.extend(events)
+
+            buffered = len(self._posts) + len(self._deletes)
+            if buffered >= self._batch_size or (
+                self._oldest is not None and monotonic() - self._oldest >= self._max_latency
+            ):
+                await self._flush()
+
+    async def _write(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str]) -> None:
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                if posts_to_create:
+                    status = await connection.execute(
+                        _INSERT_SQL,
+                        [post.uri for post in posts_to_create],
+                        [post.cid for post in posts_to_create],
+                        [post.reply_parent for post in posts_to_create],
+                        [post.reply_root for post in posts_to_create],
+                        # The column is a UTC timestamp without time zone
+                        [post.indexed_at.astimezone(timezone.utc).replace(tzinfo=None) for post in posts_to_create],
+                        [post.author for post in posts_to_create],
+                        [post.interactions for post in posts_to_create],
+                        [post.text for post in posts_to_create],
+                        [post.feeds for post in posts_to_create],
+                    )
+                    added_count = int(status.split()[-1])
+                if post_uris_to_delete:
+                    status = await connection.execute(_DELETE_SQL, post_uris_to_delete)
+                    deleted_count = int(status.split()[-1])
+                    if deleted_count > 0:
+                        logger.info(f'Deleted: {deleted_count}')
+
+        if posts_to_create:
+            skipped = len(posts_to_create) - added_count
+            logger.info(f'Added: {added_count}' + (f' ({skipped} already stored)' if skipped else ''))
+
+    async def _write_or_skip(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str]) -> None:
+        try:
+            await self._write(posts_to_create, post_uris_to_delete)
+            return
+        except _ROW_ERRORS as e:
+            if partitions.is_missing_partition(e):
+                # Not the rows' fault: raised so the retry finds the partitions created
+                raise
+            logger.error(
+                f'Failed to flush {len(posts_to_create)} posts and {len(post_uris_to_delete)} deletes, '
+                f'writing them one at a time: {e}'
+            )
+
+        for post in posts_to_create:
+            try:
+                await self._write([post], [])
+            except _ROW_ERRORS as e:
+                if partitions.is_missing_partition(e):
+                    raise
+                logger.error(f'Skipping {post.uri}: {e}')
+                self.stats.skipped += 1
+                metrics.SKIPPED_ROWS.inc()
+        for uri in post_uris_to_delete:
+            try:
+                await self._write([], [uri])
+            except _ROW_ERRORS as e:
+                if partitions.is_missing_partition(e):
+                    raise
+                logger.error(f'Skipping deletion of {uri}: {e}')
+                self.stats.skipped += 1
+                metrics.SKIPPED_ROWS.inc()
+
+    async def _flush(self) -> None:
+        if self._oldest is None:
+            return
+
+        posts_to_create, post_uris_to_delete, events = self._posts, self._deletes, self._events
+        oldest = self._oldest
+        self._posts, self._deletes, self._events, self._oldest = [], [], [], None
+
+        # Once per flush, not per attempt, and off the loop: classifying is CPU-bound
+        if self._prepare and posts_to_create:
+            posts_to_create = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._prepare, posts_to_create,
+            )
+
+        rows = len(posts_to_create) + len(post_uris_to_delete)
+        if rows:
+            started = monotonic()
+            for attempt in range(1, _FLUSH_ATTEMPTS + 1):
+                try:
+                    await self._write_or_skip(posts_to_create, post_uris_to_delete)
+                except Exception as e:
+                    logger.error(
+                        f'Failed to flush {len(posts_to_create)} posts and {len(post_uris_to_delete)} deletes '
+                        f'(attempt {attempt}/{_FLUSH_ATTEMPTS}): {e}'
+                    )
+                    if partitions.is_missing_partition(e):
+                        await asyncio.get_running_loop().run_in_executor(None, _ensure_partitions, posts_to_create)
+                    if attempt < _FLUSH_ATTEMPTS:
+                        await asyncio.sleep(_FLUSH_BACKOFF * 2 ** (attempt - 1))
+                    continue
+
+                finished = monotonic()
+                self.stats.record(rows, finished - oldest, finished - started)
+                metrics.WRITE_SECONDS.observe(finished - started)
+                metrics.FLUSH_ROWS.observe(rows)
+                metrics.DELETED_POSTS.inc(len(post_uris_to_delete))
+                break
+            else:
+                # The rows were never written, so their events must not move the cursor past them
+                self.stats.failures += 1
+                metrics.FLUSH_FAILURES.inc()
+                logger.error(f'Gave up on {rows} rows; the cursor stays before their events until a restart replays them')
+                return
+
+        if events and self._on_flushed:
+            self._on_flushed(events)
+
+
+def _ensure_partitions(posts_to_create: List[PostRow]) -> None:
+    # Partition maintenance goes through peewee, on a connection of its own in this thread
+    with db.connection_context():
+        ensure_partitions(posts_to_create)
+
+
+def _decode_and_filter(filter_callback: Callable, message: firehose_models.MessageFrame):
+    started = perf_counter()
+    seq, operations = _decode_message(message)
+    decoded = perf_counter()
+    metrics.DECODE_SECONDS.observe(decoded - started)
+    if operations is None:
+        return seq, [], []
+    posts_to_create, post_uris_to_delete = filter_callback(operations)
+    metrics.FILTER_SECONDS.observe(perf_counter() - decoded)
+    metrics.MATCHED_POSTS.inc(len(posts_to_create))
+    return seq, posts_to_create, post_uris_to_delete
+
+
+async def _decode_loop(receive: asyncio.Queue, executor, filter_callback, writer: AsyncBulkWriter, watermark) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await receive.get()
+        if item is _STOP:
+            return
+
+        ordinal, message = item
+        seq = None
+        posts_to_create, post_uris_to_delete = [], []
+        try:
+            seq, posts_to_create, post_uris_to_delete = await loop.run_in_executor(
+                executor, _decode_and_filter, filter_callback, message
+            )
+        except Exception as e:
+            metrics.DECODE_ERRORS.inc()
+            logger.error(f'Failed to decode message: {e}')
+
+        if posts_to_create or post_uris_to_delete:
+            await writer.submit(posts_to_create, post_uris_to_delete, [(ordinal, seq)])
+        else:
+            watermark.finish(ordinal, seq)
+
+
+async def _run(name, filter_callback, pool, stream_stop_event=None, prepare_callback=None):
+    """
+    Streams the firehose on the event loop: receive, decode and write overlap as tasks.
+
+    The receive task only queues frames. Decoding and filtering run on a thread pool so the
+    loop keeps reading the socket, and matched posts are written by an asyncpg bulk writer
+    that never blocks the loop on Postgres.
+    """
+    state = SubscriptionState.get_or_none(SubscriptionState.service == name)
+
+    params = None
+    if state:
+        params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=state.cursor)
+    else:
+        SubscriptionState.create(service=name, cursor=0)
+
+    client = AsyncFirehoseSubscribeReposClient(params)
+
+    watermark = SeqWatermark(state.cursor if state else None)
+    checkpointer = Checkpointer(
+        name,
+        watermark,
+        interval=config.FIREHOSE_CHECKPOINT_INTERVAL,
+        events=config.FIREHOSE_CHECKPOINT_EVENTS,
+        on_checkpoint=lambda seq: client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=seq)),
+    )
+    workers = max(1, config.FIREHOSE_DECODE_WORKERS)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='firehose-decode')
+    writer = AsyncBulkWriter(
+        pool,
+        batch_size=config.FIREHOSE_WRITE_BATCH_SIZE,
+        max_latency=config.FIREHOSE_WRITE_MAX_LATENCY,
+        queue_size=config.FIREHOSE_WRITE_QUEUE_SIZE,
+        on_flushed=watermark.finish_all,
+        prepare=prepare_callback,
+        executor=executor,
+    )
+
+    # Bigger flushes while replaying a backlog; the decode tasks are fixed for the loop's lifetime
+    catchup = CatchUpMonitor(
+        enter_lag=config.FIREHOSE_CATCHUP_ENTER_LAG,
+        exit_lag=config.FIREHOSE_CATCHUP_EXIT_LAG,
+        on_change=lambda catching_up: writer.configure(
+            config.FIREHOSE_CATCHUP_BATCH_SIZE if catching_up else config.FIREHOSE_WRITE_BATCH_SIZE,
+            config.FIREHOSE_CATCHUP_MAX_LATENCY if catching_up else config.FIREHOSE_WRITE_MAX_LATENCY,
+        ),
+    )
+
+    receive = asyncio.Queue(maxsize=config.FIREHOSE_RECEIVE_QUEUE_SIZE)
+
+    async def on_message_handler(message: firehose_models.MessageFrame) -> None:
+        if stream_stop_event and stream_stop_event.is_set():
+            logger.info("Stopping firehose...")
+            await client.stop()
+            return
+
+        # Waiting here when the queue is full applies backpressure to the socket
+        metrics.FRAMES.inc()
+        await receive.put((watermark.begin(), message))
+
+    metrics.watch_watermark(watermark)
+    metrics.RECEIVE_QUEUE.set_callback(receive.qsize)
+    metrics.WRITE_QUEUE.set_callback(lambda: writer.queue_depth)
+
+    writer.start()
+    decoders = [
+        asyncio.create_task(_decode_loop(receive, executor, filter_callback, writer, watermark))
+        for _ in range(workers)
+    ]
+    checkpointer.start()
+    catchup.start()
+    logger.info(f'Async firehose started with {workers} decode workers.')
+
+    try:
+        await client.start(on_message_handler)
+    finally:
+        # Drain everything already received before persisting the final cursor
+        for _ in decoders:
+            await receive.put(_STOP)
+        await asyncio.gather(*decoders)
+        catchup.stop()
+        await writer.stop()
+        executor.shutdown(wait=True)
+        checkpointer.stop()
+        logger.info('Async firehose stopped.')
+
+
+async def _main(name, filter_callback, stream_stop_event=None, prepare_callback=None):
+    pool = await asyncpg.create_pool(
+        user=config.POSTGRES_USER,
+        password=config.POSTGRES_PASSWORD,
+        database=config.POSTGRES_DB,
+        host=config.POSTGRES_HOST,
+        port=config.POSTGRES_PORT,
+        min_size=1,
+        max_size=2,
+    )
+    try:
+        while stream_stop_event is None or not stream_stop_event.is_set():
+            try:
+                await _run(name, filter_callback, pool, stream_stop_event, prepare_callback)
+            except FirehoseError as e:
+                logger.error(f"Firehose error: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}")
+                break
+    finally:
+        await pool.close()
+
+
+def run(name, filter_callback, stream_stop_event=None, prepare_callback=None):
+    """
+    Starts the asyncio firehose. Writes go through asyncpg rather than a write callback.
+
+    Args:
+        name: The name of the service/subscription.
+        filter_callback: Selects the posts to create and delete from the extracted operations.
+        stream_stop_event: An optional threading.Event to signal when to stop the stream.
+        prepare_callback: Applied to the posts of every flush before they are written.
+    """
+    # Schema setup and cursor checkpoints stay on peewee, outside the event loop
+    init_database()
+    metrics.start_server(config.FIREHOSE_METRICS_PORT)
+    asyncio.run(_main(name, filter_callback, stream_stop_event, prepare_callback))
@@ -0,0 +1,93 @@
+from typing import Dict, Optional, Tuple
+
+import libipld
+
+# CIDv0 is a bare sha2-256 multihash: <0x12><0x20><32-byte digest>
+_CID_V0_PREFIX = b'\x12\x20'
+_CID_V0_LENGTH = 34
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Read an unsigned LEB128 varint, returning the value and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _cid_length(data: bytes, pos: int) -> int:
+    """Length in bytes of the binary CID starting at ``pos``."""
+    if data.startswith(_CID_V0_PREFIX, pos):
+        return _CID_V0_LENGTH
+
+    start = pos
+    _, pos = _read_varint(data, pos)  # version
+    _, pos = _read_varint(data, pos)  # codec
+    _, pos = _read_varint(data, pos)  # multihash code
+    digest_size, pos = _read_varint(data, pos)
+    return pos + digest_size - start
+
+
+def cid_to_bytes(cid) -> bytes:
+    """Binary form of a CID given as a CID object, multibase string or raw bytes."""
+    if isinstance(cid, bytes):
+        return cid
+    _, raw = libipld.decode_multibase(str(cid))
+    return raw
+
+
+class LazyCAR:
+    """
+    Read-on-demand view of a CAR v1 file.
+
+    ``CAR.from_bytes`` decodes every block in a commit, including all MST nodes we never look at.
+    This reader only walks block boundaries (a few varints per block) until it finds the CID
+    being asked for, and DAG-CBOR decodes that single block. Offsets of blocks skipped along the
+    way are remembered, so several lookups on one commit still scan the file at most once.
+    """
+
+    __slots__ = ('_data', '_pos', '_offsets')
+
+    def __init__(self, data: bytes):
+        self._data = data
+        header_length, pos = _read_varint(data, 0)
+        # Skip the header; roots are not needed to look up record blocks
+        self._pos = pos + header_length
+        self._offsets: Dict[bytes, Tuple[int, int]] = {}
+
+    def get(self, cid) -> Optional[dict]:
+        """Return the decoded block for ``cid``, or None if the CAR does not contain it."""
+        key = cid_to_bytes(cid)
+        span = self._offsets.get(key) or self._scan_until(key)
+        if span is None:
+            return None
+
+        start, end = span
+        return libipld.decode_dag_cbor(self._data[start:end])
+
+    def _scan_until(self, key: bytes) -> Optional[Tuple[int, int]]:
+        data = self._data
+        pos = self._pos
+        size = len(data)
+
+        while pos < size:
+            section_length, pos = _read_varint(data, pos)
+            end = pos + section_length
+            cid_end = pos + _cid_length(data, pos)
+
+            block_cid = data[pos:cid_end]
+            span = (cid_end, end)
+            self._offsets[block_cid] = span
+            pos = end
+
+            if block_cid == key:
+                self._pos = pos
+                return span
+
+        self._pos = pos
+        return None
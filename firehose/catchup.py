@@ -0,0 +1,128 @@
+import threading
+from time import monotonic
+from typing import Callable, Optional
+
+import metrics
+from utils.logger import logger
+
+# Set while this process runs the catch-up profile; checked on the per-post hot path
+_active = threading.Event()
+
+ACTIVE = metrics.REGISTRY.register(metrics.Gauge('firehose_catchup_active', '1 while the catch-up profile is on'))
+ETA = metrics.REGISTRY.register(metrics.Gauge('firehose_catchup_eta_seconds', 'Estimated seconds until caught up'))
+
+
+def active() -> bool:
+    """Whether the firehose is replaying a backlog and should skip per-post work."""
+    return _active.is_set()
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s' if hours else f'{minutes}m{seconds:02d}s'
+
+
+class CatchUpMonitor:
+    """
+    Switches the firehose into a throughput-first profile while it replays a backlog.
+
+    The relay lag (age of the latest decoded commit) is sampled every ``interval`` seconds.
+    Above ``enter_lag`` the catch-up profile is switched on: per-post logging and handle
+    lookups are skipped and ``on_change(True)`` lets the caller enlarge write batches and add
+    decode workers. Below ``exit_lag`` the live profile is restored with ``on_change(False)``.
+    The gap between the two thresholds keeps the profile from flapping. While catching up the
+    rate at which the lag shrinks gives an estimate of the time left, which is logged and exported.
+
+    Args:
+        enter_lag: Lag in seconds above which catch-up starts.
+        exit_lag: Lag in seconds below which catch-up ends.
+        interval: Seconds between lag samples.
+        on_change: Called with True when catch-up starts and False when it ends.
+        report: Log the lag and estimate every sample while catching up.
+    """
+
+    def __init__(
+        self,
+        enter_lag: float = 300,
+        exit_lag: float = 30,
+        interval: float = 5.0,
+        on_change: Optional[Callable[[bool], None]] = None,
+        report: bool = True,
+    ):
+        self._enter_lag = enter_lag
+        self._exit_lag = min(exit_lag, enter_lag)
+        self._interval = interval
+        self._on_change = on_change
+        self._report = report
+
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._started_at: Optional[float] = None
+        self._last_lag: Optional[float] = None
+        self._last_time = monotonic()
+        self._rate: Optional[float] = None  # seconds of backlog cleared per second, smoothed
+
+    def start(self) -> None:
+        if self._enter_lag <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='firehose-catchup', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if active():
+            self._switch(False, metrics.RELAY_LAG.value)
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self._interval):
+            self.sample(metrics.RELAY_LAG.value)
+
+    def sample(self, lag: float) -> None:
+        """Feed one lag measurement; switches profiles and updates the estimate."""
+        now = monotonic()
+        if self._last_lag is not None and now > self._last_time:
+            rate = (self._last_lag - lag) / (now - self._last_time)
+            self._rate = rate if self._rate is None else 0.7 * self._rate + 0.3 * rate
+        self._last_lag, self._last_time = lag, now
+
+        if not active() and lag >= self._enter_lag:
+            self._switch(True, lag)
+        elif active() and lag <= self._exit_lag:
+            self._switch(False, lag)
+        elif active():
+            eta = lag / self._rate if self._rate and self._rate > 0 else None
+            ETA.set(eta if eta is not None else -1)
+            if not self._report:
+                return
+            logger.info(
+                f'CatchUp|{_format_duration(lag)} behind|'
+                f"{f'{self._rate:.1f}s/s cleared' if self._rate is not None else 'measuring'}|"
+                f"ETA {_format_duration(eta) if eta is not None else 'unknown'}"
+            )
+
+    def _switch(self, catching_up: bool, lag: float) -> None:
+        if catching_up:
+            _active.set()
+            self._started_at = monotonic()
+            self._rate = None  # the jump into the backlog says nothing about how fast it clears
+            logger.info(f'CatchUp|{_format_duration(lag)} behind the relay, switching to the catch-up profile.')
+        else:
+            _active.clear()
+            took = monotonic() - self._started_at if self._started_at else 0
+            logger.info(
+                f'CatchUp|caught up ({_format_duration(lag)} behind) after {_format_duration(took)}, '
+                f'switching back to the live profile.'
+            )
+            ETA.set(0)
+
+        ACTIVE.set(1 if catching_up else 0)
+        if self._on_change:
+            try:
+                self._on_change(catching_up)
+            except Exception as e:
+                logger.error(f'Failed to apply the {"catch-up" if catching_up else "live"} profile: {e}')
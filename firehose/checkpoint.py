@@ -0,0 +1,103 @@
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Callable, Optional
+
+from peewee import PeeweeException
+
+from database import db, SubscriptionState
+from utils.logger import logger
+from watermark import SeqWatermark
+
+
+class Checkpointer:
+    """
+    Persists the subscription cursor from a SeqWatermark.
+
+    A checkpoint is taken every ``interval`` seconds or every ``events`` processed events,
+    whichever comes first. Because the watermark only moves past events whose posts have been
+    committed (or that had nothing to write), a restart replays at most the events received
+    since the last checkpoint and never skips anything that was still in flight.
+
+    Args:
+        name: The name of the service/subscription.
+        watermark: Tracks which events have been fully processed.
+        interval: Maximum seconds between checkpoints.
+        events: Maximum processed events between checkpoints.
+        on_checkpoint: Called with each persisted sequence number, e.g. to update client params.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        watermark: SeqWatermark,
+        interval: float = 10.0,
+        events: int = 5000,
+        on_checkpoint: Optional[Callable[[int], None]] = None,
+    ):
+        self._name = name
+        self._watermark = watermark
+        self._interval = interval
+        self._events = events
+        self._on_checkpoint = on_checkpoint
+
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        self._last_seq: Optional[int] = None
+        self._last_processed = 0
+        self._last_time = monotonic()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='firehose-checkpoint', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread and persist the final cursor."""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.checkpoint()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(1):
+            due_by_time = monotonic() - self._last_time >= self._interval
+            due_by_events = self._watermark.processed - self._last_processed >= self._events
+            if due_by_time or due_by_events:
+                try:
+                    # Checked out from the pool per checkpoint, so a connection lost in a
+                    # failover is replaced on the next one
+                    with db.connection_context():
+                        self.checkpoint()
+                except PeeweeException as e:
+                    logger.error(f'Failed to get a database connection for the checkpoint: {e}')
+
+    def checkpoint(self) -> None:
+        """Persist the watermark if it moved since the last checkpoint."""
+        with self._lock:
+            seq = self._watermark.seq
+            processed = self._watermark.processed
+            now = monotonic()
+            elapsed = now - self._last_time
+
+            if seq is not None and seq != self._last_seq:
+                try:
+                    SubscriptionState.update(
+                        cursor=seq,
+                        last_indexed_at=datetime.now(timezone.utc),
+                    ).where(SubscriptionState.service == self._name).execute()
+                except Exception as e:
+                    logger.error(f'Failed to persist cursor {seq}: {e}')
+                    return
+
+                if self._on_checkpoint:
+                    self._on_checkpoint(seq)
+
+                rate = (processed - self._last_processed) / elapsed if elapsed > 0 else 0
+                logger.info(f'Cursor|{seq}|{rate:.2f} events/s|{elapsed:.2f}s elapsed|{self._watermark.in_flight} in flight')
+                self._last_seq = seq
+
+            self._last_processed = processed
+            self._last_time = now
@@ -0,0 +1,124 @@
+import re
+import zlib
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z0-9][a-z0-9']*")
+
+# Bump when feature extraction changes so stale models are rejected instead of misused
+_MODEL_VERSION = 1
+
+
+def _features(text: str, ngrams: int) -> List[int]:
+    """Stable (process-independent) hashes of the word n-grams of ``text``."""
+    words = _WORD.findall(text.lower()) if text else []
+    hashes = [zlib.crc32(word.encode()) for word in words]
+    for n in range(2, ngrams + 1):
+        hashes.extend(zlib.crc32(' '.join(words[i:i + n]).encode()) for i in range(len(words) - n + 1))
+    return hashes
+
+
+class HashedLinearClassifier:
+    """
+    Logistic regression over hashed word n-grams, scored a whole batch at a time with NumPy.
+
+    Every n-gram is hashed into one of ``2 ** bits`` weights, so a post costs one weight lookup
+    per n-gram whatever the size of the model. ``predict_proba`` gathers the weights of every
+    n-gram in the batch and sums them per post in a single ``bincount``.
+
+    Args:
+        bits: log2 of the number of hashed features.
+        ngrams: Longest word n-gram used as a feature.
+        weights: Trained weights, zeros when omitted.
+        bias: Trained intercept.
+    """
+
+    def __init__(self, bits: int = 20, ngrams: int = 2, weights: np.ndarray = None, bias: float = 0.0):
+        self.bits = bits
+        self.ngrams = ngrams
+        self._mask = (1 << bits) - 1
+        self.weights = weights if weights is not None else np.zeros(1 << bits, dtype=np.float32)
+        self.bias = float(bias)
+
+    def vectorize(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Hash a batch of texts into flat feature arrays.
+
+        Returns:
+            ``(indices, rows, norms)``: the feature index and the row of every n-gram in the batch,
+            and per row the scale that gives each post's feature vector unit length.
+        """
+        indices: List[int] = []
+        rows: List[int] = []
+        counts = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = _features(text, self.ngrams)
+            indices.extend(hashes)
+            rows.extend([row] * len(hashes))
+            counts[row] = len(hashes)
+
+        indices = np.fromiter(indices, dtype=np.int64, count=len(indices)) & self._mask
+        rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+        norms = 1.0 / np.sqrt(np.maximum(counts, 1.0))
+        return indices, rows, norms
+
+    def decision_function(self, texts: Sequence[str]) -> np.ndarray:
+        indices, rows, norms = self.vectorize(texts)
+        return self._scores(indices, rows, norms)
+
+    def _scores(self, indices: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        sums = np.bincount(rows, weights=self.weights[indices], minlength=len(norms))
+        return sums * norms + self.bias
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """Probability that each text is relevant."""
+        if not texts:
+            return np.zeros(0)
+        return 1.0 / (1.0 + np.exp(-self.decision_function(texts)))
+
+    def fit(self, texts: Sequence[str], labels: Iterable[int], epochs: int = 300,
+            learning_rate: float = 20.0, l2: float = 1e-5) -> 'HashedLinearClassifier':
+        """
+        Train with full-batch gradient descent on the logistic loss, weighting both classes
+        equally so a mostly-positive table doesn't teach the model to accept everything.
+        """
+        y = np.asarray(list(labels), dtype=np.float64)
+        indices, rows, norms = self.vectorize(texts)
+        positives = max(y.sum(), 1.0)
+        negatives = max(len(y) - y.sum(), 1.0)
+        sample_weight = np.where(y == 1, 0.5 / positives, 0.5 / negatives)
+
+        weights = self.weights.astype(np.float64)
+        for _ in range(epochs):
+            z = np.bincount(rows, weights=weights[indices], minlength=len(y)) * norms + self.bias
+            error = (1.0 / (1.0 + np.exp(-z)) - y) * sample_weight
+            gradient = np.bincount(indices, weights=(error * norms)[rows], minlength=len(weights))
+            weights -= learning_rate * (gradient + l2 * weights)
+            self.bias -= learning_rate * error.sum()
+
+        self.weights = weights.astype(np.float32)
+        return self
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                version=_MODEL_VERSION,
+                bits=self.bits,
+                ngrams=self.ngrams,
+                weights=self.weights,
+                bias=self.bias,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> 'HashedLinearClassifier':
+        with np.load(path) as model:
+            if int(model['version']) != _MODEL_VERSION:
+                raise ValueError(f'{path} was trained with an incompatible classifier version')
+            return cls(
+                bits=int(model['bits']),
+                ngrams=int(model['ngrams']),
+                weights=model['weights'].astype(np.float32),
+                bias=float(model['bias']),
+            )
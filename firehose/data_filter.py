@@ -1,24 +1,56 @@
-from datetime import datetime, timezone
-import re
-from collections import defaultdict
-from atproto import models, Client, IdResolver
+from typing import Dict, List, Set, Tuple
+from atproto import Client
+from utils.did_cache import get_resolver, handle_for
 from utils.logger import logger
-from database import db, Post
-import json
+from database import db, partitions, Post
+from data_stream import ensure_partitions
+from peewee import chunked, IntegrityError
+from filter_artifacts import FilterArtifacts
+from uri_index import UriIndex
+from engagement import EngagementCounter
+from records import CandidatePost, CommitOps, POST_ROW_FIELDS, PostRow
+import catchup
+import metrics
+from utils import config
 from pathlib import Path
 
-handle_resolver = IdResolver().handle
-did_resolver = IdResolver().did
+# Filter profiles in feed bit order; the first is the original filter_config.json
+FILTER_PROFILES = {name: Path(path) for name, path in config.FILTER_PROFILES.items()}
 
-FILTER_FILE = Path('filter_config.json')
+# Rows per multi-row INSERT / DELETE statement
+_INSERT_CHUNK_SIZE = 500
 
-def load_filters():
-    """Load filters from JSON file or return defaults if file doesn't exist"""
-    if FILTER_FILE.exists():
-        with open(FILTER_FILE, 'r') as f:
-            return json.load(f)
+# Matcher and include/exclude DID feed masks, loaded from the on-disk cache when the config is unchanged;
+# handles are (re-)resolved in the background so startup never waits on the network
+FILTERS = FilterArtifacts(
+    FILTER_PROFILES,
+    Path(config.FILTER_CACHE_PATH),
+    get_resolver().handle.resolve,
+    resolve_interval=config.FILTER_RESOLVE_INTERVAL,
+)
+FILTERS.start()
 
-filters = load_filters()
+# Stored post URIs, so deletes of posts we never stored don't reach the database
+URI_INDEX = UriIndex(rebuild_interval=config.FIREHOSE_URI_INDEX_REBUILD_INTERVAL)
+
+# Replies to stored posts are ingested along with the posts matching the filters
+INGEST_THREADS = config.FIREHOSE_INGEST_THREADS
+
+# Optional second stage: keyword matches are scored in micro-batches when they are written.
+# Imported lazily so numpy is only required when a model is configured
+CLASSIFIER = None
+if config.FIREHOSE_CLASSIFIER_PATH:
+    from classifier import HashedLinearClassifier
+    CLASSIFIER = HashedLinearClassifier.load(config.FIREHOSE_CLASSIFIER_PATH)
+    logger.info(f'Classifier loaded from {config.FIREHOSE_CLASSIFIER_PATH} (threshold {config.FIREHOSE_CLASSIFIER_THRESHOLD}).')
+
+# URIs of keyword matches waiting for the classifier; accepted ones are added to URI_INDEX
+_PENDING_CANDIDATES: Set[str] = set()
+
+# Likes, reposts and replies on stored posts, flushed to the post table as aggregated deltas
+ENGAGEMENT = EngagementCounter(URI_INDEX, flush_interval=config.FIREHOSE_ENGAGEMENT_FLUSH_INTERVAL)
+
+filters = FILTERS.filters
 HANDLES = filters['HANDLES']
 EXCLUDE_HANDLES = filters['EXCLUDE_HANDLES']
 PHRASES = filters['PHRASES']
@@ -26,124 +58,155 @@ INCLUSIVE_MULTI_TOKENS = filters['INCLUSIVE_MULTI_TOKENS']
 TOKENS = filters['TOKENS']
 EXCLUDE_TOKENS = filters['EXCLUDE_TOKENS']
 
-dids_to_include = [handle_resolver.resolve(handle) for handle in HANDLES]
-dids_to_exclude = [handle_resolver.resolve(handle) for handle in EXCLUDE_HANDLES]
-
-def compile_pattern(items, word_boundary=True, plural=True):
-    escaped = [re.escape(item) for item in items]
-    if plural:
-        # Add optional 's' at the end
-        escaped = [f"{item}s?" for item in escaped]
-    pattern = "|".join(escaped)
-    if word_boundary:
-        # Use raw string for word boundaries
-        pattern = r'\b(?:' + pattern + r')\b'
-    return pattern
-
-# Compile single-word include tokens into one pattern
-INCLUDE_TOKENS_PATTERN = compile_pattern(TOKENS)
-INCLUDE_TOKENS_REGEX = re.compile(INCLUDE_TOKENS_PATTERN, re.IGNORECASE)
-
-# Compile single-word exclude tokens into one pattern
-EXCLUDE_TOKENS_PATTERN = compile_pattern(EXCLUDE_TOKENS)
-EXCLUDE_TOKENS_REGEX = re.compile(EXCLUDE_TOKENS_PATTERN, re.IGNORECASE)
-
-# Compile phrases into one pattern
-PHRASES_PATTERN = compile_pattern(PHRASES)
-PHRASES_REGEX = re.compile(PHRASES_PATTERN, re.IGNORECASE)
-
-# Compile tokens with spaces using positive lookaheads
-def compile_multi_word_lookahead(tokens):
-    patterns = []
-    for token in tokens:
-        words = token.split()
-        # Use formatted raw strings within lookaheads
-        lookaheads = ''.join([fr'(?=.*\b{re.escape(word)}\b)' for word in words])
-        patterns.append(lookaheads)
-    # Combine all multi-word token lookaheads into one pattern with alternation
-    combined_pattern = '|'.join(patterns)
-    return re.compile(combined_pattern, re.IGNORECASE)
-
-# Compile include tokens with spaces using positive lookaheads
-INCLUSIVE_MULTI_WORD_PATTERN = compile_multi_word_lookahead(INCLUSIVE_MULTI_TOKENS)
+# Tokens, phrases, multi-word tokens and exclude tokens of every profile compiled into one single-pass matcher
+MATCHER = FILTERS.matcher
+ALL_FEEDS = FILTERS.all_feeds
 
 def matches_filters(text):
-    # Use case-insensitive matching; no need to lowercase the text
-    # Check exclude patterns first
-    if EXCLUDE_TOKENS_REGEX.search(text):
-        return False
+    # Any exclude token wins, then phrases, multi-word tokens and tokens include the post
+    return MATCHER.matches(text)
+
+
+def matching_feeds(text) -> int:
+    # Bitmask of the profiles whose keyword filters accept the post, from one scan
+    return MATCHER.feeds(text)
 
-    # Check include patterns
-    if PHRASES_REGEX.search(text):
-        return True
-    if INCLUSIVE_MULTI_WORD_PATTERN.search(text):
-        return True
-    if INCLUDE_TOKENS_REGEX.search(text):
-        return True
 
-    return False
+def filter_operations(ops: CommitOps) -> Tuple[List[PostRow], List[str]]:
+    """Select the posts to store and the post URIs to delete from a commit's operations."""
+    created_posts = ops.posts
 
+    replies = [post.reply_parent for post in created_posts if post.reply_parent]
+    ENGAGEMENT.record(ops.like_subjects, ops.repost_subjects, replies)
 
-def operations_callback(ops: defaultdict) -> None:
-    created_posts = ops[models.ids.AppBskyFeedPost]['created']
-    deleted_posts = ops[models.ids.AppBskyFeedPost]['deleted']
+    # Replaying a backlog skips per-post logging and handle lookups
+    quiet = catchup.active()
 
     posts_to_create = []
+    indexed_at = None
     for post in created_posts:
-        record = post['record']
-        did = post['author']
-        now = datetime.now(timezone.utc)
+        did = post.repo
 
-        if did in dids_to_exclude:
-            logger.info(f'Skipping post from excluded DID: {did}')
+        excluded = FILTERS.exclude_feeds.get(did, 0)
+        if excluded == ALL_FEEDS:
+            if not quiet: logger.info(f'Skipping post from excluded DID: {did}')
             continue
-        
-        if did in dids_to_include:
-            logger.info(f'Processing post from included DID: {did}')
-        
-            posts_to_create.append({
-                'uri': post['uri'],
-                'cid': post['cid'],
-                'reply_parent': record.reply.parent.uri if record.reply else None,
-                'reply_root': record.reply.root.uri if record.reply else None,
-                'author': did,
-                'interactions': 0,
-                'indexed_at': now,
-                'text': record.text if hasattr(record, 'text') else None,
-            })
 
+        # A post joins every feed that includes its author, matches its text or holds its thread,
+        # minus the feeds that exclude its author
+        included = FILTERS.include_feeds.get(did, 0)
+        matched = matching_feeds(post.text)
+        # Replies in a stored thread cost two dict lookups, no query
+        in_thread = 0
+        if INGEST_THREADS and post.reply_root is not None:
+            in_thread = URI_INDEX.feeds_of(post.reply_root) | URI_INDEX.feeds_of(post.reply_parent)
+
+        feeds = (included | matched | in_thread) & ~excluded
+        if not feeds:
             continue
 
-        
-        if matches_filters(record.text):
-            reply_root = post['record'].reply.root.uri if post['record'].reply else None
-            reply_parent = post['record'].reply.parent.uri if post['record'].reply else None
-
-            #logger.info(f'Processing matched post: {record.text}')
-            logger.info(f'Processing matched post from {did_resolver.resolve(did).also_known_as[0]}')
-
-            posts_to_create.append({
-                'uri': post['uri'],
-                'cid': post['cid'],
-                'reply_parent': reply_parent,
-                'reply_root': reply_root,
-                'author': did,
-                'interactions': 0,
-                'indexed_at': now,
-                'text': record.text if hasattr(record, 'text') else None,
-            })
-
-    if deleted_posts:
-        post_uris_to_delete = [post['uri'] for post in deleted_posts]
-        if post_uris_to_delete:
-            # Assuming Post.delete() returns a query builder that needs to be executed
-            deleted_count = 0
-            with db.atomic():
-                deleted_count = Post.delete().where(Post.uri.in_(post_uris_to_delete)).execute()
-            if deleted_count>0: logger.info(f'Deleted: {deleted_count}')
+        if included & feeds:
+            if not quiet: logger.info(f'Processing post from included DID: {did}')
+            row_type = PostRow
+        else:
+            #logger.info(f'Processing matched post: {post.text}')
+            # Never wait on the network here: unknown handles are resolved in the background
+            if not quiet: logger.info(f'Processing {"thread reply" if in_thread & feeds else "matched post"} from {handle_for(did) or did}')
+            # Only keyword matches go through the classifier; thread replies and included DIDs bypass it
+            row_type = CandidatePost if CLASSIFIER is not None and not in_thread & feeds else PostRow
+
+        # URI and CID strings and the timestamp are only built once a post is kept
+        if indexed_at is None:
+            indexed_at = ops.indexed_at()
+        # Postgres text can't hold NUL characters, which psycopg2 rejects for the whole batch
+        text = post.text.replace('\x00', '') if post.text else post.text
+        posts_to_create.append(row_type(
+            post.uri, str(post.cid), post.reply_parent, post.reply_root, indexed_at, did, 0, text, feeds,
+        ))
 
     if posts_to_create:
+        # Keyword matches only join the index once the classifier accepts them
+        kept = {}
+        for post in posts_to_create:
+            if isinstance(post, CandidatePost):
+                _PENDING_CANDIDATES.add(post.uri)
+            else:
+                kept[post.uri] = post.feeds
+        if kept:
+            URI_INDEX.add(kept)
+    post_uris_to_delete = URI_INDEX.filter(ops.deleted_posts)
+    if _PENDING_CANDIDATES and ops.deleted_posts:
+        # Not indexed yet but may still be stored; the delete runs after the insert
+        pending = [uri for uri in ops.deleted_posts if uri in _PENDING_CANDIDATES]
+        if pending:
+            _PENDING_CANDIDATES.difference_update(pending)
+            post_uris_to_delete = post_uris_to_delete + pending
+
+    return posts_to_create, post_uris_to_delete
+
+
+def index_posts(posts: Dict[str, int]) -> None:
+    """Record posts another process is storing, as URIs mapped to their feed bitmasks."""
+    URI_INDEX.add(posts)
+
+
+def classify_posts(posts_to_create: List[PostRow]) -> List[PostRow]:
+    """
+    Score the keyword matches of a write batch with the classifier in one pass and drop those
+    below FIREHOSE_CLASSIFIER_THRESHOLD. Posts that bypass the classifier pass through.
+    """
+    if CLASSIFIER is None:
+        return posts_to_create
+
+    posts, candidates = [], []
+    for post in posts_to_create:
+        (candidates if isinstance(post, CandidatePost) else posts).append(post)
+    if not candidates:
+        return posts
+
+    scores = CLASSIFIER.predict_proba([post.text or '' for post in candidates])
+    accepted, rejected = {}, 0
+    for post, score in zip(candidates, scores):
+        if score >= config.FIREHOSE_CLASSIFIER_THRESHOLD:
+            posts.append(PostRow._make(post))
+            # Unless deleted while waiting, which already sent its delete after this insert
+            if post.uri in _PENDING_CANDIDATES:
+                accepted[post.uri] = post.feeds
+        else:
+            rejected += 1
+    _PENDING_CANDIDATES.difference_update(post.uri for post in candidates)
+
+    if accepted:
+        URI_INDEX.add(accepted)
+    if rejected:
+        metrics.CLASSIFIER_REJECTED.inc(rejected)
+        logger.info(f'Rejected: {rejected}')
+    return posts
+
+
+def write_operations(posts_to_create: List[PostRow], post_uris_to_delete: List[str]) -> None:
+    """
+    Persist filtered posts and deletions in a single transaction using multi-row statements.
+    Keyword matches must have been through ``classify_posts`` already.
+    """
+    added_count = deleted_count = 0
+    try:
         with db.atomic():
-            for post_dict in posts_to_create:
-                Post.create(**post_dict)
-        logger.info(f'Added: {len(posts_to_create)}')
+            for batch in chunked(posts_to_create, _INSERT_CHUNK_SIZE):
+                # Replays after a restart re-send posts that are already stored; the unique URI skips them
+                added_count += Post.insert_many(batch, fields=POST_ROW_FIELDS).on_conflict_ignore().as_rowcount().execute()
+            for batch in chunked(post_uris_to_delete, _INSERT_CHUNK_SIZE):
+                deleted_count += Post.delete().where(Post.uri.in_(batch)).execute()
+    except IntegrityError as e:
+        if partitions.is_missing_partition(e):
+            # e.g. a replay older than the partitions; the writer's retry then finds them
+            ensure_partitions(posts_to_create)
+        raise
+
+    if deleted_count>0: logger.info(f'Deleted: {deleted_count}')
+    if posts_to_create: logger.info(f'Added: {added_count}' + (f' ({len(posts_to_create) - added_count} already stored)' if added_count < len(posts_to_create) else ''))
+
+
+def operations_callback(ops: CommitOps) -> None:
+    posts_to_create, post_uris_to_delete = filter_operations(ops)
+    write_operations(classify_posts(posts_to_create), post_uris_to_delete)
@@ -1,83 +1,192 @@
-from collections import defaultdict
-from datetime import datetime, timezone
-from time import time
+import threading
+from datetime import timedelta, timezone
+from time import sleep
+from typing import List, Optional, Tuple
 
 from atproto import (
-    AtUri,
-    CAR,
     firehose_models,
     FirehoseSubscribeReposClient,
     models,
     parse_subscribe_repos_message,
 )
 from atproto.exceptions import FirehoseError
+import peewee
 
-from database import db, Post, SubscriptionState, SessionState, Requests
+from car_reader import LazyCAR
+from catchup import CatchUpMonitor
+import metrics
+from checkpoint import Checkpointer
+from database import db, migrate, partitions, SubscriptionState
+from pipeline import Pipeline
+from records import CommitOps, CreatedPost
+from spool import Spool
+from utils import config
 from utils.logger import logger
+from watermark import SeqWatermark
+from writer import BulkWriter
+
+# Collections we decode: posts are filtered, likes and reposts only count engagement on stored posts
+_INTERESTED_COLLECTIONS = frozenset((
+    models.ids.AppBskyFeedPost,
+    models.ids.AppBskyFeedLike,
+    models.ids.AppBskyFeedRepost,
+))
+
+
+def _needs_blocks(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> bool:
+    """Cheap pre-pass: does any op create a record we would actually decode?"""
+    for op in commit.ops:
+        if op.action == 'create' and op.cid and op.path.split('/', 1)[0] in _INTERESTED_COLLECTIONS:
+            return True
+    return False
+
+
+def _has_interesting_ops(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> bool:
+    """Does the commit create or delete any record type we track?"""
+    for op in commit.ops:
+        collection = op.path.split('/', 1)[0]
+        if op.action == 'create' and collection in _INTERESTED_COLLECTIONS:
+            return True
+        # Only post deletes matter; unlikes and un-reposts can't be attributed to a subject
+        if op.action == 'delete' and collection == models.ids.AppBskyFeedPost:
+            return True
+    return False
+
+
+def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> CommitOps:
+    """Extract the post creates and deletes and the like/repost subjects of a commit."""
+    ops = CommitOps(commit.repo, commit.time)
+
+    # Likes, follows and reposts dominate traffic; skip CAR decoding entirely when
+    # no op creates a record we care about. Otherwise only decode the blocks we look up.
+    car = LazyCAR(commit.blocks) if commit.blocks and _needs_blocks(commit) else None
 
-# Define the types of records we're interested in and their corresponding namespace IDs
-_INTERESTED_RECORDS = {
-    models.AppBskyFeedPost: models.ids.AppBskyFeedPost,
-}
-
-def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defaultdict:
-    """Memory-optimized version of operation processing"""
-    operations_by_type = defaultdict(lambda: {'created': [], 'deleted': []})
-    
-    # Process CAR blocks in chunks to reduce memory usage
-    car = CAR.from_bytes(commit.blocks)
-    
     for op in commit.ops:
         # Early return for updates we don't care about
         if op.action == 'update':
             continue
-            
-        uri = AtUri.from_str(f'at://{commit.repo}/{op.path}')
-        
+
+        collection = op.path.split('/', 1)[0]
+        if collection not in _INTERESTED_COLLECTIONS:
+            continue
+
         # Handle deletions immediately - they're lightweight
         if op.action == 'delete':
-            operations_by_type[uri.collection]['deleted'].append({'uri': str(uri)})
+            if collection == models.ids.AppBskyFeedPost:
+                ops.deleted_posts.append(f'at://{commit.repo}/{op.path}')
             continue
 
-        # For creates, only process if we have a valid CID and it's a record type we care about
-        if op.action == 'create' and op.cid and uri.collection in _INTERESTED_RECORDS.values():
-            record_raw_data = car.blocks.get(op.cid)
-            if not record_raw_data:
-                continue
-
+        # For creates, only process if we have a valid CID
+        if op.action == 'create' and op.cid and car:
             try:
-                # Only parse records we're interested in
-                record = models.get_or_create(record_raw_data, strict=False)
-                create_info = {'uri': str(uri), 'cid': str(op.cid), 'author': commit.repo}
-                operations_by_type[uri.collection]['created'].append({'record': record, **create_info})
+                record = car.get(op.cid)
+                if not record:
+                    continue
+
+                # Only the fields filtering reads are taken from the raw record; no model is built
+                if collection == models.ids.AppBskyFeedPost:
+                    reply = record.get('reply')
+                    ops.posts.append(CreatedPost(
+                        commit.repo,
+                        op.path,
+                        op.cid,
+                        record.get('text', ''),
+                        reply['root']['uri'] if reply else None,
+                        reply['parent']['uri'] if reply else None,
+                    ))
+                elif collection == models.ids.AppBskyFeedLike:
+                    ops.like_subjects.append(record['subject']['uri'])
+                else:
+                    ops.repost_subjects.append(record['subject']['uri'])
             except Exception as e:
                 logger.error(f"Failed to parse record: {e}")
                 continue
 
-    # Clear references to help garbage collection
-    del car
-    return operations_by_type
+    return ops
+
+
+def init_database():
+    """Connect to the database and apply any pending schema migrations."""
+    if db.is_closed():
+        db.connect()
+        for step in migrate():
+            logger.info(f'Applied schema migration {step.version}: {step.description}.')
+        logger.info("Database connected and schema up to date.")
+        metrics.watch_pool(db)
+
+        # Posts are stamped with their commit time, so a replay after a long outage needs the
+        # partitions back to the last checkpoint
+        since = SubscriptionState.select(peewee.fn.MIN(SubscriptionState.last_indexed_at)).scalar()
+        _maintain_partitions(since=since.date() - timedelta(days=1) if since else None, wait=True)
+        threading.Thread(target=_partition_loop, name='partitions', daemon=True).start()
 
 
-def run(name, operations_callback, stream_stop_event=None):
+def _maintain_partitions(since=None, wait: bool = False, poll_interval: float = 1.0) -> None:
+    """
+    Create the daily post partitions missing up to partitions.DAYS_AHEAD days ahead. A round
+    another maintainer holds the lock for is skipped, unless ``wait`` polls until it is free.
+    """
+    while True:
+        try:
+            result = partitions.maintain(since=since)
+        except Exception as e:
+            logger.error(f'Failed to create post partitions: {e}')
+            return
+        # The other maintainer only covers its own days, which may not reach back to ``since``
+        if result is not None or not wait or not partitions.is_partitioned():
+            break
+        sleep(poll_interval)
+    if result and result['created']:
+        logger.info(f"Created post partitions for {', '.join(day.isoformat() for day in result['created'])}.")
+
+
+def ensure_partitions(posts_to_create: List) -> None:
+    """Create the partitions missing from the day of the oldest post on, after ``partitions.is_missing_partition``."""
+    if posts_to_create:
+        oldest = min(post.indexed_at for post in posts_to_create)
+        _maintain_partitions(since=oldest.astimezone(timezone.utc).date(), wait=True)
+
+
+def _partition_loop(interval: float = 60 * 60) -> None:
+    while True:
+        sleep(interval)
+        try:
+            # Its own connection: peewee connections are per thread
+            with db.connection_context():
+                _maintain_partitions()
+        except peewee.PeeweeException as e:
+            logger.error(f'Failed to create post partitions: {e}')
+
+
+def open_spool(suffix: str = '') -> Optional[Spool]:
+    """Open the write spool configured by FIREHOSE_SPOOL_PATH, or None when it is disabled."""
+    if not config.FIREHOSE_SPOOL_PATH:
+        return None
+    spool = Spool(config.FIREHOSE_SPOOL_PATH + suffix, max_bytes=config.FIREHOSE_SPOOL_MAX_BYTES)
+    metrics.watch_spool(spool)
+    return spool
+
+
+def run(name, filter_callback, write_callback, stream_stop_event=None, prepare_callback=None):
     """
     Starts the firehose client and processes incoming messages.
 
     Args:
         name: The name of the service/subscription.
-        operations_callback: A callback function to handle the operations extracted from messages.
+        filter_callback: Selects the posts to create and delete from the extracted operations.
+        write_callback: Persists the posts selected by filter_callback.
         stream_stop_event: An optional threading.Event to signal when to stop the stream.
+        prepare_callback: Applied once to the posts of every flush before they are written.
     """
-    # Initialize Database
-    if db.is_closed():
-        db.connect()
-        db.create_tables([Post, SubscriptionState, SessionState, Requests])
-        logger.info("Database connected and tables created.")
+    init_database()
+    metrics.start_server(config.FIREHOSE_METRICS_PORT)
+    # Opened once so batches spooled before a reconnect keep draining in order
+    spool = open_spool()
 
     while stream_stop_event is None or not stream_stop_event.is_set():
         try:
             # Start the main run loop
-            _run(name, operations_callback, stream_stop_event)
+            _run(name, filter_callback, write_callback, stream_stop_event, spool, prepare_callback)
         except FirehoseError as e:
             logger.error(f"Firehose error: {e}")
             # Implement a backoff or retry mechanism here
@@ -89,20 +198,52 @@ def run(name, operations_callback, stream_stop_event=None):
             logger.info("You should not see this ...")
 
 
-def _run(name, operations_callback, stream_stop_event=None):
+def _decode_message(message: firehose_models.MessageFrame) -> Tuple[Optional[int], Optional[CommitOps]]:
+    """
+    Parses a message frame and extracts its operations. Runs on a pipeline decode worker.
+
+    Args:
+        message: The message frame received from the firehose.
+
+    Returns:
+        The frame's sequence number (None if it has none) and its operations,
+        or None if there is nothing to process.
+    """
+    # Parse the message into a commit object
+    commit = parse_subscribe_repos_message(message)
+    seq = getattr(commit, 'seq', None)
+
+    # Only process commit messages
+    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+        return seq, None
+
+    if not commit.blocks:
+        # Skip if there are no blocks to process
+        return seq, None
+
+    metrics.COMMITS.inc()
+    metrics.observe_commit_time(commit.time)
+
+    # Extract operations from the commit
+    return seq, _get_ops_by_type(commit)
+
+
+def _run(name, filter_callback, write_callback, stream_stop_event=None, spool=None, prepare_callback=None):
     """
     Connects to the firehose, sets up the message handler, and starts streaming messages.
 
+    The message handler only hands frames to a staged pipeline; parsing, CAR decoding,
+    filtering and database writes all happen on pipeline threads. The cursor is checkpointed
+    from a watermark that only passes events once their posts are committed.
+
     Args:
         name: The name of the service/subscription.
-        operations_callback: A callback function to handle the operations extracted from messages.
+        filter_callback: Selects the posts to create and delete from the extracted operations.
+        write_callback: Persists the posts selected by filter_callback.
         stream_stop_event: An optional threading.Event to signal when to stop the stream.
+        spool: Optional disk spool the writer falls back to while the database is behind.
+        prepare_callback: Applied once to the posts of every flush before they are written.
     """
-    # Add performance monitoring variables
-    last_seq = 0
-    last_time = time()
-    processed_count = 0
-
     # Retrieve the last known cursor position from the database
     state = SubscriptionState.get_or_none(SubscriptionState.service == name)
 
@@ -117,10 +258,51 @@ def _run(name, operations_callback, stream_stop_event=None):
     # Initialize the firehose client
     client = FirehoseSubscribeReposClient(params)
 
+    watermark = SeqWatermark(state.cursor if state else None)
+    checkpointer = Checkpointer(
+        name,
+        watermark,
+        interval=config.FIREHOSE_CHECKPOINT_INTERVAL,
+        events=config.FIREHOSE_CHECKPOINT_EVENTS,
+        # Reconnects resume from the last checkpoint rather than the original cursor
+        on_checkpoint=lambda seq: client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=seq)),
+    )
+    writer = BulkWriter(
+        write_callback,
+        batch_size=config.FIREHOSE_WRITE_BATCH_SIZE,
+        max_latency=config.FIREHOSE_WRITE_MAX_LATENCY,
+        queue_size=config.FIREHOSE_WRITE_QUEUE_SIZE,
+        on_flushed=watermark.finish_all,
+        spool=spool,
+        prepare=prepare_callback,
+    )
+    pipeline = Pipeline(
+        _decode_message,
+        filter_callback,
+        writer,
+        watermark,
+        decode_workers=config.FIREHOSE_DECODE_WORKERS,
+        receive_queue_size=config.FIREHOSE_RECEIVE_QUEUE_SIZE,
+    )
+
+    def apply_profile(catching_up: bool) -> None:
+        # Replaying a backlog favours throughput: bigger flushes and every decode worker available
+        if catching_up:
+            writer.configure(config.FIREHOSE_CATCHUP_BATCH_SIZE, config.FIREHOSE_CATCHUP_MAX_LATENCY)
+            pipeline.set_decode_workers(config.FIREHOSE_CATCHUP_DECODE_WORKERS)
+        else:
+            writer.configure(config.FIREHOSE_WRITE_BATCH_SIZE, config.FIREHOSE_WRITE_MAX_LATENCY)
+            pipeline.set_decode_workers(config.FIREHOSE_DECODE_WORKERS)
+
+    catchup = CatchUpMonitor(
+        enter_lag=config.FIREHOSE_CATCHUP_ENTER_LAG,
+        exit_lag=config.FIREHOSE_CATCHUP_EXIT_LAG,
+        on_change=apply_profile,
+    )
+
     def on_message_handler(message: firehose_models.MessageFrame) -> None:
-        nonlocal last_seq, last_time, processed_count, stream_stop_event, client
         """
-        Handles incoming messages from the firehose.
+        Handles incoming messages from the firehose by queueing them for the pipeline.
 
         Args:
             message: The message frame received from the firehose.
@@ -131,45 +313,21 @@ def _run(name, operations_callback, stream_stop_event=None):
             client.stop()
             return
 
-        try:
-            # Parse the message into a commit object
-            commit = parse_subscribe_repos_message(message)
-        except Exception as e:
-            logger.error(f"Failed to parse message: {e}")
-            return
+        metrics.FRAMES.inc()
+        pipeline.submit(message)
 
-        # Only process commit messages
-        if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
-            #logger.warning(f"Received non-commit message: {commit}")
-            return
-        
-        if not commit.blocks:
-            # Skip if there are no blocks to process
-            return
+    metrics.watch_watermark(watermark)
+    metrics.RECEIVE_QUEUE.set_callback(lambda: pipeline.receive_queue_depth)
+    metrics.WRITE_QUEUE.set_callback(lambda: pipeline.write_queue_depth)
 
-        # Update the cursor every ~20,000 events
-        if commit.seq % 20000 == 0:
-            current_time = time()
-            elapsed = current_time - last_time
-            rate = 20000 / elapsed if elapsed > 0 else 0
-            
-            logger.info(f'Cursor|{commit.seq}|{rate:.2f} events/s|{elapsed:.2f}s elapsed')
-            
-            last_time = current_time
-
-            # Update the client's parameters with the new cursor
-            client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=commit.seq))
-            # Persist the new cursor in the database with the last indexed timestamp
-            SubscriptionState.update(
-                cursor=commit.seq,
-                last_indexed_at=datetime.now(timezone.utc),
-            ).where(SubscriptionState.service == name).execute()
-                
-
-        # Extract operations from the commit
-        operations = _get_ops_by_type(commit)
-        # Pass the operations to the callback function
-        operations_callback(operations)
-
-    # Start the client with the message handler
-    client.start(on_message_handler)
+    pipeline.start()
+    checkpointer.start()
+    catchup.start()
+    try:
+        # Start the client with the message handler
+        client.start(on_message_handler)
+    finally:
+        # Finish decoding and writing everything received, then record how far we got
+        catchup.stop()
+        pipeline.stop()
+        checkpointer.stop()
@@ -0,0 +1,109 @@
+import atexit
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+
+from peewee import chunked, PeeweeException
+
+from database import db
+from uri_index import UriIndex
+from utils.logger import logger
+
+# Rows per multi-row UPDATE statement
+_UPDATE_CHUNK_SIZE = 500
+
+# Applies aggregated deltas and recomputes the hot score with the formula the hydrate job uses:
+# (likes + 2 * replies + 3 * reposts) / (age_in_hours + 2) ** 1.5, scaled by 100
+_UPDATE_SQL = """
+UPDATE post SET
+    like_count = post.like_count + v.likes,
+    repost_count = post.repost_count + v.reposts,
+    reply_count = post.reply_count + v.replies,
+    interactions = ((post.like_count + v.likes + 2 * (post.reply_count + v.replies) + 3 * (post.repost_count + v.reposts))
+        / power(extract(epoch from (now() at time zone 'utc') - post.indexed_at) / 3600 + 2, 1.5) * 100)::bigint
+FROM (VALUES {values}) AS v(uri, likes, reposts, replies)
+WHERE post.uri = v.uri
+"""
+
+
+class EngagementCounter:
+    """
+    Counts likes, reposts and replies on stored posts straight from the firehose and flushes
+    the aggregated deltas every ``flush_interval`` seconds with one UPDATE per chunk.
+
+    Only subjects in the URI index are counted, so engagement on the rest of the network never
+    reaches the database. Counts are best effort: unlikes and un-reposts only carry the URI of
+    the like or repost record, not its subject, so they are not subtracted, and deltas still in
+    memory when the process dies are lost. The hydrate job resets the counters from the API.
+
+    Args:
+        uri_index: Index of the post URIs stored in the database.
+        flush_interval: Seconds between flushes.
+    """
+
+    def __init__(self, uri_index: UriIndex, flush_interval: float = 10.0):
+        self._uri_index = uri_index
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._deltas: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])  # likes, reposts, replies
+        self._thread: Optional[threading.Thread] = None
+
+        self.flushed_posts = 0
+        self.flushed_events = 0
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_loop, name='engagement', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def record(self, likes: List[str], reposts: List[str], replies: List[str]) -> None:
+        """Count the subject URIs of new likes, reposts and replies."""
+        index = self._uri_index
+        if not (likes or reposts or replies):
+            return
+
+        self._ensure_started()
+        with self._lock:
+            for column, subjects in enumerate((likes, reposts, replies)):
+                for uri in subjects:
+                    if uri in index:
+                        self._deltas[uri][column] += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            deltas = self._deltas
+            self._deltas = defaultdict(lambda: [0, 0, 0])
+
+        if not deltas:
+            return
+
+        started = monotonic()
+        rows = [(uri, likes, reposts, replies) for uri, (likes, reposts, replies) in deltas.items()]
+        try:
+            with db.atomic():
+                for batch in chunked(rows, _UPDATE_CHUNK_SIZE):
+                    values = ', '.join(['(%s, %s::int, %s::int, %s::int)'] * len(batch))
+                    db.execute_sql(_UPDATE_SQL.format(values=values), [param for row in batch for param in row])
+        except Exception as e:
+            logger.error(f'Failed to flush engagement for {len(rows)} posts: {e}')
+            return
+
+        events = sum(likes + reposts + replies for _, likes, reposts, replies in rows)
+        self.flushed_posts += len(rows)
+        self.flushed_events += events
+        logger.info(f'Engagement|{events} events|{len(rows)} posts|{monotonic() - started:.2f}s flush')
+
+    def _flush_loop(self) -> None:
+        while True:
+            sleep(self._flush_interval)
+            if not self._deltas:
+                continue
+            try:
+                with db.connection_context():
+                    self.flush()
+            except PeeweeException as e:
+                logger.error(f'Failed to get a database connection for the engagement flush: {e}')
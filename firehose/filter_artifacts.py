@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional
+
+from matcher import FilterMatcher
+from utils.logger import logger
+
+# Bump when the pickled layout or the matcher's internals change
+_ARTIFACT_VERSION = 2
+
+
+class FilterArtifacts:
+    """
+    Everything ``filter_operations`` needs, compiled from the filter profiles: one keyword
+    matcher covering every profile and, per DID, the bitmask of the profiles that include or
+    exclude it, resolved from the configured handles.
+
+    Artifacts are pickled to disk keyed by the sha256 of the profiles and their config files, so
+    a restart with an unchanged config loads them without compiling or resolving anything.
+    Handles are resolved on a background thread and the DID maps are swapped in whole, so
+    readers never lock.
+
+    Args:
+        profiles: Profile names mapped to their ``filter_config.json``, in feed bit order.
+        cache_path: Where the pickled artifacts are stored.
+        resolve_handle: Resolves a handle to a DID, returning None when it does not exist.
+        resolve_interval: Seconds after which handles are resolved again.
+    """
+
+    def __init__(
+        self,
+        profiles: Dict[str, Path],
+        cache_path: Path,
+        resolve_handle: Callable[[str], Optional[str]],
+        resolve_interval: float = 3600,
+    ):
+        self._cache_path = Path(cache_path)
+        self._resolve_handle = resolve_handle
+        self._resolve_interval = resolve_interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        digest = hashlib.sha256()
+        self.names: List[str] = []
+        self.profiles: List[dict] = []
+        for name, filter_file in profiles.items():
+            raw = Path(filter_file).read_bytes()
+            digest.update(name.encode() + b'\0' + hashlib.sha256(raw).digest())
+            self.names.append(name)
+            self.profiles.append(json.loads(raw))
+        self.digest = digest.hexdigest()
+        # The first profile is the original single-topic feed
+        self.filters = self.profiles[0]
+        self.all_feeds = (1 << len(self.profiles)) - 1
+
+        self.matcher: Optional[FilterMatcher] = None
+        self._handle_dids: Dict[str, Optional[str]] = {}
+        self._resolved_at = 0.0  # wall clock of the last complete resolution
+        self.include_feeds: Dict[str, int] = {}
+        self.exclude_feeds: Dict[str, int] = {}
+
+        started = monotonic()
+        loaded = self._load()
+        if self.matcher is None:
+            self.matcher = FilterMatcher.from_profiles(self.profiles)
+        self._rebuild_did_feeds()
+        if not loaded:
+            self._save()
+
+        logger.info(
+            f"Filters {'loaded' if loaded else 'compiled'} in {(monotonic() - started) * 1000:.1f}ms "
+            f"({len(self.profiles)} profiles, {len(self.include_feeds)} included, {len(self.exclude_feeds)} excluded DIDs)."
+        )
+
+    @property
+    def handles(self):
+        handles = set()
+        for filters in self.profiles:
+            handles.update(filters['HANDLES'], filters['EXCLUDE_HANDLES'])
+        return handles
+
+    def feed_names(self, feeds: int) -> List[str]:
+        """Names of the profiles whose bits are set in ``feeds``."""
+        return [name for i, name in enumerate(self.names) if feeds >> i & 1]
+
+    def start(self) -> None:
+        """Start resolving handles in the background; resolution is skipped while the cache is fresh."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._resolve_loop, name='filter-resolve', daemon=True)
+            self._thread.start()
+
+    def _load(self) -> bool:
+        """Load cached artifacts. Returns True when they match the current config exactly."""
+        try:
+            with open(self._cache_path, 'rb') as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(f'Ignoring unreadable filter cache {self._cache_path}: {e}')
+            return False
+
+        if cached.get('version') != _ARTIFACT_VERSION:
+            return False
+
+        # Resolved handles stay useful when the config changed; only keep those still configured
+        handles = self.handles
+        self._handle_dids = {handle: did for handle, did in cached['handle_dids'].items() if handle in handles}
+
+        if cached['digest'] != self.digest:
+            return False
+
+        self.matcher = cached['matcher']
+        self._resolved_at = cached['resolved_at']
+        return True
+
+    def _save(self) -> None:
+        with self._lock:
+            cached = {
+                'version': _ARTIFACT_VERSION,
+                'digest': self.digest,
+                'matcher': self.matcher,
+                'handle_dids': dict(self._handle_dids),
+                'resolved_at': self._resolved_at,
+            }
+
+        try:
+            self._cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Sharded workers may save concurrently, so each writes its own file before renaming
+            tmp_path = self._cache_path.with_name(f'{self._cache_path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            logger.error(f'Failed to persist filter cache to {self._cache_path}: {e}')
+
+    def _rebuild_did_feeds(self) -> None:
+        with self._lock:
+            handle_dids = self._handle_dids
+            include_feeds: Dict[str, int] = {}
+            exclude_feeds: Dict[str, int] = {}
+            for i, filters in enumerate(self.profiles):
+                for did in filter(None, map(handle_dids.get, filters['HANDLES'])):
+                    include_feeds[did] = include_feeds.get(did, 0) | 1 << i
+                for did in filter(None, map(handle_dids.get, filters['EXCLUDE_HANDLES'])):
+                    exclude_feeds[did] = exclude_feeds.get(did, 0) | 1 << i
+            self.include_feeds = include_feeds
+            self.exclude_feeds = exclude_feeds
+
+    def resolve(self) -> None:
+        """Resolve every configured handle, then swap in the new DID maps and persist them."""
+        resolved = {}
+        failed = 0
+        for handle in self.handles:
+            try:
+                did = self._resolve_handle(handle)
+            except Exception as e:
+                logger.error(f'Failed to resolve handle {handle}: {e}')
+                did = self._handle_dids.get(handle)
+                failed += 1
+            # Handles that don't exist are kept as None so they aren't retried until the next round
+            resolved[handle] = did
+
+        with self._lock:
+            self._handle_dids = resolved
+            if not failed:
+                self._resolved_at = datetime.now(timezone.utc).timestamp()
+        self._rebuild_did_feeds()
+        self._save()
+
+        logger.info(
+            f'Resolved {len(resolved)} filter handles ({failed} failed): '
+            f'{len(self.include_feeds)} included, {len(self.exclude_feeds)} excluded DIDs.'
+        )
+
+    def _resolve_loop(self) -> None:
+        while True:
+            age = datetime.now(timezone.utc).timestamp() - self._resolved_at
+            # Handles missing from the cache (new config entries) are resolved straight away
+            if age >= self._resolve_interval or not self.handles <= self._handle_dids.keys():
+                self.resolve()
+                age = 0
+            sleep(max(60.0, self._resolve_interval - age))
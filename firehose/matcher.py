@@ -0,0 +1,201 @@
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Flags reported by FilterMatcher.scan; profile i uses these shifted left by 2 * i
+INCLUDE = 1
+EXCLUDE = 2
+
+# Text is scanned as alternating runs of word and non-word characters, which is exactly
+# where the regex engine places \b boundaries.
+_PIECES = re.compile(r'\w+|\W+')
+_WORD = re.compile(r'\w+')
+
+# Key under which a trie node stores the flags of the items ending there. Never a piece.
+_TERMINAL = ''
+
+
+def compile_pattern(items, word_boundary=True, plural=True):
+    escaped = [re.escape(item) for item in items]
+    if plural:
+        # Add optional 's' at the end
+        escaped = [f"{item}s?" for item in escaped]
+    pattern = "|".join(escaped)
+    if word_boundary:
+        # Use raw string for word boundaries
+        pattern = r'\b(?:' + pattern + r')\b'
+    return pattern
+
+
+# Compile tokens with spaces using positive lookaheads
+def compile_multi_word_lookahead(tokens):
+    patterns = []
+    for token in tokens:
+        words = token.split()
+        # Use formatted raw strings within lookaheads
+        lookaheads = ''.join([fr'(?=.*\b{re.escape(word)}\b)' for word in words])
+        patterns.append(lookaheads)
+    # Combine all multi-word token lookaheads into one pattern with alternation
+    combined_pattern = '|'.join(patterns)
+    return re.compile(combined_pattern, re.IGNORECASE)
+
+
+def _is_word(piece: str) -> bool:
+    return _WORD.fullmatch(piece) is not None
+
+
+class FilterMatcher:
+    """
+    Single-pass matcher for the keyword filters in ``filter_config.json``, or for several
+    filter profiles at once.
+
+    ``matches_filters`` used to run up to four regexes per post, one of which re-scans the whole
+    text once per multi-word alternative. This matcher splits the lowercased text into word and
+    non-word runs once and walks them a single time:
+
+    * tokens and phrases live in one trie keyed by runs, so each word costs a dict lookup and
+      only words that start some item descend further;
+    * multi-word tokens are checked against the set of words seen on each line.
+
+    Semantics follow ``compile_pattern`` and ``compile_multi_word_lookahead``: items must sit on
+    word boundaries, tokens and phrases may take a trailing ``s``, and the words of a multi-word
+    token must all appear on the same line (``.`` in the lookahead does not cross newlines).
+    Items that do not start and end with a word character cannot be expressed with run
+    boundaries and fall back to the equivalent regex. Case folding uses ``str.lower``, which
+    agrees with ``re.IGNORECASE`` apart from a handful of code points whose lowercase form is
+    several characters long.
+    """
+
+    def __init__(self):
+        self._trie: dict = {}
+        self._multi: List[Tuple[frozenset, int]] = []
+        self._multi_vocab: set = set()
+        self._fallback: List[Tuple['re.Pattern', int]] = []
+        self.profiles = 1
+
+    @classmethod
+    def from_filters(cls, filters: dict) -> 'FilterMatcher':
+        """Build a matcher from the contents of ``filter_config.json``."""
+        return cls.from_profiles([filters])
+
+    @classmethod
+    def from_profiles(cls, profiles: List[dict]) -> 'FilterMatcher':
+        """
+        Build one matcher for several filter configs. Profile ``i`` reports its matches as
+        ``INCLUDE << 2 * i`` and ``EXCLUDE << 2 * i``, so a single scan decides every profile.
+        """
+        matcher = cls()
+        for i, filters in enumerate(profiles):
+            include, exclude = INCLUDE << 2 * i, EXCLUDE << 2 * i
+            matcher.add_items(filters['EXCLUDE_TOKENS'], exclude)
+            matcher.add_items(filters['PHRASES'], include)
+            matcher.add_items(filters['TOKENS'], include)
+            matcher.add_multi_word(filters['INCLUSIVE_MULTI_TOKENS'], include)
+        matcher.profiles = len(profiles)
+        return matcher
+
+    def add_items(self, items: Iterable[str], flag: int) -> None:
+        """Add word-bounded items that may take a trailing ``s`` (``compile_pattern`` semantics)."""
+        fallback = []
+        for item in items:
+            pieces = _PIECES.findall(item.lower())
+            if not pieces or not _is_word(pieces[0]) or not _is_word(pieces[-1]):
+                fallback.append(item)
+                continue
+
+            *head, last = pieces
+            for variant in (last, last + 's'):
+                node = self._trie
+                for piece in head:
+                    node = node.setdefault(piece, {})
+                node = node.setdefault(variant, {})
+                node[_TERMINAL] = node.get(_TERMINAL, 0) | flag
+
+        if fallback:
+            self._fallback.append((re.compile(compile_pattern(fallback), re.IGNORECASE), flag))
+
+    def add_multi_word(self, tokens: Iterable[str], flag: int) -> None:
+        """Add tokens whose words must all appear on one line (``compile_multi_word_lookahead`` semantics)."""
+        fallback = []
+        for token in tokens:
+            words = token.lower().split()
+            if not words or not all(_is_word(word) for word in words):
+                fallback.append(token)
+                continue
+
+            self._multi.append((frozenset(words), flag))
+            self._multi_vocab.update(words)
+
+        if fallback:
+            self._fallback.append((compile_multi_word_lookahead(fallback), flag))
+
+    def scan(self, text: str) -> int:
+        """Return the OR of the flags of every item found in ``text``."""
+        flags = 0
+        if not text:
+            return flags
+
+        pieces = _PIECES.findall(text.lower())
+        trie = self._trie
+        multi_vocab = self._multi_vocab
+        size = len(pieces)
+
+        line_words: Optional[set] = set() if self._multi else None
+        start = 0 if _is_word(pieces[0]) else 1
+
+        # Word runs sit at every other index, starting at `start`
+        for i in range(start, size, 2):
+            word = pieces[i]
+
+            node = trie.get(word)
+            if node is not None:
+                j = i
+                while True:
+                    flags |= node.get(_TERMINAL, 0)
+                    j += 1
+                    if j >= size:
+                        break
+                    node = node.get(pieces[j])
+                    if node is None:
+                        break
+
+            if line_words is not None:
+                if word in multi_vocab:
+                    line_words.add(word)
+                # A separator containing a newline ends the line
+                if i + 1 < size and '\n' in pieces[i + 1]:
+                    flags |= self._match_line(line_words)
+                    line_words.clear()
+
+        if line_words:
+            flags |= self._match_line(line_words)
+
+        for regex, flag in self._fallback:
+            if not flags & flag and regex.search(text):
+                flags |= flag
+
+        return flags
+
+    def _match_line(self, line_words: set) -> int:
+        flags = 0
+        for words, flag in self._multi:
+            if words <= line_words:
+                flags |= flag
+        return flags
+
+    def matches(self, text: str) -> bool:
+        """Same decision as the original ``matches_filters``: any exclude token wins, then any include."""
+        flags = self.scan(text)
+        return not flags & EXCLUDE and bool(flags & INCLUDE)
+
+    def feeds(self, text: str) -> int:
+        """Bitmask of the profiles that accept ``text`` (bit ``i`` for profile ``i``), from one scan."""
+        flags = self.scan(text)
+        mask = 0
+        profile = 0
+        while flags:
+            # Per profile: an exclude token wins, then any include
+            if flags & 3 == INCLUDE:
+                mask |= 1 << profile
+            flags >>= 2
+            profile += 1
+        return mask
@@ -0,0 +1,207 @@
+import threading
+from bisect import bisect_left
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+
+from utils.logger import logger
+
+# Stage latencies span tens of microseconds (filtering a commit) to seconds (a slow flush)
+_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Counter:
+    """Monotonically increasing count."""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter', f'{self.name} {self._value}']
+
+
+class Gauge:
+    """Point-in-time value, either set directly or read from ``callback`` at scrape time."""
+
+    def __init__(self, name: str, help: str, callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self._value = 0.0
+        self._callback = callback
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_callback(self, callback: Optional[Callable[[], float]]) -> None:
+        self._callback = callback
+
+    @property
+    def value(self) -> float:
+        if self._callback is not None:
+            try:
+                return self._callback()
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.value}']
+
+
+class Histogram:
+    """Cumulative bucketed distribution with a running sum and count."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = _LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self._buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._buckets) + 1)  # the last slot is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+
+class Registry:
+    """Named metrics of one process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FRAMES = REGISTRY.register(Counter('firehose_frames_total', 'Frames received from the relay'))
+COMMITS = REGISTRY.register(Counter('firehose_commits_total', 'Commits with operations decoded'))
+MATCHED_POSTS = REGISTRY.register(Counter('firehose_matched_posts_total', 'Posts selected by the filters'))
+DELETED_POSTS = REGISTRY.register(Counter('firehose_deleted_posts_total', 'Post deletions sent to the database'))
+DECODE_ERRORS = REGISTRY.register(Counter('firehose_decode_errors_total', 'Frames that failed to decode or filter'))
+CLASSIFIER_REJECTED = REGISTRY.register(Counter('firehose_classifier_rejected_total', 'Keyword matches rejected by the classifier'))
+FLUSH_FAILURES = REGISTRY.register(Counter('firehose_flush_failures_total', 'Flushes that failed every retry and were left unwritten'))
+SKIPPED_ROWS = REGISTRY.register(Counter('firehose_skipped_rows_total', 'Posts and deletions the database rejected, skipped'))
+
+RELAY_LAG = REGISTRY.register(Gauge('firehose_relay_lag_seconds', 'Seconds between the latest decoded commit and now'))
+CURSOR = REGISTRY.register(Gauge('firehose_cursor_seq', 'Sequence number up to which every event is processed'))
+IN_FLIGHT = REGISTRY.register(Gauge('firehose_in_flight_events', 'Received events not yet fully processed'))
+RECEIVE_QUEUE = REGISTRY.register(Gauge('firehose_receive_queue_depth', 'Frames waiting to be decoded'))
+WRITE_QUEUE = REGISTRY.register(Gauge('firehose_write_queue_depth', 'Filtered results waiting for the writer'))
+SPOOL_BATCHES = REGISTRY.register(Gauge('firehose_spool_batches', 'Write batches spooled to disk waiting for the database'))
+SPOOL_BYTES = REGISTRY.register(Gauge('firehose_spool_bytes', 'Size of the write spool file'))
+DB_POOL_IN_USE = REGISTRY.register(Gauge('firehose_db_pool_in_use', 'Database connections checked out of the pool'))
+DB_POOL_IDLE = REGISTRY.register(Gauge('firehose_db_pool_idle', 'Open database connections waiting in the pool'))
+DB_POOL_AVG_WAIT = REGISTRY.register(Gauge('firehose_db_pool_avg_wait_seconds', 'Average time to check a connection out of the pool'))
+DB_POOL_MAX_WAIT = REGISTRY.register(Gauge('firehose_db_pool_max_wait_seconds', 'Longest time to check a connection out of the pool'))
+DB_POOL_TIMEOUTS = REGISTRY.register(Gauge('firehose_db_pool_timeouts', 'Checkouts that gave up waiting for a free connection'))
+DB_POOL_REPLACED = REGISTRY.register(Gauge('firehose_db_pool_replaced', 'Pooled connections closed for their age or for being broken'))
+
+DECODE_SECONDS = REGISTRY.register(Histogram('firehose_decode_seconds', 'Time to parse a frame and extract its operations'))
+FILTER_SECONDS = REGISTRY.register(Histogram('firehose_filter_seconds', 'Time to filter the operations of a commit'))
+WRITE_SECONDS = REGISTRY.register(Histogram('firehose_db_write_seconds', 'Time to write one flush to the database'))
+FLUSH_ROWS = REGISTRY.register(Histogram('firehose_flush_rows', 'Rows written per flush', _SIZE_BUCKETS))
+
+
+def observe_commit_time(commit_time: str) -> None:
+    """Update the relay lag from a commit's ISO 8601 ``time``."""
+    try:
+        committed = datetime.fromisoformat(commit_time)
+    except (TypeError, ValueError):
+        return
+    if committed.tzinfo is None:
+        committed = committed.replace(tzinfo=timezone.utc)
+    RELAY_LAG.set((datetime.now(timezone.utc) - committed).total_seconds())
+
+
+def watch_watermark(watermark) -> None:
+    """Export the cursor and in-flight count of a SeqWatermark."""
+    CURSOR.set_callback(lambda: watermark.seq or 0)
+    IN_FLIGHT.set_callback(lambda: watermark.in_flight)
+
+
+def watch_pool(database) -> None:
+    """Export the checkout statistics of a feeddb PooledDatabase."""
+    DB_POOL_IN_USE.set_callback(lambda: database.pool_stats()['in_use'])
+    DB_POOL_IDLE.set_callback(lambda: database.pool_stats()['idle'])
+    DB_POOL_AVG_WAIT.set_callback(lambda: database.stats.as_dict()['avg_wait'])
+    DB_POOL_MAX_WAIT.set_callback(lambda: database.stats.max_wait)
+    DB_POOL_TIMEOUTS.set_callback(lambda: database.stats.timeouts)
+    DB_POOL_REPLACED.set_callback(lambda: database.stats.recycled + database.stats.broken)
+
+
+def watch_spool(spool) -> None:
+    """Export the backlog of a write Spool."""
+    SPOOL_BATCHES.set_callback(lambda: spool.pending)
+    SPOOL_BYTES.set_callback(lambda: spool.size)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the ingestion logs
+        pass
+
+
+def start_server(port: int) -> None:
+    """Serve ``/metrics`` on ``port`` from a daemon thread. A port of 0 disables the endpoint."""
+    if not port:
+        return
+
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f'Failed to start metrics endpoint on port {port}: {e}')
+        return
+
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Metrics endpoint listening on :{port}/metrics')
@@ -0,0 +1,141 @@
+import queue
+import threading
+from time import perf_counter
+from typing import Callable, List
+
+import metrics
+from utils.logger import logger
+from watermark import SeqWatermark
+from writer import BulkWriter
+
+# Sentinel pushed through the receive queue to shut down workers
+_STOP = object()
+
+
+class Pipeline:
+    """
+    Staged firehose pipeline: receive -> bounded queue -> decode/filter workers -> single bulk writer.
+
+    The websocket callback only enqueues raw message frames, so network receive never waits
+    on CAR decoding, regex filtering or Postgres. When the queues are full ``submit`` blocks,
+    which applies backpressure to the socket instead of growing memory without bound.
+
+    Every frame is registered with the watermark on receipt. Frames with nothing to write are
+    finished by the decode worker; the rest are finished by the writer once their flush commits.
+
+    Args:
+        decode: Turns a raw message frame into ``(seq, operations by type)``; operations may be None.
+        filter_callback: Turns operations into ``(posts_to_create, post_uris_to_delete)``.
+        writer: Bulk writer that buffers and flushes the filtered results.
+        watermark: Tracks which frames have been fully processed.
+        decode_workers: Number of decode/filter worker threads.
+        receive_queue_size: Maximum number of raw frames waiting to be decoded.
+    """
+
+    def __init__(
+        self,
+        decode: Callable,
+        filter_callback: Callable,
+        writer: BulkWriter,
+        watermark: SeqWatermark,
+        decode_workers: int = 4,
+        receive_queue_size: int = 10000,
+    ):
+        self._decode = decode
+        self._filter_callback = filter_callback
+        self._writer = writer
+        self._watermark = watermark
+        self._decode_workers = max(1, decode_workers)
+
+        self._receive_queue = queue.Queue(maxsize=receive_queue_size)
+        self._workers: List[threading.Thread] = []
+        self._workers_lock = threading.Lock()
+        self._next_worker = 0
+
+    @property
+    def receive_queue_depth(self) -> int:
+        return self._receive_queue.qsize()
+
+    @property
+    def write_queue_depth(self) -> int:
+        return self._writer.queue_depth
+
+    def start(self) -> None:
+        """Start the decode workers and the writer thread."""
+        self._writer.start()
+
+        with self._workers_lock:
+            self._add_workers(self._decode_workers)
+
+        logger.info(f'Pipeline started with {self._decode_workers} decode workers.')
+
+    def set_decode_workers(self, decode_workers: int) -> None:
+        """
+        Grow or shrink the decode worker pool while the pipeline runs. Surplus workers exit
+        after finishing the frame they are decoding, so nothing already received is dropped.
+        """
+        decode_workers = max(1, decode_workers)
+        with self._workers_lock:
+            change = decode_workers - self._decode_workers
+            if change > 0:
+                self._add_workers(change)
+            else:
+                for _ in range(-change):
+                    self._receive_queue.put(_STOP)
+            self._decode_workers = decode_workers
+
+        if change:
+            logger.info(f'Pipeline now running {decode_workers} decode workers.')
+
+    def _add_workers(self, count: int) -> None:
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        for _ in range(count):
+            worker = threading.Thread(target=self._decode_loop, name=f'firehose-decode-{self._next_worker}', daemon=True)
+            self._next_worker += 1
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, message) -> None:
+        """Hand a raw message frame to the decode workers. Called from the receive thread."""
+        self._receive_queue.put((self._watermark.begin(), message))
+
+    def stop(self) -> None:
+        """Drain everything already received, then stop all threads."""
+        with self._workers_lock:
+            # Workers retired by set_decode_workers already have their stop sentinel queued
+            for _ in range(self._decode_workers):
+                self._receive_queue.put(_STOP)
+            for worker in self._workers:
+                worker.join()
+            self._workers.clear()
+
+        self._writer.stop()
+
+        logger.info('Pipeline stopped.')
+
+    def _decode_loop(self) -> None:
+        while True:
+            item = self._receive_queue.get()
+            if item is _STOP:
+                return
+
+            ordinal, message = item
+            seq = None
+            posts_to_create, post_uris_to_delete = [], []
+            try:
+                started = perf_counter()
+                seq, operations = self._decode(message)
+                decoded = perf_counter()
+                metrics.DECODE_SECONDS.observe(decoded - started)
+                if operations is not None:
+                    posts_to_create, post_uris_to_delete = self._filter_callback(operations)
+                    metrics.FILTER_SECONDS.observe(perf_counter() - decoded)
+                    metrics.MATCHED_POSTS.inc(len(posts_to_create))
+            except Exception as e:
+                metrics.DECODE_ERRORS.inc()
+                logger.error(f'Failed to decode message: {e}')
+
+            if posts_to_create or post_uris_to_delete:
+                self._writer.submit(posts_to_create, post_uris_to_delete, [(ordinal, seq)])
+            else:
+                self._watermark.finish(ordinal, seq)
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Optional
+
+
+class CreatedPost:
+    """
+    A post created in a commit, read straight from its DAG-CBOR block.
+
+    Only the fields filtering needs are kept; the URI and CID strings are built on demand,
+    so posts that don't match never pay for them.
+    """
+
+    __slots__ = ('repo', 'path', 'cid', 'text', 'reply_root', 'reply_parent')
+
+    def __init__(self, repo: str, path: str, cid, text: str, reply_root: Optional[str], reply_parent: Optional[str]):
+        self.repo = repo
+        self.path = path
+        self.cid = cid
+        self.text = text
+        self.reply_root = reply_root
+        self.reply_parent = reply_parent
+
+    @property
+    def uri(self) -> str:
+        return f'at://{self.repo}/{self.path}'
+
+
+class CommitOps:
+    """The operations of one commit that ingestion looks at."""
+
+    __slots__ = ('repo', 'time', 'posts', 'deleted_posts', 'like_subjects', 'repost_subjects')
+
+    def __init__(self, repo: str, time: Optional[str] = None):
+        self.repo = repo
+        self.time = time                        # relay timestamp of the commit (ISO 8601)
+        self.posts: List[CreatedPost] = []
+        self.deleted_posts: List[str] = []      # URIs
+        self.like_subjects: List[str] = []      # URIs of liked posts
+        self.repost_subjects: List[str] = []    # URIs of reposted posts
+
+    def indexed_at(self) -> datetime:
+        """
+        When the posts of this commit are indexed: the relay's commit time, which a replay
+        repeats exactly, so a replayed post hits the unique (uri, indexed_at) key.
+        """
+        try:
+            indexed_at = datetime.fromisoformat(self.time)
+        except (TypeError, ValueError):
+            return datetime.now(timezone.utc)
+        if indexed_at.tzinfo is None:
+            indexed_at = indexed_at.replace(tzinfo=timezone.utc)
+        return indexed_at
+
+
+class PostRow(NamedTuple):
+    """A post to insert, in the column order of ``POST_ROW_FIELDS``."""
+
+    uri: str
+    cid: str
+    reply_parent: Optional[str]
+    reply_root: Optional[str]
+    indexed_at: datetime
+    author: str
+    interactions: int
+    text: Optional[str]
+    # Bitmask of the filter profiles (feeds) the post belongs to
+    feeds: int = 1
+
+
+class CandidatePost(PostRow):
+    """A keyword match still waiting for the relevance classifier."""
+
+    __slots__ = ()
+
+
+# Post columns filled from a PostRow; the engagement counters take their defaults
+POST_ROW_FIELDS = PostRow._fields
@@ -0,0 +1,365 @@
+import multiprocessing
+import queue
+import threading
+import zlib
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from atproto import (
+    firehose_models,
+    FirehoseSubscribeReposClient,
+    models,
+    parse_subscribe_repos_message,
+)
+from atproto.exceptions import FirehoseError
+
+import metrics
+from catchup import CatchUpMonitor
+from checkpoint import Checkpointer
+from data_stream import _get_ops_by_type, _has_interesting_ops, init_database, open_spool
+from database import db, SubscriptionState
+from records import CandidatePost
+from utils import config
+from utils.logger import logger
+from watermark import SeqWatermark
+from writer import BulkWriter
+
+# Maximum number of commits without writes acknowledged in one message
+_ACK_BATCH_SIZE = 500
+
+
+class _RepoOp(NamedTuple):
+    action: str
+    path: str
+    cid: Any  # CID, None for deletes
+
+
+class _ShardCommit(NamedTuple):
+    """The commit fields ``_get_ops_by_type`` reads, rebuilt in the worker from the queue's tuple."""
+
+    repo: str
+    seq: int
+    time: str
+    blocks: bytes
+    ops: Tuple[_RepoOp, ...]
+
+
+def _pack_commit(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> tuple:
+    # Plain tuples pickle about twice as fast as the pydantic model and unpickle several times
+    # faster, which matters on the single coordinator process
+    return commit.repo, commit.seq, commit.time, commit.blocks, tuple((op.action, op.path, op.cid) for op in commit.ops)
+
+
+def _unpack_commit(packed: tuple) -> _ShardCommit:
+    repo, seq, time, blocks, ops = packed
+    return _ShardCommit(repo, seq, time, blocks, tuple(_RepoOp._make(op) for op in ops))
+
+
+def shard_for(did: str, shards: int) -> int:
+    """Stable shard index for a repo DID, so a repo's events always land on the same worker."""
+    return zlib.crc32(did.encode()) % shards
+
+
+def _follow_peer_posts(peer_posts, index_callback: Callable[[Dict[str, int]], None]) -> None:
+    while True:
+        posts = peer_posts.get()
+        if posts is None:
+            return
+        index_callback(posts)
+
+
+def _shard_worker(index: int, commits, acks, filter_callback: Callable, write_callback: Callable,
+                  peer_queues: list, index_callback: Optional[Callable[[Dict[str, int]], None]],
+                  prepare_callback: Optional[Callable]) -> None:
+    """
+    Worker process: decodes and filters the commits of one shard and writes them through a
+    bulk writer. Commits are acknowledged to the coordinator once their flush has committed,
+    or straight away when they have nothing to write.
+
+    Likes, reposts and replies are sharded by their own author, not the author of the post
+    they point at, so every shard passes the posts it keeps to its peers through
+    ``peer_queues``, and records theirs with ``index_callback``. Keyword matches are passed
+    on from ``prepare_callback`` once the classifier has accepted them.
+    """
+    logger.info(f'Shard {index} started.')
+    follower = None
+    if index_callback is not None:
+        follower = threading.Thread(
+            target=_follow_peer_posts, args=(peer_queues[index], index_callback), name='peer-posts', daemon=True,
+        )
+        follower.start()
+    peers = [peer for i, peer in enumerate(peer_queues) if i != index]
+    for peer in peers:
+        # Unread updates are worthless once the shards stop, so exiting never waits to flush them
+        peer.cancel_join_thread()
+    # Each shard serves its own decode, filter and write metrics next to the coordinator's port
+    if config.FIREHOSE_METRICS_PORT:
+        metrics.start_server(config.FIREHOSE_METRICS_PORT + 1 + index)
+
+    prepare = prepare_callback
+    if prepare_callback is not None and index_callback is not None:
+        def prepare(posts):
+            # Keyword matches reach the peers once the classifier accepts them, like the own index
+            candidates = {post.uri for post in posts if isinstance(post, CandidatePost)}
+            prepared = prepare_callback(posts)
+            accepted = {post.uri: post.feeds for post in prepared if post.uri in candidates}
+            if accepted:
+                for peer in peers:
+                    peer.put(accepted)
+            return prepared
+
+    writer = BulkWriter(
+        write_callback,
+        batch_size=config.FIREHOSE_WRITE_BATCH_SIZE,
+        max_latency=config.FIREHOSE_WRITE_MAX_LATENCY,
+        queue_size=config.FIREHOSE_WRITE_QUEUE_SIZE,
+        on_flushed=acks.put,
+        spool=open_spool(f'.{index}'),
+        prepare=prepare,
+    )
+    writer.start()
+
+    # Each shard follows the lag of its own commits; the coordinator reports the estimate
+    catchup = CatchUpMonitor(
+        enter_lag=config.FIREHOSE_CATCHUP_ENTER_LAG,
+        exit_lag=config.FIREHOSE_CATCHUP_EXIT_LAG,
+        on_change=lambda catching_up: writer.configure(
+            config.FIREHOSE_CATCHUP_BATCH_SIZE if catching_up else config.FIREHOSE_WRITE_BATCH_SIZE,
+            config.FIREHOSE_CATCHUP_MAX_LATENCY if catching_up else config.FIREHOSE_WRITE_MAX_LATENCY,
+        ),
+        report=False,
+    )
+    catchup.start()
+
+    nothing_to_write = []
+    while True:
+        try:
+            item = commits.get(timeout=1)
+        except queue.Empty:
+            item = False
+
+        # Batch acknowledgements of empty commits to keep IPC traffic down
+        if nothing_to_write and (item is False or item is None or len(nothing_to_write) >= _ACK_BATCH_SIZE):
+            acks.put(nothing_to_write)
+            nothing_to_write = []
+
+        if item is None:
+            break
+        if item is False:
+            continue
+
+        ordinal, seq, packed = item
+        posts_to_create, post_uris_to_delete = [], []
+        try:
+            started = perf_counter()
+            commit = _unpack_commit(packed)
+            metrics.observe_commit_time(commit.time)
+            operations = _get_ops_by_type(commit)
+            decoded = perf_counter()
+            posts_to_create, post_uris_to_delete = filter_callback(operations)
+            metrics.DECODE_SECONDS.observe(decoded - started)
+            metrics.FILTER_SECONDS.observe(perf_counter() - decoded)
+            metrics.COMMITS.inc()
+            metrics.MATCHED_POSTS.inc(len(posts_to_create))
+        except Exception as e:
+            metrics.DECODE_ERRORS.inc()
+            logger.error(f'Shard {index} failed to decode commit {seq}: {e}')
+
+        if posts_to_create and index_callback is not None:
+            kept = {post.uri: post.feeds for post in posts_to_create if not isinstance(post, CandidatePost)}
+            if kept:
+                for peer in peers:
+                    peer.put(kept)
+
+        if posts_to_create or post_uris_to_delete:
+            writer.submit(posts_to_create, post_uris_to_delete, [(ordinal, seq)])
+        else:
+            nothing_to_write.append((ordinal, seq))
+
+    if follower is not None:
+        peer_queues[index].put(None)
+        follower.join()
+    catchup.stop()
+    writer.stop()
+    if not db.is_closed():
+        db.close()
+    logger.info(f'Shard {index} stopped.')
+
+
+class ShardCoordinator:
+    """
+    Receives firehose frames, fans commits out to worker processes sharded by repo DID, and
+    persists a cursor that only advances past events every shard has finished writing.
+
+    Args:
+        name: The name of the service/subscription.
+        filter_callback: Selects the posts to create and delete from the extracted operations.
+        write_callback: Persists the posts selected by filter_callback.
+        shards: Number of worker processes.
+        queue_size: Maximum number of commits queued per shard.
+        index_callback: Records posts kept by another shard, as URIs mapped to their feed bitmasks.
+        prepare_callback: Applied once to the posts of every flush before they are written.
+    """
+
+    def __init__(self, name: str, filter_callback: Callable, write_callback: Callable, shards: int, queue_size: int,
+                 index_callback: Optional[Callable[[Dict[str, int]], None]] = None,
+                 prepare_callback: Optional[Callable] = None):
+        self._name = name
+        self._shards = max(1, shards)
+
+        state = SubscriptionState.get_or_none(SubscriptionState.service == name)
+        self._watermark = SeqWatermark(state.cursor if state else None)
+        self._checkpointer = Checkpointer(
+            name,
+            self._watermark,
+            interval=config.FIREHOSE_CHECKPOINT_INTERVAL,
+            events=config.FIREHOSE_CHECKPOINT_EVENTS,
+            on_checkpoint=self._update_client_cursor,
+        )
+
+        # Spawn rather than fork so workers don't inherit the coordinator's connections and threads
+        context = multiprocessing.get_context('spawn')
+        self._queues = [context.Queue(maxsize=queue_size) for _ in range(self._shards)]
+        self._acks = context.Queue()
+        # Unbounded: a shard blocked on a full peer while that peer waits on it would deadlock both
+        self._peer_queues = [context.Queue() for _ in range(self._shards)]
+        self._workers: List[multiprocessing.Process] = [
+            context.Process(
+                target=_shard_worker,
+                args=(
+                    i, self._queues[i], self._acks, filter_callback, write_callback,
+                    self._peer_queues, index_callback, prepare_callback,
+                ),
+                name=f'firehose-shard-{i}',
+                daemon=True,
+            )
+            for i in range(self._shards)
+        ]
+
+        self._catchup = CatchUpMonitor(
+            enter_lag=config.FIREHOSE_CATCHUP_ENTER_LAG,
+            exit_lag=config.FIREHOSE_CATCHUP_EXIT_LAG,
+        )
+
+        self._client: Optional[FirehoseSubscribeReposClient] = None
+        self._stopping = threading.Event()
+        self._ack_thread = threading.Thread(target=self._ack_loop, name='firehose-acks', daemon=True)
+
+    def start(self) -> None:
+        metrics.watch_watermark(self._watermark)
+        metrics.RECEIVE_QUEUE.set_callback(lambda: sum(commits.qsize() for commits in self._queues))
+
+        for worker in self._workers:
+            worker.start()
+        self._ack_thread.start()
+        self._checkpointer.start()
+        self._catchup.start()
+        logger.info(f'Started {self._shards} firehose shards.')
+
+    def stop(self) -> None:
+        """Let every shard drain its queue, then persist the final cursor."""
+        for commits in self._queues:
+            commits.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        self._stopping.set()
+        self._ack_thread.join()
+        self._checkpointer.stop()
+        self._catchup.stop()
+        logger.info('Firehose shards stopped.')
+
+    def stream(self, stream_stop_event=None) -> None:
+        """Connect to the firehose and dispatch commits until the connection ends."""
+        state = SubscriptionState.get_or_none(SubscriptionState.service == self._name)
+
+        params = None
+        if state:
+            params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=state.cursor)
+        else:
+            SubscriptionState.create(service=self._name, cursor=0)
+
+        client = FirehoseSubscribeReposClient(params)
+        self._client = client
+
+        def on_message_handler(message: firehose_models.MessageFrame) -> None:
+            if stream_stop_event and stream_stop_event.is_set():
+                logger.info("Stopping firehose...")
+                client.stop()
+                return
+
+            try:
+                commit = parse_subscribe_repos_message(message)
+            except Exception as e:
+                logger.error(f"Failed to parse message: {e}")
+                return
+
+            metrics.FRAMES.inc()
+            ordinal = self._watermark.begin()
+            seq = getattr(commit, 'seq', None)
+
+            # Events no shard needs to see are finished immediately so they don't hold the cursor back
+            if (
+                not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit)
+                or not commit.blocks
+                or not _has_interesting_ops(commit)
+            ):
+                self._watermark.finish(ordinal, seq)
+                return
+
+            metrics.observe_commit_time(commit.time)
+            self._queues[shard_for(commit.repo, self._shards)].put((ordinal, seq, _pack_commit(commit)))
+
+        client.start(on_message_handler)
+
+    def _ack_loop(self) -> None:
+        while not self._stopping.is_set() or not self._acks.empty():
+            try:
+                acked = self._acks.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._watermark.finish_all(acked)
+
+    def _update_client_cursor(self, seq: int) -> None:
+        # Reconnects resume from the last checkpoint rather than the original cursor
+        if self._client:
+            self._client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=seq))
+
+
+def run(name, filter_callback, write_callback, shards, stream_stop_event=None, index_callback=None,
+        prepare_callback=None):
+    """
+    Starts the sharded firehose: one coordinator process receiving frames and ``shards``
+    worker processes decoding, filtering and writing them.
+
+    Args:
+        name: The name of the service/subscription.
+        filter_callback: Selects the posts to create and delete from the extracted operations.
+        write_callback: Persists the posts selected by filter_callback.
+        shards: Number of worker processes.
+        stream_stop_event: An optional threading.Event to signal when to stop the stream.
+        index_callback: Records posts kept by another shard, so engagement on them and replies in
+            their threads are seen by every shard.
+        prepare_callback: Applied once to the posts of every flush before they are written.
+    """
+    init_database()
+    metrics.start_server(config.FIREHOSE_METRICS_PORT)
+
+    coordinator = ShardCoordinator(
+        name, filter_callback, write_callback, shards, config.FIREHOSE_SHARD_QUEUE_SIZE, index_callback,
+        prepare_callback,
+    )
+    coordinator.start()
+
+    try:
+        while stream_stop_event is None or not stream_stop_event.is_set():
+            try:
+                coordinator.stream(stream_stop_event)
+            except FirehoseError as e:
+                logger.error(f"Firehose error: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}")
+                break
+    finally:
+        coordinator.stop()
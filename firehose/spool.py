@@ -0,0 +1,145 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+from typing import Any, Optional
+
+from utils.logger import logger
+
+# File header: magic, then the offset of the oldest record that has not been drained yet
+_MAGIC = b'FHSPOOL1'
+_HEADER = struct.Struct('>8sQ')
+# Record header: payload length and CRC32 of the payload
+_RECORD = struct.Struct('>II')
+
+
+class Spool:
+    """
+    Append-only on-disk queue of write batches, used while the database is falling behind.
+
+    Records are appended with a length and CRC32 and fsynced before ``append`` returns, so a
+    spooled batch survives a crash just like a committed one. The offset of the oldest undrained
+    record lives in the file header and is only advanced once that record has been written to
+    the database. On open, records past the offset are checked and a torn tail left by a crash
+    mid-append is truncated. The file is reset to its header whenever it has been fully drained.
+
+    Disk use is bounded by ``max_bytes``: when the spool is full, ``append`` blocks until the
+    drainer has emptied it, which turns back into ordinary backpressure on the firehose.
+
+    Args:
+        path: Spool file, created if missing.
+        max_bytes: Maximum file size before appends block.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 ** 3):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        self._head = _HEADER.size   # offset of the oldest undrained record
+        self._tail = _HEADER.size   # offset the next record is appended at
+        self._pending = 0
+        self._head_length: Optional[int] = None
+        self._recover()
+
+    @property
+    def pending(self) -> int:
+        """Number of spooled batches waiting to be drained."""
+        return self._pending
+
+    @property
+    def size(self) -> int:
+        """Bytes used by the spool file."""
+        return self._tail
+
+    def _recover(self) -> None:
+        size = os.fstat(self._fd).st_size
+        if size < _HEADER.size:
+            self._reset()
+            return
+
+        magic, head = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))
+        if magic != _MAGIC:
+            raise RuntimeError(f'{self.path} is not a firehose spool file')
+
+        position = head
+        while position + _RECORD.size <= size:
+            length, crc = _RECORD.unpack(os.pread(self._fd, _RECORD.size, position))
+            end = position + _RECORD.size + length
+            if end > size or zlib.crc32(os.pread(self._fd, length, position + _RECORD.size)) != crc:
+                break
+            self._pending += 1
+            position = end
+
+        if position < size:
+            # A crash mid-append leaves a partial record; everything before it is intact
+            logger.warning(f'Spool|truncating {size - position} bytes of torn records in {self.path}')
+            os.ftruncate(self._fd, position)
+            os.fsync(self._fd)
+
+        self._head, self._tail = head, position
+        if self._pending:
+            logger.info(f'Spool|recovered {self._pending} batches ({position - head} bytes) from {self.path}')
+        else:
+            self._reset()
+
+    def _reset(self) -> None:
+        os.ftruncate(self._fd, _HEADER.size)
+        os.pwrite(self._fd, _HEADER.pack(_MAGIC, _HEADER.size), 0)
+        os.fsync(self._fd)
+        self._head = self._tail = _HEADER.size
+        self._head_length = None
+
+    def append(self, item: Any) -> None:
+        """Durably append a batch. Blocks while the spool is full."""
+        payload = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        record = _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._space:
+            if self._pending and self._tail + len(record) > self._max_bytes:
+                logger.warning(f'Spool|{self.path} is full ({self._tail} bytes), waiting for it to drain')
+                while self._pending and self._tail + len(record) > self._max_bytes:
+                    self._space.wait()
+
+            os.pwrite(self._fd, record, self._tail)
+            os.fdatasync(self._fd)
+            self._tail += len(record)
+            self._pending += 1
+
+    def peek(self) -> Any:
+        """Return the oldest spooled batch without removing it."""
+        with self._lock:
+            if not self._pending:
+                raise IndexError('spool is empty')
+            head = self._head
+
+        length, _ = _RECORD.unpack(os.pread(self._fd, _RECORD.size, head))
+        self._head_length = length
+        return pickle.loads(os.pread(self._fd, length, head + _RECORD.size))
+
+    def pop(self) -> None:
+        """Drop the oldest spooled batch once it has been written to the database."""
+        with self._space:
+            if not self._pending:
+                return
+            if self._head_length is None:
+                self._head_length, _ = _RECORD.unpack(os.pread(self._fd, _RECORD.size, self._head))
+
+            self._pending -= 1
+            if self._pending:
+                self._head += _RECORD.size + self._head_length
+                self._head_length = None
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, self._head), 0)
+                os.fdatasync(self._fd)
+            else:
+                self._reset()
+                self._space.notify_all()
+
+    def close(self) -> None:
+        os.close(self._fd)
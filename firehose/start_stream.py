@@ -4,7 +4,8 @@ import signal
 from utils import config
 from utils.logger import logger
 import data_stream as data_stream
-from data_filter import operations_callback
+import sharding
+from data_filter import classify_posts, filter_operations, index_posts, write_operations
 
 class StopEvent:
     def __init__(self):
@@ -26,7 +27,17 @@ def main():
 
     signal.signal(signal.SIGINT, handle_termination)
     
-    data_stream.run(config.SERVICE_DID, operations_callback, stop_event)
+    if config.FIREHOSE_MODE == 'sharded':
+        sharding.run(
+            config.SERVICE_DID, filter_operations, write_operations, config.FIREHOSE_SHARDS, stop_event,
+            index_posts, classify_posts,
+        )
+    elif config.FIREHOSE_MODE == 'async':
+        # Imported lazily so asyncpg is only required when the async mode is selected
+        import async_stream
+        async_stream.run(config.SERVICE_DID, filter_operations, stop_event, classify_posts)
+    else:
+        data_stream.run(config.SERVICE_DID, filter_operations, write_operations, stop_event, classify_posts)
     logger.info("firehose has exited")
 
 
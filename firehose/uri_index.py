@@ -0,0 +1,131 @@
+import threading
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Set
+
+from peewee import PeeweeException
+
+from database import db, Post
+from utils.logger import logger
+
+
+class UriIndex:
+    """
+    In-memory map of the post URIs stored in the database to their feed bitmasks, used to drop
+    firehose deletes that cannot match any row before they reach Postgres and to place replies
+    in the feeds of stored threads.
+
+    The post table only holds a few days of topical posts, so an exact map stays small and
+    never sends a false positive to the database. It is loaded from the table in the
+    background on first use and rebuilt every ``rebuild_interval`` seconds, which forgets
+    rows removed by the cleanup job and picks up rows written by anything other than this
+    process. Until the first load completes every delete is let through.
+
+    Args:
+        rebuild_interval: Seconds between rebuilds from the database; 0 disables loading from
+            the database, leaving the index to ``load``.
+    """
+
+    def __init__(self, rebuild_interval: float = 3600):
+        self._rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._uris: Dict[str, int] = {}
+        self._added_during_rebuild: Optional[Dict[str, int]] = None
+        self._removed_during_rebuild: Optional[Set[str]] = None
+        self._loaded = False
+        self._thread: Optional[threading.Thread] = None
+
+        self.checked = 0
+        self.skipped = 0
+
+    def __len__(self) -> int:
+        return len(self._uris)
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._uris
+
+    def _ensure_started(self) -> None:
+        if self._thread is None and self._rebuild_interval:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._rebuild_loop, name='uri-index', daemon=True)
+                    self._thread.start()
+
+    def feeds_of(self, uri: str) -> int:
+        """Feed bitmask of a stored post, 0 when it isn't stored."""
+        return self._uris.get(uri, 0)
+
+    def add(self, posts: Dict[str, int]) -> None:
+        """Record posts that are about to be stored, as URIs mapped to their feed bitmasks."""
+        self._ensure_started()
+        with self._lock:
+            self._uris.update(posts)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.update(posts)
+
+    def filter(self, uris: List[str]) -> List[str]:
+        """Return the URIs that may be stored, and forget them since they are about to be deleted."""
+        self._ensure_started()
+        if not uris:
+            return uris
+
+        with self._lock:
+            if not self._loaded:
+                return uris
+
+            stored = [uri for uri in uris if uri in self._uris]
+            for uri in stored:
+                del self._uris[uri]
+            if self._added_during_rebuild is not None:
+                for uri in stored:
+                    self._added_during_rebuild.pop(uri, None)
+                self._removed_during_rebuild.update(stored)
+
+            self.checked += len(uris)
+            self.skipped += len(uris) - len(stored)
+        return stored
+
+    def load(self, posts: Dict[str, int]) -> None:
+        """Replace the index with ``posts``, URIs mapped to their feed bitmasks."""
+        with self._lock:
+            self._uris = dict(posts)
+            self._loaded = True
+
+    def rebuild(self) -> None:
+        """Replace the index with the URIs currently in the database."""
+        started = monotonic()
+        with self._lock:
+            self._added_during_rebuild = {}
+            self._removed_during_rebuild = set()
+
+        try:
+            uris = dict(Post.select(Post.uri, Post.feeds).tuples().iterator())
+        except Exception as e:
+            logger.error(f'Failed to rebuild the URI index: {e}')
+            with self._lock:
+                self._added_during_rebuild = self._removed_during_rebuild = None
+            return
+
+        with self._lock:
+            # Posts accepted or deleted while the table was being read may not be committed yet
+            uris.update(self._added_during_rebuild)
+            for uri in self._removed_during_rebuild:
+                uris.pop(uri, None)
+            self._added_during_rebuild = self._removed_during_rebuild = None
+            self._uris = uris
+            self._loaded = True
+            checked, skipped = self.checked, self.skipped
+
+        share = skipped / checked if checked else 0
+        logger.info(
+            f'UriIndex|{len(uris)} URIs|{monotonic() - started:.2f}s rebuild|'
+            f'{skipped}/{checked} deletes skipped ({share:.1%})'
+        )
+
+    def _rebuild_loop(self) -> None:
+        while True:
+            try:
+                with db.connection_context():
+                    self.rebuild()
+            except PeeweeException as e:
+                logger.error(f'Failed to get a database connection for the URI index: {e}')
+            sleep(self._rebuild_interval if self._loaded else 60)
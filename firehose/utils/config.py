@@ -27,6 +27,104 @@ if HOSTNAME is None:
 if SERVICE_DID is None:
     SERVICE_DID = f'did:web:{HOSTNAME}'
 
+# Database connection pool (feeddb/pool.py); every service reads these from its own environment
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX_CONNECTIONS', 10))
+DB_POOL_MAX_AGE = float(os.environ.get('DB_POOL_MAX_AGE', 30 * 60))
+DB_POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', 10))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))
+
+# Read replicas serving the web service's feed queries, as comma-separated host or host:port (empty
+# reads from the primary); a replica lagging more than MAX_LAG seconds behind is skipped
+POSTGRES_REPLICA_HOSTS = [host.strip() for host in os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',') if host.strip()]
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 30))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+
+# Firehose ingestion pipeline tuning
+FIREHOSE_RECEIVE_QUEUE_SIZE = int(os.environ.get('FIREHOSE_RECEIVE_QUEUE_SIZE', 10000))
+FIREHOSE_WRITE_QUEUE_SIZE = int(os.environ.get('FIREHOSE_WRITE_QUEUE_SIZE', 1000))
+FIREHOSE_DECODE_WORKERS = int(os.environ.get('FIREHOSE_DECODE_WORKERS', 4))
+FIREHOSE_WRITE_BATCH_SIZE = int(os.environ.get('FIREHOSE_WRITE_BATCH_SIZE', 500))
+FIREHOSE_WRITE_MAX_LATENCY = float(os.environ.get('FIREHOSE_WRITE_MAX_LATENCY', 2.0))
+
+# Cursor checkpoints: whichever of the interval or the event count is reached first
+FIREHOSE_CHECKPOINT_INTERVAL = float(os.environ.get('FIREHOSE_CHECKPOINT_INTERVAL', 10.0))
+FIREHOSE_CHECKPOINT_EVENTS = int(os.environ.get('FIREHOSE_CHECKPOINT_EVENTS', 5000))
+
+# Ingestion mode: 'pipeline' (threads in one process), 'sharded' (one process per shard)
+# or 'async' (asyncio event loop with asyncpg writes)
+FIREHOSE_MODE = os.environ.get('FIREHOSE_MODE', 'pipeline')
+FIREHOSE_SHARDS = int(os.environ.get('FIREHOSE_SHARDS', os.cpu_count() or 1))
+FIREHOSE_SHARD_QUEUE_SIZE = int(os.environ.get('FIREHOSE_SHARD_QUEUE_SIZE', 10000))
+
+# Seconds between rebuilds of the in-memory index of stored post URIs used to skip irrelevant deletes
+FIREHOSE_URI_INDEX_REBUILD_INTERVAL = float(os.environ.get('FIREHOSE_URI_INDEX_REBUILD_INTERVAL', 60 * 60))
+
+# Also ingest replies whose root or parent post is stored, even when their own text doesn't match
+FIREHOSE_INGEST_THREADS = os.environ.get('FIREHOSE_INGEST_THREADS', 'false').lower() in ('1', 'true', 'yes')
+
+# Optional relevance classifier for keyword matches (see scripts/train_classifier.py); posts scoring
+# below the threshold are dropped
+FIREHOSE_CLASSIFIER_PATH = os.environ.get('FIREHOSE_CLASSIFIER_PATH', None)
+FIREHOSE_CLASSIFIER_THRESHOLD = float(os.environ.get('FIREHOSE_CLASSIFIER_THRESHOLD', 0.5))
+
+# Port of the Prometheus /metrics endpoint (0 disables it); sharded workers use the following ports
+FIREHOSE_METRICS_PORT = int(os.environ.get('FIREHOSE_METRICS_PORT', 9000))
+
+# Seconds between flushes of like/repost/reply counts on stored posts
+FIREHOSE_ENGAGEMENT_FLUSH_INTERVAL = float(os.environ.get('FIREHOSE_ENGAGEMENT_FLUSH_INTERVAL', 10.0))
+
+# Disk spool absorbing writes while Postgres is slow or failing over, disabled unless set. Spooled
+# batches count as committed for the cursor, so the path must be on storage that survives restarts.
+# Appends block once it reaches MAX_BYTES. Sharded workers append the shard index to the path
+FIREHOSE_SPOOL_PATH = os.environ.get('FIREHOSE_SPOOL_PATH', '')
+FIREHOSE_SPOOL_MAX_BYTES = int(os.environ.get('FIREHOSE_SPOOL_MAX_BYTES', 1024 ** 3))
+
+# Catch-up profile after an outage: entered when the relay lag exceeds ENTER_LAG seconds (0 disables)
+# and left below EXIT_LAG; while on, writes are batched harder and per-post logging is skipped
+FIREHOSE_CATCHUP_ENTER_LAG = float(os.environ.get('FIREHOSE_CATCHUP_ENTER_LAG', 5 * 60))
+FIREHOSE_CATCHUP_EXIT_LAG = float(os.environ.get('FIREHOSE_CATCHUP_EXIT_LAG', 30))
+FIREHOSE_CATCHUP_BATCH_SIZE = int(os.environ.get('FIREHOSE_CATCHUP_BATCH_SIZE', 5000))
+FIREHOSE_CATCHUP_MAX_LATENCY = float(os.environ.get('FIREHOSE_CATCHUP_MAX_LATENCY', 10.0))
+FIREHOSE_CATCHUP_DECODE_WORKERS = int(
+    os.environ.get('FIREHOSE_CATCHUP_DECODE_WORKERS', max(FIREHOSE_DECODE_WORKERS, os.cpu_count() or 1))
+)
+
+if FIREHOSE_MODE not in ('pipeline', 'sharded', 'async'):
+    raise RuntimeError('"FIREHOSE_MODE" must be one of "pipeline", "sharded" or "async".')
+
+# Shared DID document cache (firehose and web auth)
+DID_CACHE_SIZE = int(os.environ.get('DID_CACHE_SIZE', 50000))
+DID_CACHE_STALE_TTL = int(os.environ.get('DID_CACHE_STALE_TTL', 60 * 60))
+DID_CACHE_MAX_TTL = int(os.environ.get('DID_CACHE_MAX_TTL', 60 * 60 * 24))
+DID_CACHE_PATH = os.environ.get('DID_CACHE_PATH', None)
+
+def _parse_pairs(value: str) -> dict:
+    """Parse comma-separated ``name=value`` pairs, keeping their order."""
+    pairs = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        name, sep, rest = item.partition('=')
+        if not sep or not name.strip() or not rest.strip():
+            raise RuntimeError(f'Expected name=value, got "{item}".')
+        pairs[name.strip()] = rest.strip()
+    return pairs
+
+# Filter profiles, as comma-separated name=config-file pairs, all evaluated in one scan of each post.
+# The profiles a post matched are stored as a bitmask in post.feeds (bit i for the i-th profile),
+# so new profiles must be appended; never reorder or remove existing ones
+FILTER_PROFILES = _parse_pairs(os.environ.get('FILTER_PROFILES', 'main=filter_config.json'))
+if not 1 <= len(FILTER_PROFILES) <= 63:
+    raise RuntimeError('"FILTER_PROFILES" must name between 1 and 63 profiles.')
+
+# Feed URIs of the profiles after the first, as comma-separated profile=at-uri pairs; the first
+# profile is served at CHRONOLOGICAL_TRENDING_URI
+FEED_URIS = _parse_pairs(os.environ.get('FEED_URIS', ''))
+if not FEED_URIS.keys() <= FILTER_PROFILES.keys():
+    raise RuntimeError(f'"FEED_URIS" names unknown profiles: {", ".join(FEED_URIS.keys() - FILTER_PROFILES.keys())}.')
+
+# Compiled filter artifacts (matcher and resolved handle DIDs), keyed by a hash of the profiles' configs
+FILTER_CACHE_PATH = os.environ.get('FILTER_CACHE_PATH', 'filter_cache.pickle')
+FILTER_RESOLVE_INTERVAL = float(os.environ.get('FILTER_RESOLVE_INTERVAL', 60 * 60))
+
 
 CHRONOLOGICAL_TRENDING_URI = os.environ.get('CHRONOLOGICAL_TRENDING_URI')
 if CHRONOLOGICAL_TRENDING_URI is None:
@@ -0,0 +1,306 @@
+import atexit
+import json
+import os
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from time import sleep
+from typing import Callable, Optional
+
+from atproto import IdResolver
+from atproto_core.did_doc import DidDocument
+from atproto_identity.cache.base_cache import DidBaseCache
+from atproto_identity.cache.models import CachedDid, CachedDidResult
+
+from . import config
+from .logger import logger
+
+# How often stats are logged and the cache is persisted when it changed
+_MAINTENANCE_INTERVAL = 60  # seconds
+
+
+class DidCacheStats:
+    """Lookup counters for a DidLRUCache."""
+
+    __slots__ = (
+        'hits', 'stale_hits', 'misses', 'expired', 'evictions', 'refreshes', 'refresh_failures', 'refreshes_dropped'
+    )
+
+    def __init__(self):
+        self.hits = 0
+        self.stale_hits = 0        # hits served while a background refresh is scheduled
+        self.misses = 0
+        self.expired = 0           # entries found but past max_ttl, counted as misses too
+        self.evictions = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.refreshes_dropped = 0  # refreshes not scheduled because the queue was full
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> dict:
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats['hit_rate'] = self.hit_rate
+        return stats
+
+
+class DidLRUCache(DidBaseCache):
+    """
+    Size-bounded LRU cache of DID documents with TTL expiry and background refresh.
+
+    Entries older than ``stale_ttl`` are still served, but the resolver's refresh is run on a
+    small pool of daemon threads instead of the caller's thread; entries older than ``max_ttl``
+    are misses. Refreshes beyond ``refresh_queue_size`` pending are dropped, so a burst of
+    lookups can't build an unbounded backlog or keep the process alive at exit.
+    When ``path`` is set the cache is loaded from that JSON file on start and written back
+    periodically and at exit, so restarts don't begin with a cold cache.
+
+    Args:
+        max_size: Maximum number of cached documents; the least recently used are evicted.
+        stale_ttl: Seconds after which an entry is refreshed in the background.
+        max_ttl: Seconds after which an entry is no longer served.
+        path: Optional JSON file the cache is persisted to.
+        refresh_workers: Number of background refresh threads.
+        refresh_queue_size: Maximum number of pending refreshes.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 50000,
+        stale_ttl: Optional[int] = None,
+        max_ttl: Optional[int] = None,
+        path: Optional[str] = None,
+        refresh_workers: int = 2,
+        refresh_queue_size: int = 1000,
+    ):
+        super().__init__(stale_ttl, max_ttl)
+        self._max_size = max(1, max_size)
+        self._path = Path(path) if path else None
+
+        self._lock = threading.Lock()
+        self._cache: 'OrderedDict[str, CachedDid]' = OrderedDict()
+        self._refreshing = set()
+        self._queue = queue.Queue(maxsize=max(1, refresh_queue_size))
+        self._workers = max(1, refresh_workers)
+        self._dirty = False
+
+        self.stats = DidCacheStats()
+
+        if self._path:
+            self.load()
+            atexit.register(self.save)
+        atexit.register(self.close)
+
+        for i in range(self._workers):
+            threading.Thread(target=self._refresh_loop, name=f'did-refresh-{i}', daemon=True).start()
+        threading.Thread(target=self._maintenance_loop, name='did-cache', daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, did: str) -> Optional[CachedDidResult]:
+        with self._lock:
+            val = self._cache.get(did)
+            if val is None:
+                self.stats.misses += 1
+                return None
+
+            age = datetime.now(timezone.utc).timestamp() - val.updated_at.timestamp()
+            expired = age > self.max_ttl
+            stale = age > self.stale_ttl
+
+            if expired:
+                self.stats.expired += 1
+                self.stats.misses += 1
+            else:
+                self._cache.move_to_end(did)
+                self.stats.hits += 1
+                if stale:
+                    self.stats.stale_hits += 1
+
+        return CachedDidResult(did, val.document, val.updated_at, stale, expired)
+
+    def set(self, did: str, document: DidDocument) -> None:
+        self._put(did, CachedDid(document, datetime.now(timezone.utc)))
+
+    def refresh(self, did: str, get_doc_callback: Callable[[], Optional[DidDocument]]) -> None:
+        """Schedule a refresh of ``did``; the stale entry keeps being served until it completes."""
+        self.submit(did, get_doc_callback)
+
+    def submit(self, did: str, get_doc_callback: Callable[[], Optional[DidDocument]]) -> None:
+        """Run ``get_doc_callback`` in the background and cache its result, once per DID at a time."""
+        with self._lock:
+            if did in self._refreshing:
+                return
+            self._refreshing.add(did)
+
+        try:
+            self._queue.put_nowait((did, get_doc_callback))
+        except queue.Full:
+            with self._lock:
+                self._refreshing.discard(did)
+            self.stats.refreshes_dropped += 1
+
+    def close(self) -> None:
+        """Drop pending refreshes and stop the refresh threads once their current lookup returns."""
+        while True:
+            try:
+                did, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._refreshing.discard(did)
+        for _ in range(self._workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def delete(self, did: str) -> None:
+        with self._lock:
+            if self._cache.pop(did, None) is not None:
+                self._dirty = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._dirty = True
+
+    def _put(self, did: str, cached: CachedDid) -> None:
+        with self._lock:
+            self._cache[did] = cached
+            self._cache.move_to_end(did)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+                self.stats.evictions += 1
+            self._dirty = True
+
+    def _refresh_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._refresh(*item)
+
+    def _refresh(self, did: str, get_doc_callback: Callable[[], Optional[DidDocument]]) -> None:
+        try:
+            document = get_doc_callback()
+            if document:
+                self.set(did, document)
+            self.stats.refreshes += 1
+        except Exception as e:
+            self.stats.refresh_failures += 1
+            logger.debug(f'Failed to refresh DID {did}: {e}')
+        finally:
+            with self._lock:
+                self._refreshing.discard(did)
+
+    def load(self) -> None:
+        """Load persisted entries, skipping any that already expired."""
+        if not self._path or not self._path.exists():
+            return
+
+        try:
+            with open(self._path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f'Failed to load DID cache from {self._path}: {e}')
+            return
+
+        now = datetime.now(timezone.utc).timestamp()
+        loaded = 0
+        # Entries are stored least recently used first, so replaying them restores LRU order
+        for did, updated_at, document in entries:
+            if now - updated_at > self.max_ttl:
+                continue
+            try:
+                cached = CachedDid(DidDocument.from_dict(document), datetime.fromtimestamp(updated_at, timezone.utc))
+            except Exception:
+                continue
+            self._put(did, cached)
+            loaded += 1
+
+        self._dirty = False
+        logger.info(f'Loaded {loaded} DID documents from {self._path}.')
+
+    def save(self) -> None:
+        """Write the cache to ``path`` if it changed since the last save."""
+        if not self._path or not self._dirty:
+            return
+
+        with self._lock:
+            entries = [
+                [did, cached.updated_at.timestamp(), cached.document.model_dump(mode='json', by_alias=True)]
+                for did, cached in self._cache.items()
+            ]
+            self._dirty = False
+
+        try:
+            # Write then rename so a crash mid-write never leaves a truncated cache behind
+            tmp_path = self._path.with_suffix(self._path.suffix + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f'Failed to persist DID cache to {self._path}: {e}')
+
+    def _maintenance_loop(self) -> None:
+        while True:
+            sleep(_MAINTENANCE_INTERVAL)
+            self.save()
+            stats = self.stats.as_dict()
+            if stats['hits'] or stats['misses']:
+                logger.info(
+                    f"DidCache|{len(self)} cached|{stats['hit_rate']:.1%} hit rate|{stats['stale_hits']} stale|"
+                    f"{stats['misses']} misses|{stats['evictions']} evictions|{stats['refresh_failures']} failed refreshes|"
+                    f"{stats['refreshes_dropped']} dropped refreshes"
+                )
+
+
+_lock = threading.Lock()
+_cache: Optional[DidLRUCache] = None
+_resolver: Optional[IdResolver] = None
+
+
+def get_resolver() -> IdResolver:
+    """Process-wide IdResolver backed by the shared DID cache, created on first use."""
+    global _cache, _resolver
+    with _lock:
+        if _resolver is None:
+            _cache = DidLRUCache(
+                max_size=config.DID_CACHE_SIZE,
+                stale_ttl=config.DID_CACHE_STALE_TTL,
+                max_ttl=config.DID_CACHE_MAX_TTL,
+                path=config.DID_CACHE_PATH,
+            )
+            _resolver = IdResolver(cache=_cache)
+        return _resolver
+
+
+def get_cache() -> DidLRUCache:
+    get_resolver()
+    return _cache
+
+
+def handle_for(did: str) -> Optional[str]:
+    """
+    Cached handle of ``did`` without blocking on the network.
+
+    On a miss the DID is resolved in the background and None is returned, so callers on the
+    ingestion hot path can fall back to the DID itself.
+    """
+    resolver = get_resolver()
+    cached = _cache.get(did)
+    if cached is None or cached.expired:
+        _cache.submit(did, lambda: resolver.did.resolve_no_cache(did))
+        return None
+
+    if cached.stale:
+        resolver.did.refresh_cache(did)
+    return cached.document.get_handle()
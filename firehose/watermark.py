@@ -0,0 +1,67 @@
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class SeqWatermark:
+    """
+    Tracks firehose events that are still in flight and reports the highest sequence number
+    below which every event has been fully processed.
+
+    Events are registered in receive order with ``begin`` and may finish in any order with
+    ``finish``. ``seq`` only moves forward once every earlier event has finished, so it is
+    always safe to persist as the resume cursor.
+    """
+
+    def __init__(self, seq: Optional[int] = None):
+        self._lock = Lock()
+        self._next = 0          # next ordinal handed out by begin()
+        self._low = 0           # lowest ordinal that has not finished yet
+        self._finished: Dict[int, Optional[int]] = {}
+        self._seq = seq
+        self._processed = 0
+
+    def begin(self) -> int:
+        """Register a received event and return its ordinal."""
+        with self._lock:
+            ordinal = self._next
+            self._next += 1
+            return ordinal
+
+    def finish(self, ordinal: int, seq: Optional[int] = None) -> None:
+        """Mark an event as processed. ``seq`` may be None for frames without a sequence number."""
+        with self._lock:
+            self._finished[ordinal] = seq
+            self._advance()
+
+    def finish_all(self, events: Iterable[Tuple[int, Optional[int]]]) -> None:
+        """Mark several ``(ordinal, seq)`` events as processed at once."""
+        with self._lock:
+            for ordinal, seq in events:
+                self._finished[ordinal] = seq
+            self._advance()
+
+    def _advance(self) -> None:
+        while self._low in self._finished:
+            finished_seq = self._finished.pop(self._low)
+            if finished_seq is not None:
+                self._seq = finished_seq
+            self._low += 1
+            self._processed += 1
+
+    @property
+    def seq(self) -> Optional[int]:
+        """Highest sequence number up to which everything has been processed."""
+        with self._lock:
+            return self._seq
+
+    @property
+    def processed(self) -> int:
+        """Number of events the watermark has moved past."""
+        with self._lock:
+            return self._processed
+
+    @property
+    def in_flight(self) -> int:
+        """Number of registered events that have not finished yet."""
+        with self._lock:
+            return self._next - self._low
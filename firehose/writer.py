@@ -0,0 +1,400 @@
+import itertools
+import queue
+import threading
+from time import monotonic, sleep, time
+from typing import Callable, List, Optional, Sequence
+
+from peewee import DataError, IntegrityError, InterfaceError, OperationalError
+
+import metrics
+from database import db, partitions
+from records import PostRow
+from spool import Spool
+from utils.logger import logger
+
+# Sentinel pushed through the queue to stop the writer
+_STOP = object()
+
+# How often flush statistics are logged
+_STATS_INTERVAL = 60  # seconds
+
+# Attempts per flush before the batch is given up on, with exponential backoff between them
+_FLUSH_ATTEMPTS = 3
+_FLUSH_BACKOFF = 1  # seconds
+
+# Errors caused by the rows rather than the database, e.g. text psycopg2 can't send. Retrying
+# can't fix them, so the batch is written again one row at a time and the rejected rows are skipped
+_ROW_ERRORS = (DataError, IntegrityError, ValueError, TypeError)
+
+# Connection errors while draining the spool are retried indefinitely, backing off up to this
+_DRAIN_MAX_BACKOFF = 30  # seconds
+
+
+def _reset_connection() -> None:
+    # peewee keeps a broken connection open; closing it makes the next write reconnect,
+    # e.g. to the new primary after a failover
+    try:
+        db.close()
+    except Exception:
+        pass
+
+
+class WriterStats:
+    """Flush size and latency counters for a BulkWriter."""
+
+    __slots__ = ('flushes', 'rows', 'max_rows', 'latency_total', 'max_latency', 'duration_total', 'failures', 'skipped')
+
+    def __init__(self):
+        self.flushes = 0
+        self.rows = 0
+        self.max_rows = 0
+        self.latency_total = 0.0   # age of the oldest buffered row when its flush committed
+        self.max_latency = 0.0
+        self.duration_total = 0.0  # time spent inside the write callback
+        self.failures = 0
+        self.skipped = 0           # rows the database rejected
+
+    def record(self, rows: int, latency: float, duration: float) -> None:
+        self.flushes += 1
+        self.rows += rows
+        self.max_rows = max(self.max_rows, rows)
+        self.latency_total += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.duration_total += duration
+
+    def as_dict(self) -> dict:
+        flushes = self.flushes or 1
+        return {
+            'flushes': self.flushes,
+            'rows': self.rows,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'avg_rows_per_flush': self.rows / flushes,
+            'max_rows_per_flush': self.max_rows,
+            'avg_latency': self.latency_total / flushes,
+            'max_latency': self.max_latency,
+            'avg_flush_duration': self.duration_total / flushes,
+        }
+
+
+class BulkWriter:
+    """
+    Buffers matched posts and deletions across commits and flushes them in one transaction
+    once ``batch_size`` rows are waiting or the oldest row has waited ``max_latency`` seconds.
+
+    This trades one commit per firehose event for a handful of commits per second, while the
+    latency deadline bounds how stale the feed can get when traffic is light.
+
+    Each submission may carry opaque event tokens; they are handed to ``on_flushed`` only after
+    the flush containing them has committed, which is what cursor checkpointing relies on. A
+    flush that fails every attempt keeps its events: the cursor stays before them, so a restart
+    replays the posts instead of losing them. Rows the database rejects outright are the
+    exception: retrying can't store them, so they are skipped one by one and the rest written.
+
+    With a ``spool`` the database is written from a separate drain thread, so a slow or failed
+    over Postgres never blocks the writer. A flush is handed straight to the drain thread when it
+    is idle; otherwise it is appended to the spool, which counts as committed for the cursor,
+    and the drain thread writes spooled batches back in order once the database keeps up again.
+    A spooled batch is only removed from the spool once it has been written.
+
+    Args:
+        write_callback: Persists ``(posts_to_create, post_uris_to_delete)`` in one transaction.
+        batch_size: Number of buffered rows (posts plus deletions) that triggers a flush.
+        max_latency: Maximum seconds a buffered row waits before it is flushed.
+        queue_size: Maximum number of submitted results waiting to be buffered.
+        on_flushed: Called with the event tokens of every flush once it has committed.
+        spool: Optional disk spool absorbing flushes while the database falls behind.
+        prepare: Applied once to the posts of every flush before it is written or spooled, e.g.
+            to classify them, so retries don't repeat it.
+    """
+
+    def __init__(
+        self,
+        write_callback: Callable,
+        batch_size: int = 500,
+        max_latency: float = 2.0,
+        queue_size: int = 1000,
+        on_flushed: Optional[Callable[[list], None]] = None,
+        spool: Optional[Spool] = None,
+        prepare: Optional[Callable[[List[PostRow]], List[PostRow]]] = None,
+    ):
+        self._write_callback = write_callback
+        self._prepare = prepare
+        self._on_flushed = on_flushed
+        self._batch_size = max(1, batch_size)
+        self._max_latency = max_latency
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+        self._posts: List[PostRow] = []
+        self._deletes: List[str] = []
+        self._events: list = []
+        self._oldest: Optional[float] = None
+
+        self._spool = spool
+        self._handoff = queue.Queue(maxsize=1)  # at most one flush waiting for the drain thread
+        self._drain_thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+        self.stats = WriterStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def configure(self, batch_size: int, max_latency: float) -> None:
+        """Change the flush thresholds; the new values apply from the next buffered row."""
+        self._batch_size = max(1, batch_size)
+        self._max_latency = max_latency
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='firehose-writer', daemon=True)
+        self._thread.start()
+        if self._spool is not None:
+            self._drain_thread = threading.Thread(target=self._drain_loop, name='firehose-drain', daemon=True)
+            self._drain_thread.start()
+
+    def submit(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str], events: Sequence = ()) -> None:
+        """Queue filtered results for the next flush. Blocks when the writer is backed up."""
+        self._queue.put((posts_to_create, post_uris_to_delete, events))
+
+    def stop(self) -> None:
+        """Flush everything submitted so far and stop the writer thread."""
+        if self._thread:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        if self._drain_thread:
+            # Spooled batches stay on disk for the next start; a write stuck on a down database
+            # is abandoned and its events are replayed from the cursor
+            self._stopping.set()
+            # A drain thread giving up on a down database exits without taking the flush waiting
+            # in the handoff, so make room instead of blocking on the full queue
+            try:
+                self._handoff.get_nowait()
+            except queue.Empty:
+                pass
+            self._handoff.put_nowait(_STOP)
+            self._drain_thread.join()
+            self._drain_thread = None
+        self._log_stats()
+
+    def _run(self) -> None:
+        last_stats = monotonic()
+
+        while True:
+            timeout = None
+            if self._oldest is not None:
+                timeout = max(0.0, self._oldest + self._max_latency - monotonic())
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush()
+                return
+
+            if item is not None:
+                posts_to_create, post_uris_to_delete, events = item
+                if self._oldest is None:
+                    self._oldest = monotonic()
+                self._posts.extend(posts_to_create)
+                self._deletes.extend(post_uris_to_delete)
+                self._events.extend(events)
+
+            buffered = len(self._posts) + len(self._deletes)
+            if buffered >= self._batch_size or (
+                self._oldest is not None and monotonic() - self._oldest >= self._max_latency
+            ):
+                self._flush()
+
+            if monotonic() - last_stats >= _STATS_INTERVAL:
+                self._log_stats()
+                last_stats = monotonic()
+
+    def _flush(self) -> None:
+        if self._oldest is None:
+            return
+
+        posts_to_create, post_uris_to_delete, events = self._posts, self._deletes, self._events
+        oldest = self._oldest
+        self._posts, self._deletes, self._events, self._oldest = [], [], [], None
+
+        if self._prepare and posts_to_create:
+            posts_to_create = self._prepare(posts_to_create)
+
+        if self._spool is not None:
+            self._dispatch(posts_to_create, post_uris_to_delete, events, time() - (monotonic() - oldest))
+            return
+
+        rows = len(posts_to_create) + len(post_uris_to_delete)
+        if rows:
+            started = monotonic()
+            for attempt in range(1, _FLUSH_ATTEMPTS + 1):
+                try:
+                    self._write(posts_to_create, post_uris_to_delete)
+                except Exception as e:
+                    logger.error(
+                        f'Failed to flush {len(posts_to_create)} posts and {len(post_uris_to_delete)} deletes '
+                        f'(attempt {attempt}/{_FLUSH_ATTEMPTS}): {e}'
+                    )
+                    if isinstance(e, (OperationalError, InterfaceError)):
+                        _reset_connection()
+                    if attempt < _FLUSH_ATTEMPTS:
+                        sleep(_FLUSH_BACKOFF * 2 ** (attempt - 1))
+                    continue
+
+                finished = monotonic()
+                self.stats.record(rows, finished - oldest, finished - started)
+                metrics.WRITE_SECONDS.observe(finished - started)
+                metrics.FLUSH_ROWS.observe(rows)
+                metrics.DELETED_POSTS.inc(len(post_uris_to_delete))
+                break
+            else:
+                # The rows were never written, so their events must not move the cursor past them
+                self.stats.failures += 1
+                metrics.FLUSH_FAILURES.inc()
+                logger.error(f'Gave up on {rows} rows; the cursor stays before their events until a restart replays them')
+                return
+
+        if events and self._on_flushed:
+            self._on_flushed(events)
+
+    def _dispatch(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str], events: list, queued_at: float) -> None:
+        if not (posts_to_create or post_uris_to_delete):
+            if events and self._on_flushed:
+                self._on_flushed(events)
+            return
+
+        # Handing off is only safe while nothing older is waiting in the spool
+        if not self._spool.pending:
+            try:
+                self._handoff.put_nowait((posts_to_create, post_uris_to_delete, events, queued_at))
+                return
+            except queue.Full:
+                logger.info(f'Spool|database is behind, spooling writes to {self._spool.path}')
+
+        self._spool.append((posts_to_create, post_uris_to_delete, queued_at))
+        if events and self._on_flushed:
+            self._on_flushed(events)
+
+    def _drain_loop(self) -> None:
+        drained = 0
+        while True:
+            # A handed-off flush is always older than anything in the spool
+            try:
+                item = self._handoff.get(timeout=0 if self._spool.pending else 1)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                return
+
+            if item is not None:
+                posts_to_create, post_uris_to_delete, events, queued_at = item
+                if not self._write_durably(posts_to_create, post_uris_to_delete, queued_at):
+                    if self._stopping.is_set():
+                        return
+                    # Given up on like a direct flush: the events stay unfinished and hold the cursor
+                    logger.error(f'Gave up on {len(posts_to_create) + len(post_uris_to_delete)} rows; '
+                                 f'the cursor stays before their events until a restart replays them')
+                    continue
+                if events and self._on_flushed:
+                    self._on_flushed(events)
+            elif self._spool.pending:
+                posts_to_create, post_uris_to_delete, queued_at = self._spool.peek()
+                # Its events already count as committed, so the spool is the only copy of these rows
+                if not self._write_durably(posts_to_create, post_uris_to_delete, queued_at, attempts=None):
+                    return
+                self._spool.pop()
+                drained += 1
+                if not self._spool.pending:
+                    logger.info(f'Spool|drained {drained} batches, writing directly again')
+                    drained = 0
+
+    def _write_durably(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str], queued_at: float,
+                       attempts: Optional[int] = _FLUSH_ATTEMPTS) -> bool:
+        """
+        Write one batch from the drain thread. Connection errors are retried until the database
+        comes back; other errors give up after ``attempts`` tries like a direct flush does, or
+        are retried with backoff for as long as it takes when ``attempts`` is None. Returns
+        False when the batch is still unwritten, because the writer is stopping or it gave up.
+        """
+        rows = len(posts_to_create) + len(post_uris_to_delete)
+        attempt = failed = 0
+        while True:
+            attempt += 1
+            started = monotonic()
+            try:
+                self._write(posts_to_create, post_uris_to_delete)
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f'Database unavailable while writing {rows} rows (attempt {attempt}): {e}')
+                _reset_connection()
+                if self._stopping.wait(min(_FLUSH_BACKOFF * 2 ** min(attempt - 1, 5), _DRAIN_MAX_BACKOFF)):
+                    return False
+                continue
+            except Exception as e:
+                failed += 1
+                logger.error(
+                    f'Failed to flush {len(posts_to_create)} posts and {len(post_uris_to_delete)} deletes '
+                    f'(attempt {failed}/{attempts or "unlimited"}): {e}'
+                )
+                if failed == (attempts or _FLUSH_ATTEMPTS):
+                    # Counted once per batch, however long it keeps failing
+                    self.stats.failures += 1
+                    metrics.FLUSH_FAILURES.inc()
+                if failed == attempts:
+                    return False
+                if self._stopping.wait(min(_FLUSH_BACKOFF * 2 ** min(failed - 1, 5), _DRAIN_MAX_BACKOFF)):
+                    return False
+                continue
+
+            finished = monotonic()
+            self.stats.record(rows, max(0.0, time() - queued_at), finished - started)
+            metrics.WRITE_SECONDS.observe(finished - started)
+            metrics.FLUSH_ROWS.observe(rows)
+            metrics.DELETED_POSTS.inc(len(post_uris_to_delete))
+            return True
+
+    def _write(self, posts_to_create: List[PostRow], post_uris_to_delete: List[str]) -> None:
+        """
+        Write one batch in one transaction. When the database rejects its rows, write them again
+        one per transaction and skip the rejected ones; any other error is raised.
+        """
+        try:
+            self._write_callback(posts_to_create, post_uris_to_delete)
+            return
+        except _ROW_ERRORS as e:
+            if partitions.is_missing_partition(e):
+                # Not the rows' fault: raised so the retry finds the partitions created
+                raise
+            logger.error(
+                f'Failed to flush {len(posts_to_create)} posts and {len(post_uris_to_delete)} deletes, '
+                f'writing them one at a time: {e}'
+            )
+
+        rows = itertools.chain(
+            (([post], []) for post in posts_to_create),
+            (([], [uri]) for uri in post_uris_to_delete),
+        )
+        for posts, uris in rows:
+            try:
+                self._write_callback(posts, uris)
+            except _ROW_ERRORS as e:
+                if partitions.is_missing_partition(e):
+                    raise
+                logger.error(f'Skipping {posts[0].uri if posts else "deletion of " + uris[0]}: {e}')
+                self.stats.skipped += 1
+                metrics.SKIPPED_ROWS.inc()
+
+    def _log_stats(self) -> None:
+        stats = self.stats.as_dict()
+        if not stats['flushes']:
+            return
+        logger.info(
+            f"Writer|{stats['flushes']} flushes|{stats['avg_rows_per_flush']:.1f} rows/flush avg|"
+            f"{stats['max_rows_per_flush']} max|{stats['avg_latency']:.2f}s latency avg|"
+            f"{stats['max_latency']:.2f}s max|{stats['failures']} failures|{stats['skipped']} skipped rows"
+        )
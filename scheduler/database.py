@@ -1,35 +1,16 @@
-from datetime import datetime, timedelta, timezone
+import os
+import sys
+from utils import config
 from utils.config import POSTGRES_DB, POSTGRES_PASSWORD, POSTGRES_USER, POSTGRES_HOST, POSTGRES_PORT
-import peewee
 
-# Database setup
-db = peewee.PostgresqlDatabase(POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD, host=POSTGRES_HOST, port=POSTGRES_PORT)
-
-# Database Models
-class BaseModel(peewee.Model):
-    class Meta:
-        database = db
-
-class Post(BaseModel):
-    uri = peewee.CharField(index=True)
-    cid = peewee.CharField()
-    reply_parent = peewee.CharField(null=True, default=None)
-    reply_root = peewee.CharField(null=True, default=None)
-    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc), index=True)
-    author = peewee.CharField(null=True, default=None, index=True)
-    interactions = peewee.BigIntegerField(default=0, index=True)
-    text = peewee.TextField(null=True, default=None)
+# The shared schema package sits at the repository root (next to this module in the Docker image)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-class SubscriptionState(BaseModel):
-    service = peewee.CharField(unique=True)
-    cursor = peewee.BigIntegerField()
-    last_indexed_at = peewee.DateTimeField(null=True, default=None)
+from feeddb import db, PooledDatabase, partitions, Post, Requests, SessionState, SubscriptionState  # noqa: E402
 
-class SessionState(BaseModel):
-    service = peewee.CharField(unique=True)
-    session_string = peewee.TextField(null=True)
-
-# table for storing dids
-class Requests(BaseModel):
-    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc), index=True)
-    did = peewee.CharField(null=True, default=None, index=True)
\ No newline at end of file
+# Database setup
+db.initialize(PooledDatabase(
+    POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD, host=POSTGRES_HOST, port=POSTGRES_PORT,
+    max_connections=config.DB_POOL_MAX_CONNECTIONS, max_age=config.DB_POOL_MAX_AGE,
+    timeout=config.DB_POOL_WAIT_TIMEOUT, ping_after=config.DB_POOL_PING_AFTER,
+))
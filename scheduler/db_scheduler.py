@@ -9,13 +9,14 @@ import argparse
 
 from utils.logger import logger
 from utils.config import HANDLE, PASSWORD
-from database import db, Post, SessionState
+from database import db, partitions, Post, SessionState
 
 # Main Function
 def main():
     parser = argparse.ArgumentParser(description='Run scheduler tasks as one-time jobs')
-    parser.add_argument('--job', choices=['hydrate', 'cleanup'], required=True,
-                       help='Job type to run: hydrate (hydrate posts) or cleanup (database cleanup)')
+    parser.add_argument('--job', choices=['hydrate', 'cleanup', 'score'], required=True,
+                       help='Job type to run: hydrate (hydrate posts), cleanup (database cleanup) '
+                            'or score (rescore from firehose counters)')
     parser.add_argument('--clear-days', type=int, default=3,
                        help='Days to keep posts for cleanup job (default: 3)')
     
@@ -36,6 +37,9 @@ def main():
         elif job_type == 'cleanup':
             cleanup_db(clear_days)
             logger.info(f"Cleanup job completed successfully (cleared {clear_days} days)")
+        elif job_type == 'score':
+            rescore_posts()
+            logger.info("Score job completed successfully")
         else:
             logger.error(f"Unknown job type: {job_type}")
             sys.exit(1)
@@ -50,44 +54,54 @@ def main():
             logger.info("Database connection closed.")
 
 # Postgres database management functions
-def clear_old_posts(clear_days: int):
+def drop_expired_partitions(clear_days: int):
+    """Drop the daily post partitions older than ``clear_days`` and create the upcoming ones."""
     try:
         with db.connection_context():
             logger.info("Database connection opened for cleanup.")
-            cutoff_date = datetime.now() - timedelta(days=clear_days)
-            query = Post.delete().where(Post.indexed_at < cutoff_date)
-
-            with db.atomic():
-                num_deleted = query.execute()
-
-            logger.info(f"Deleted {num_deleted} posts older than {cutoff_date}.")
+            result = partitions.maintain(retention_days=clear_days)
+            if result is None:
+                logger.info("Partition maintenance skipped: another job holds the lock or post is not partitioned yet.")
+                return
+            for day in result['dropped']:
+                logger.info(f"Dropped the post partition of {day.isoformat()}.")
+            for day in result['created']:
+                logger.info(f"Created the post partition of {day.isoformat()}.")
     except peewee.PeeweeException as e:
-        logger.error(f"An error occurred while deleting old posts: {e}")
-    finally:
-        if not db.is_closed():
-            db.close()
-            logger.info("Database connection closed after cleanup by force.")
-        else:
-            logger.info("Database connection closed after cleanup.")
+        logger.error(f"An error occurred while maintaining post partitions: {e}")
+        raise
 
-def vacuum_database():
+def cleanup_db(clear_days: int = 3):
+    # Dropping a partition replaces DELETE + VACUUM FULL, which rewrote the table under an exclusive lock
+    drop_expired_partitions(clear_days)
+
+# Rescoring from the engagement counters the firehose maintains, without API calls
+def rescore_posts(days: int = 4):
+    """
+    Recompute every recent post's hot score in one statement so scores decay between engagements.
+    Only rows whose score actually changes are written; most posts never get any engagement.
+    """
     try:
         with db.connection_context():
-            logger.info("Database connection opened for vacuum.")
-            db.execute_sql('VACUUM FULL;')
-            logger.info("Vacuum operation completed.")
+            updated = db.execute_sql(
+                """
+                WITH scored AS (
+                    SELECT id, indexed_at, ((like_count + 2 * reply_count + 3 * repost_count)
+                        / power(extract(epoch from (now() at time zone 'utc') - indexed_at) / 3600 + 2, 1.5) * 100)::bigint AS score
+                    FROM post
+                    WHERE indexed_at > (now() at time zone 'utc') - make_interval(days => %s)
+                )
+                UPDATE post SET interactions = scored.score
+                FROM scored
+                WHERE post.id = scored.id AND post.indexed_at = scored.indexed_at
+                  AND post.interactions IS DISTINCT FROM scored.score
+                """,
+                (days,),
+            ).rowcount
+            logger.info(f"Rescored {updated} posts from engagement counters.")
     except peewee.PeeweeException as e:
-        logger.error(f"An error occurred while vacuuming the database: {e}")
-    finally:
-        if not db.is_closed():
-            db.close()
-            logger.info("Database connection closed after vacuum by force.")
-        else:
-            logger.info("Database connection closed after vacuum.")
-
-def cleanup_db(clear_days: int = 3):
-    clear_old_posts(clear_days)
-    vacuum_database()
+        logger.error(f"An error occurred while rescoring posts: {e}")
+        raise
 
 # Hydration Function with Rate Limit and Expired Token Handling
 def hydrate_posts_with_interactions(client: Client, batch_size: int = 25):
@@ -152,9 +166,15 @@ def hydrate_posts_with_interactions(client: Client, batch_size: int = 25):
 
                         # Fetch the current interaction score from the database
                         current_post = Post.get_or_none(Post.uri == uri)
-                        if current_post and current_post.interactions != hot_score:
-                            # Update the interactions in list for bulk update
+                        counts = (like_count, repost_count, reply_count)
+                        if current_post and (
+                            current_post.interactions != hot_score
+                            or (current_post.like_count, current_post.repost_count, current_post.reply_count) != counts
+                        ):
+                            # Update the interactions in list for bulk update; the API counts also
+                            # correct the firehose counters, which cannot see unlikes
                             current_post.interactions = hot_score
+                            current_post.like_count, current_post.repost_count, current_post.reply_count = counts
                             #logger.info(f"{current_post}")
                             posts_to_update.append(current_post)
                         
@@ -185,7 +205,9 @@ def hydrate_posts_with_interactions(client: Client, batch_size: int = 25):
             if posts_to_update:
                 try:
                     with db.atomic():
-                        updated = Post.bulk_update(posts_to_update, fields=['interactions'])
+                        updated = Post.bulk_update(
+                            posts_to_update, fields=['interactions', 'like_count', 'repost_count', 'reply_count']
+                        )
                     logger.info(f"Hydrated {updated} posts with updated hot_scores.")
                 except Exception as e:
                     logger.error(f"Failed to bulk update posts: {e}")
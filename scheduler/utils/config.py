@@ -27,6 +27,12 @@ if HOSTNAME is None:
 if SERVICE_DID is None:
     SERVICE_DID = f'did:web:{HOSTNAME}'
 
+# Database connection pool (feeddb/pool.py); every service reads these from its own environment
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX_CONNECTIONS', 10))
+DB_POOL_MAX_AGE = float(os.environ.get('DB_POOL_MAX_AGE', 30 * 60))
+DB_POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', 10))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))
+
 
 CHRONOLOGICAL_TRENDING_URI = os.environ.get('CHRONOLOGICAL_TRENDING_URI')
 if CHRONOLOGICAL_TRENDING_URI is None:
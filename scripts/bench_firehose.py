@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Capture-and-replay benchmark for firehose ingestion.
+
+Records raw firehose frames to a length-prefixed capture file, then replays them at full
+speed through the same stages the live service runs: frame decoding,
+``parse_subscribe_repos_message``, ``_get_ops_by_type``, ``filter_operations`` and
+``write_operations`` (or an in-memory sink). Reports events/s, time per stage, peak RSS and
+garbage collector runs, so ingestion changes can be compared on a machine without network access.
+
+    python scripts/bench_firehose.py record capture.bin --count 200000
+    python scripts/bench_firehose.py synth capture.bin --count 100000      # no network needed
+    python scripts/bench_firehose.py replay capture.bin                    # in-memory sink
+    python scripts/bench_firehose.py replay capture.bin --sink postgres    # POSTGRES_* env vars
+
+The firehose modules read their configuration from the environment at import time, so the
+POSTGRES_* and other required variables must be set even for the in-memory sink. Handles in
+``filter_config.json`` resolve from the filter cache (FILTER_CACHE_PATH) when it exists.
+"""
+
+import argparse
+import gc
+import hashlib
+import os
+import random
+import resource
+import struct
+import sys
+import time
+from datetime import datetime, timezone
+
+FIREHOSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firehose')
+sys.path.append(FIREHOSE_DIR)
+
+# Capture file: magic, then one big-endian u32 length followed by the raw websocket frame per event
+MAGIC = b'FHCAP\x01'
+_LENGTH = struct.Struct('>I')
+
+STAGES = ('read', 'frame', 'parse', 'ops', 'filter', 'write')
+
+
+def write_frame(f, frame: bytes) -> None:
+    f.write(_LENGTH.pack(len(frame)))
+    f.write(frame)
+
+
+def read_frames(path: str):
+    """Yield the raw frames of a capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise SystemExit(f'{path} is not a firehose capture')
+        while True:
+            header = f.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            (length,) = _LENGTH.unpack(header)
+            yield f.read(length)
+
+
+def record(args) -> None:
+    from atproto import FirehoseSubscribeReposClient, models
+
+    params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=args.cursor) if args.cursor else None
+    recorded = 0
+    started = time.monotonic()
+
+    with open(args.capture, 'wb') as f:
+        f.write(MAGIC)
+
+        class RecordingClient(FirehoseSubscribeReposClient):
+            # Raw frames are only visible before the client decodes them
+            def _decode_frame(self, raw_frame):
+                nonlocal recorded
+                if isinstance(raw_frame, bytes):
+                    write_frame(f, raw_frame)
+                    recorded += 1
+                    if recorded % 10000 == 0:
+                        print(f'{recorded} frames recorded')
+                return super()._decode_frame(raw_frame)
+
+        client = RecordingClient(params)
+
+        def on_message(message) -> None:
+            if recorded >= args.count or (args.duration and time.monotonic() - started >= args.duration):
+                client.stop()
+
+        client.start(on_message)
+
+    print(f'Recorded {recorded} frames to {args.capture} in {time.monotonic() - started:.1f}s')
+
+
+def _cid(data: bytes) -> bytes:
+    # CIDv1, dag-cbor, sha2-256
+    return bytes([0x01, 0x71, 0x12, 0x20]) + hashlib.sha256(data).digest()
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def synth(args) -> None:
+    """Generate a capture with a firehose-like mix of posts, likes, reposts, follows and deletes."""
+    import json
+
+    import libipld
+
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from bench_matcher import generate_corpus
+
+    with open(os.path.join(FIREHOSE_DIR, 'filter_config.json'), 'r') as f:
+        filters = json.load(f)
+
+    rng = random.Random(args.seed)
+    texts = generate_corpus(filters, 2000, args.seed, args.term_rate)
+    now = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+    header = libipld.encode_dag_cbor({'op': 1, 't': '#commit'})
+    subject = {'uri': 'at://did:plc:subject/app.bsky.feed.post/3kabc', 'cid': _cid(b'subject')}
+    repos = [f'did:plc:{i:024d}' for i in range(args.repos)]
+    recent_posts = []  # (repo, path) of posts a later commit may delete
+
+    with open(args.capture, 'wb') as f:
+        f.write(MAGIC)
+        for seq in range(1, args.count + 1):
+            repo = rng.choice(repos)
+            rkey = f'3k{seq:011d}'
+            kind = rng.random()
+
+            if kind < args.post_rate:
+                collection = 'app.bsky.feed.post'
+                record = {'$type': collection, 'text': rng.choice(texts), 'createdAt': now, 'langs': ['en']}
+                recent_posts.append((repo, f'{collection}/{rkey}'))
+            elif kind < args.post_rate + args.delete_rate and recent_posts:
+                # Deletes come from the repo that created the post, so they match a stored one
+                repo, path = recent_posts.pop(rng.randrange(len(recent_posts)))
+                collection = None
+            else:
+                collection = rng.choice(('app.bsky.feed.like', 'app.bsky.feed.like', 'app.bsky.feed.repost', 'app.bsky.graph.follow'))
+                if collection == 'app.bsky.graph.follow':
+                    record = {'$type': collection, 'subject': rng.choice(repos), 'createdAt': now}
+                else:
+                    record = {'$type': collection, 'subject': subject, 'createdAt': now}
+
+            if collection is None:
+                ops = [{'action': 'delete', 'path': path, 'cid': None}]
+                blocks = [(_cid(rkey.encode()), libipld.encode_dag_cbor({'did': repo, 'rev': rkey}))]
+            else:
+                data = libipld.encode_dag_cbor(record)
+                ops = [{'action': 'create', 'path': f'{collection}/{rkey}', 'cid': _cid(data)}]
+                # A real commit also carries the signed commit node and MST nodes
+                blocks = [(_cid(data), data), (_cid(rkey.encode()), libipld.encode_dag_cbor({'did': repo, 'rev': rkey}))]
+
+            root = blocks[-1][0]
+            car_header = libipld.encode_dag_cbor({'version': 1, 'roots': [root]})
+            car = _varint(len(car_header)) + car_header
+            for cid, data in blocks:
+                car += _varint(len(cid) + len(data)) + cid + data
+
+            body = {
+                'seq': seq,
+                'rebase': False,
+                'tooBig': False,
+                'repo': repo,
+                'commit': root,
+                'rev': rkey,
+                'since': None,
+                'blocks': car,
+                'ops': ops,
+                'blobs': [],
+                'time': now,
+            }
+            write_frame(f, header + libipld.encode_dag_cbor(body))
+
+    print(f'Generated {args.count} frames in {args.capture}')
+
+
+class MemorySink:
+    """Stands in for write_operations, keeping only the stored URIs."""
+
+    def __init__(self):
+        self.uris = set()
+        self.created = 0
+        self.deleted = 0
+
+    def __call__(self, posts_to_create, post_uris_to_delete) -> None:
+        for post in posts_to_create:
+            self.uris.add(post.uri)
+        self.created += len(posts_to_create)
+        for uri in post_uris_to_delete:
+            if uri in self.uris:
+                self.uris.discard(uri)
+                self.deleted += 1
+
+
+def replay(args) -> None:
+    capture = os.path.abspath(args.capture)
+    # data_filter loads filter_config.json relative to the working directory, like the service does
+    os.chdir(FIREHOSE_DIR)
+
+    from atproto import firehose_models, models, parse_subscribe_repos_message
+
+    import data_filter
+    from data_filter import classify_posts, filter_operations, write_operations
+    from data_stream import _get_ops_by_type, init_database
+    from uri_index import UriIndex
+
+    if args.sink == 'postgres':
+        init_database()
+        # The service's writer classifies each batch once before writing it
+        sink = lambda posts, deletes: write_operations(classify_posts(posts), deletes)  # noqa: E731
+    else:
+        sink = MemorySink()
+        # Nothing is stored yet, so the delete filter starts empty instead of reading the table
+        data_filter.URI_INDEX = UriIndex(rebuild_interval=0)
+        data_filter.URI_INDEX.load({})
+
+    timings = dict.fromkeys(STAGES, 0.0)
+    events = commits = matched = deleted = 0
+    posts, deletes = [], []
+    clock = time.perf_counter
+
+    def flush() -> None:
+        nonlocal posts, deletes
+        started = clock()
+        sink(posts, deletes)
+        timings['write'] += clock() - started
+        posts, deletes = [], []
+
+    gc_before = [generation['collections'] for generation in gc.get_stats()]
+    started_all = clock()
+    for _ in range(args.repeat):
+        frames = read_frames(capture)
+        while True:
+            t0 = clock()
+            raw = next(frames, None)
+            t1 = clock()
+            timings['read'] += t1 - t0
+            if raw is None:
+                break
+
+            events += 1
+            try:
+                message = firehose_models.Frame.from_bytes(raw)
+                t2 = clock()
+                commit = parse_subscribe_repos_message(message)
+                t3 = clock()
+            except Exception as e:
+                print(f'Skipping undecodable frame {events}: {e}')
+                continue
+            timings['frame'] += t2 - t1
+            timings['parse'] += t3 - t2
+
+            if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit) or not commit.blocks:
+                continue
+            commits += 1
+
+            ops = _get_ops_by_type(commit)
+            t4 = clock()
+            posts_to_create, post_uris_to_delete = filter_operations(ops)
+            t5 = clock()
+            timings['ops'] += t4 - t3
+            timings['filter'] += t5 - t4
+
+            matched += len(posts_to_create)
+            deleted += len(post_uris_to_delete)
+            posts.extend(posts_to_create)
+            deletes.extend(post_uris_to_delete)
+            if len(posts) + len(deletes) >= args.batch_size:
+                flush()
+
+    flush()
+    elapsed = clock() - started_all
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    # Collections per generation are a proxy for allocation churn in the long-running service
+    collections = [generation['collections'] - before for generation, before in zip(gc.get_stats(), gc_before)]
+
+    print(f'{events} events ({commits} commits, {matched} matched posts, {deleted} deletes written) in {elapsed:.2f}s')
+    print(f'throughput: {events / elapsed:,.0f} events/s')
+    print(f'peak RSS:   {peak_rss:,.1f} MiB')
+    print(f'gc runs:    {collections[0]} gen0, {collections[1]} gen1, {collections[2]} gen2')
+    print(f"{'stage':<8}{'total s':>10}{'us/event':>10}{'share':>8}")
+    for stage in STAGES:
+        total = timings[stage]
+        print(f'{stage:<8}{total:>10.3f}{total * 1e6 / max(events, 1):>10.2f}{total / elapsed:>8.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record firehose frames and replay them through the ingestion stages')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='Record live frames from the firehose')
+    record_parser.add_argument('capture', help='Capture file to write')
+    record_parser.add_argument('--count', type=int, default=100000, help='Frames to record (default: 100000)')
+    record_parser.add_argument('--duration', type=float, help='Stop after this many seconds')
+    record_parser.add_argument('--cursor', type=int, help='Start from this sequence number')
+
+    synth_parser = commands.add_parser('synth', help='Generate a synthetic capture without network access')
+    synth_parser.add_argument('capture', help='Capture file to write')
+    synth_parser.add_argument('--count', type=int, default=100000, help='Frames to generate (default: 100000)')
+    synth_parser.add_argument('--repos', type=int, default=5000, help='Distinct repo DIDs (default: 5000)')
+    synth_parser.add_argument('--post-rate', type=float, default=0.15, help='Share of commits creating posts')
+    synth_parser.add_argument('--delete-rate', type=float, default=0.02, help='Share of commits deleting posts')
+    synth_parser.add_argument('--term-rate', type=float, default=0.02,
+                              help='Share of post words drawn from the filter vocabulary (default: 0.02)')
+    synth_parser.add_argument('--seed', type=int, default=1126, help='Seed for the generated capture')
+
+    replay_parser = commands.add_parser('replay', help='Replay a capture at full speed and report timings')
+    replay_parser.add_argument('capture', help='Capture file to read')
+    replay_parser.add_argument('--sink', choices=['memory', 'postgres'], default='memory',
+                               help='Where matched posts are written (default: memory)')
+    replay_parser.add_argument('--batch-size', type=int, default=500, help='Rows per write (default: 500)')
+    replay_parser.add_argument('--repeat', type=int, default=1, help='Replay the capture this many times')
+
+    args = parser.parse_args()
+    {'record': record, 'synth': synth, 'replay': replay}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
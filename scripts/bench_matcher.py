@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Equivalence check and microbenchmark for the firehose keyword matcher.
+
+Runs the original four-regex ``matches_filters`` logic and ``FilterMatcher`` over the same
+corpus, fails if they ever disagree, then times both.
+
+    python scripts/bench_matcher.py
+    python scripts/bench_matcher.py --corpus posts.jsonl   # one {"text": ...} object per line
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from typing import Callable, List
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'firehose'))
+
+from matcher import FilterMatcher, compile_multi_word_lookahead, compile_pattern
+
+FILTER_FILE = os.path.join(os.path.dirname(__file__), '..', 'firehose', 'filter_config.json')
+
+FILLER = (
+    'the a of and to in is it that was for on are with as his they be at one have this from or had by '
+    'word but what some we can out other were all there when up use your how said an each she which do '
+    'their time if will way about many then them write would like so these her long make thing see him '
+    'two has look more day could go come did number sound no most people my over know water than call '
+    'first who may down side been now find any new work part take get place made live where after back '
+    'reading book books series fantasy magic storm light archive kings war words radiance hero ages well'
+).split()
+
+DECORATIONS = [
+    lambda w: w,
+    lambda w: w.upper(),
+    lambda w: w.capitalize(),
+    lambda w: w + 's',
+    lambda w: w + 'S',
+    lambda w: w + 'es',
+    lambda w: w + 'x',
+    lambda w: 'x' + w,
+    lambda w: w + '_',
+    lambda w: w + '1',
+    lambda w: '#' + w,
+    lambda w: '@' + w,
+    lambda w: w + "'s",
+    lambda w: w + '!',
+]
+
+SEPARATORS = [' ', ' ', ' ', '  ', ', ', '. ', '\n', ' - ', '/', '"', ' (', ') ']
+
+
+def build_regex_matcher(filters: dict) -> Callable[[str], bool]:
+    """The original matches_filters, kept here as the reference implementation."""
+    include_tokens = re.compile(compile_pattern(filters['TOKENS']), re.IGNORECASE)
+    exclude_tokens = re.compile(compile_pattern(filters['EXCLUDE_TOKENS']), re.IGNORECASE)
+    phrases = re.compile(compile_pattern(filters['PHRASES']), re.IGNORECASE)
+    multi_word = compile_multi_word_lookahead(filters['INCLUSIVE_MULTI_TOKENS'])
+
+    def matches_filters(text):
+        if exclude_tokens.search(text):
+            return False
+        if phrases.search(text):
+            return True
+        if multi_word.search(text):
+            return True
+        if include_tokens.search(text):
+            return True
+        return False
+
+    return matches_filters
+
+
+def generate_corpus(filters: dict, size: int, seed: int, term_rate: float) -> List[str]:
+    rng = random.Random(seed)
+    vocabulary = (
+        filters['TOKENS'] + filters['PHRASES'] + filters['EXCLUDE_TOKENS']
+        + [word for token in filters['INCLUSIVE_MULTI_TOKENS'] for word in token.split()]
+    )
+
+    corpus = []
+    for _ in range(size):
+        parts = []
+        for _ in range(rng.randint(3, 60)):
+            # Most words in real traffic are not filter terms
+            word = rng.choice(vocabulary) if rng.random() < term_rate else rng.choice(FILLER)
+            parts.append(rng.choice(DECORATIONS)(word))
+            parts.append(rng.choice(SEPARATORS))
+        corpus.append(''.join(parts))
+    return corpus
+
+
+def load_corpus(path: str) -> List[str]:
+    texts = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                texts.append(json.loads(line)['text'] or '')
+    return texts
+
+
+def time_matcher(fn: Callable[[str], bool], corpus: List[str], rounds: int) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check FilterMatcher against the original regexes and benchmark both')
+    parser.add_argument('--corpus', help='JSON-lines file of posts ({"text": ...}); defaults to a generated corpus')
+    parser.add_argument('--size', type=int, default=5000, help='Number of generated posts (default: 5000)')
+    parser.add_argument('--term-rate', type=float, default=0.02,
+                        help='Share of generated words drawn from the filter vocabulary (default: 0.02)')
+    parser.add_argument('--seed', type=int, default=1126, help='Seed for the generated corpus')
+    parser.add_argument('--rounds', type=int, default=3, help='Timing rounds; the best one is reported')
+    args = parser.parse_args()
+
+    with open(FILTER_FILE, 'r') as f:
+        filters = json.load(f)
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(filters, args.size, args.seed, args.term_rate)
+    regex_matches = build_regex_matcher(filters)
+    matcher = FilterMatcher.from_filters(filters)
+
+    mismatches = [text for text in corpus if regex_matches(text) != matcher.matches(text)]
+    matched = sum(1 for text in corpus if matcher.matches(text))
+    print(f'{len(corpus)} posts, {matched} matched, {len(mismatches)} mismatches')
+    for text in mismatches[:10]:
+        print(f'  MISMATCH regex={regex_matches(text)} matcher={matcher.matches(text)}: {text!r}')
+    if mismatches:
+        sys.exit(1)
+
+    regex_time = time_matcher(regex_matches, corpus, args.rounds)
+    matcher_time = time_matcher(matcher.matches, corpus, args.rounds)
+    print(f'regex:   {regex_time * 1e6 / len(corpus):8.2f} us/post')
+    print(f'matcher: {matcher_time * 1e6 / len(corpus):8.2f} us/post')
+    print(f'speedup: {regex_time / matcher_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
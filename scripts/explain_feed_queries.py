@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Check that the hot feed queries are served by the feed indexes.
+
+Runs EXPLAIN on the exact queries of ``web/algos/chrono_trending.py`` (built by the same
+functions the handler uses) and fails when a plan reads the post table sequentially or sorts
+rows instead of reading them in index order. The trending count must be an index-only scan.
+On the partitioned table each partition is read through its copy of the index, and the
+trending windows should only touch the partitions they overlap.
+
+    python scripts/explain_feed_queries.py
+    python scripts/explain_feed_queries.py --feed 1            # a topical feed's queries
+    python scripts/explain_feed_queries.py --planner-defaults  # plans as the planner picks them
+
+A small development table is cheaper to scan than to read through an index, so by default
+sequential and bitmap scans and sorts are priced out (``enable_seqscan``, ``enable_bitmapscan``
+and ``enable_sort`` off) and the check proves that an index *can* serve each query. With ``--planner-defaults`` it checks the plans the
+planner actually chooses, which is only meaningful on a production-sized table.
+
+Uses the web service's environment variables. Exits with status 1 when a check fails.
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from peewee import fn, Select, SQL  # noqa: E402
+
+from web.algos import chrono_trending  # noqa: E402
+from web.database_ro import db  # noqa: E402
+
+
+def count_query(query):
+    # Same statement peewee's .count() sends
+    wrapped = query.order_by().alias('_wrapped').select(SQL('1'))
+    return Select([wrapped], [fn.COUNT(SQL('1'))]).bind(db)
+
+
+def hot_queries(feed):
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(hours=chrono_trending.TRENDING_THRESHOLD)
+    trending = chrono_trending.trending_posts_query(feed, since)
+    return [
+        # (name, query, indexes allowed to serve it, index-only scan required)
+        ('latest post', chrono_trending.main_posts_query(feed).limit(1), {'post_indexed_at_cid'}, False),
+        ('main posts, first page', chrono_trending.main_posts_query(feed, None, ['bafy1', 'bafy2']).limit(30),
+         {'post_indexed_at_cid'}, False),
+        ('main posts, next page', chrono_trending.main_posts_query(feed, (now - timedelta(hours=1), 'bafy'), ['bafy1']).limit(30),
+         {'post_indexed_at_cid'}, False),
+        ('trending posts', trending.offset(30).limit(30), {'post_trending'}, False),
+        ('trending count', count_query(trending), {'post_trending'}, True),
+    ]
+
+
+# Partitions carry their own copy of each index; map them back to the index on post
+_PARENT_INDEXES_SQL = """
+SELECT c.relname, p.relname FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+WHERE c.relkind = 'i'
+"""
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+def check(name, query, indexes, index_only, parent_indexes) -> bool:
+    sql, params = query.sql()
+    plan = db.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params).fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(plan_nodes(plan[0]['Plan']))
+
+    problems = []
+    for node in nodes:
+        kind = node['Node Type']
+        if kind == 'Seq Scan' and node.get('Relation Name', '').startswith('post'):
+            problems.append(f"sequential scan of {node['Relation Name']}")
+        elif kind in ('Sort', 'Incremental Sort'):
+            problems.append(f"sort on {', '.join(node.get('Sort Key', []))}")
+    scans = [node for node in nodes if node['Node Type'] in ('Index Scan', 'Index Only Scan')]
+    for node in scans:
+        node['Index Name'] = parent_indexes.get(node.get('Index Name'), node.get('Index Name'))
+    if not any(node.get('Index Name') in indexes for node in scans):
+        problems.append(f"not read through {' or '.join(sorted(indexes))}")
+    elif index_only and not any(node['Node Type'] == 'Index Only Scan' for node in scans):
+        problems.append('not an index-only scan')
+
+    used = ', '.join(sorted({f"{node['Node Type']} using {node.get('Index Name')}" for node in scans})) or 'no index'
+    print(f"{'ok  ' if not problems else 'FAIL'} {name:<24} {used}")
+    for problem in problems:
+        print(f'       {problem}')
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the hot feed queries are index-ordered')
+    parser.add_argument('--feed', type=int, default=None, help='Feed bit of a topical feed (default: no feed filter)')
+    parser.add_argument('--planner-defaults', action='store_true', help='Keep sequential and bitmap scans and sorts enabled')
+    args = parser.parse_args()
+
+    db.connect(reuse_if_open=True)
+    if not args.planner_defaults:
+        db.execute_sql('SET enable_seqscan = off')
+        db.execute_sql('SET enable_bitmapscan = off')
+        db.execute_sql('SET enable_sort = off')
+
+    parent_indexes = dict(db.execute_sql(_PARENT_INDEXES_SQL).fetchall())
+    results = [check(*query, parent_indexes) for query in hot_queries(args.feed)]
+    if not all(results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
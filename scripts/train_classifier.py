@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Train the firehose relevance classifier from labelled posts in the ``post`` table.
+
+Labels come from a CSV of ``uri,label`` rows (label 1 for relevant, 0 for a false positive of
+the keyword filters); the text of each post is read from the database. A share of the posts
+is held out to report precision and recall at a few thresholds, then the model is saved for
+FIREHOSE_CLASSIFIER_PATH.
+
+    python scripts/train_classifier.py labels.csv classifier.npz
+    python scripts/train_classifier.py labels.csv classifier.npz --bits 18 --ngrams 3 --epochs 500
+
+Uses the firehose POSTGRES_* environment variables.
+"""
+
+import argparse
+import csv
+import os
+import random
+import sys
+
+FIREHOSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firehose')
+sys.path.append(FIREHOSE_DIR)
+
+import numpy as np  # noqa: E402
+from peewee import chunked  # noqa: E402
+
+from classifier import HashedLinearClassifier  # noqa: E402
+from database import db, Post  # noqa: E402
+
+
+def load_labels(path: str) -> dict:
+    labels = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0] == 'uri':
+                continue
+            labels[row[0].strip()] = 1 if row[1].strip().lower() in ('1', 'true', 'yes') else 0
+    return labels
+
+
+def load_texts(uris) -> dict:
+    texts = {}
+    db.connect(reuse_if_open=True)
+    for batch in chunked(list(uris), 1000):
+        for uri, text in Post.select(Post.uri, Post.text).where(Post.uri.in_(batch)).tuples():
+            if text:
+                texts[uri] = text
+    return texts
+
+
+def report(model: HashedLinearClassifier, texts, labels) -> None:
+    y = np.asarray(labels)
+    scores = model.predict_proba(texts)
+    print(f"{'threshold':>10}{'precision':>11}{'recall':>8}{'kept':>7}")
+    for threshold in (0.3, 0.4, 0.5, 0.6, 0.7, 0.8):
+        predicted = scores >= threshold
+        true_positives = int((predicted & (y == 1)).sum())
+        precision = true_positives / max(int(predicted.sum()), 1)
+        recall = true_positives / max(int((y == 1).sum()), 1)
+        print(f'{threshold:>10.1f}{precision:>11.1%}{recall:>8.1%}{predicted.mean():>7.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the firehose relevance classifier from labelled posts')
+    parser.add_argument('labels', help='CSV of uri,label rows (1 relevant, 0 not)')
+    parser.add_argument('model', help='Where to save the trained model (.npz)')
+    parser.add_argument('--bits', type=int, default=20, help='log2 of the number of hashed features (default: 20)')
+    parser.add_argument('--ngrams', type=int, default=2, help='Longest word n-gram used as a feature (default: 2)')
+    parser.add_argument('--epochs', type=int, default=300, help='Gradient descent epochs (default: 300)')
+    parser.add_argument('--learning-rate', type=float, default=20.0, help='Gradient descent step size (default: 20)')
+    parser.add_argument('--l2', type=float, default=1e-5, help='L2 regularisation (default: 1e-5)')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Share of posts held out for evaluation')
+    parser.add_argument('--seed', type=int, default=1126, help='Seed for the holdout split')
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels)
+    texts = load_texts(labels)
+    missing = len(labels) - len(texts)
+    if missing:
+        print(f'{missing} labelled posts are no longer in the post table (or have no text) and are skipped')
+
+    examples = [(texts[uri], labels[uri]) for uri in texts]
+    if not examples:
+        raise SystemExit('No labelled posts found in the post table')
+    random.Random(args.seed).shuffle(examples)
+
+    split = int(len(examples) * (1 - args.holdout)) if args.holdout > 0 else len(examples)
+    train, holdout = examples[:split], examples[split:]
+    positives = sum(label for _, label in train)
+    print(f'Training on {len(train)} posts ({positives} relevant, {len(train) - positives} not)')
+
+    model = HashedLinearClassifier(bits=args.bits, ngrams=args.ngrams)
+    model.fit([text for text, _ in train], [label for _, label in train],
+              epochs=args.epochs, learning_rate=args.learning_rate, l2=args.l2)
+
+    if holdout:
+        print(f'Holdout of {len(holdout)} posts:')
+        report(model, [text for text, _ in holdout], [label for _, label in holdout])
+
+    model.save(args.model)
+    print(f'Saved model to {args.model}; set FIREHOSE_CLASSIFIER_PATH and FIREHOSE_CLASSIFIER_THRESHOLD to use it')
+
+
+if __name__ == '__main__':
+    main()
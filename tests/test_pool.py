@@ -0,0 +1,47 @@
+"""
+feeddb.PooledDatabase overrides private parts of playhouse.pool. These checks fail when a
+peewee upgrade renames or reshapes them, before the pool silently stops working.
+"""
+import inspect
+
+from playhouse.pool import PooledPostgresqlDatabase
+
+from feeddb.pool import PooledDatabase
+
+# Methods PooledDatabase overrides, with their parameters
+OVERRIDDEN_METHODS = {
+    '_connect': ['self'],
+    '_is_stale': ['self', 'timestamp'],
+    '_is_closed': ['self', 'conn'],
+    '_can_reuse': ['self', 'conn'],
+    '_close_raw': ['self', 'conn'],
+}
+
+
+def test_overridden_methods_exist():
+    for name, parameters in OVERRIDDEN_METHODS.items():
+        method = getattr(PooledPostgresqlDatabase, name, None)
+        assert method is not None, f'playhouse.pool no longer defines {name}'
+        assert list(inspect.signature(method).parameters) == parameters, f'{name} changed its signature'
+
+
+def test_pool_state_attributes():
+    database = PooledDatabase('feeds', max_connections=3)
+    # _connect holds the lock while the base class takes it again
+    assert database._pool_lock.acquire(blocking=False)
+    try:
+        assert database._pool_lock.acquire(blocking=False), '_pool_lock is no longer reentrant'
+        database._pool_lock.release()
+    finally:
+        database._pool_lock.release()
+    assert database._connections == []
+    assert database._in_use == {}
+    assert database._max_connections == 3
+    assert callable(database.conn_key)
+    assert callable(database._adapter.is_connection_closed)
+
+
+def test_idle_connections_are_heap_entries():
+    source = inspect.getsource(PooledPostgresqlDatabase._connect)
+    # PooledDatabase._connect unpacks idle entries as (timestamp, counter, connection)
+    assert 'ts, _counter, conn = heapq.heappop(self._connections)' in source
@@ -1,5 +1,14 @@
+from functools import partial
+
+from firehose.utils import config
 from . import chrono_trending
 
+# Every filter profile is served as its own feed from the shared post table; with a single
+# profile the feed reads every post
+_profiles = list(config.FILTER_PROFILES)
+_feed_uris = {_profiles[0]: chrono_trending.uri, **config.FEED_URIS}
+
 algos = {
-    chrono_trending.uri: chrono_trending.handler
+    uri: partial(chrono_trending.handler, feed=_profiles.index(name) if len(_profiles) > 1 else None)
+    for name, uri in _feed_uris.items()
 }
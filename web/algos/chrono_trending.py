@@ -2,15 +2,17 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict
 import json
 
+from peewee import Tuple
+
 from firehose.utils import config
-from web.database_ro import Post
+from web.database_ro import Post, router
 from firehose.utils.logger import logger
 
 uri = config.CHRONOLOGICAL_TRENDING_URI
 CURSOR_EOF = 'eof'
 
 TRENDING_THRESHOLD = 72  # Hours
-INTERACTIONS_THRESHOLD = 10  # Minimum hot score for trending posts
+INTERACTIONS_THRESHOLD = 10  # Minimum hot score for trending posts, at least feeddb.TRENDING_MIN_INTERACTIONS
 
 def encode_cursor(cursors: Dict[str, Optional[str]]) -> str:
     return json.dumps(cursors)
@@ -35,13 +37,40 @@ def adjust_limit(limit: int, posts_per_iteration: int) -> int:
 
     return limit
 
-def handler(cursor: Optional[str], limit: int) -> dict:
+def feed_posts(feed: Optional[int]):
+    # Posts tagged with bit ``feed`` of post.feeds, or every post when the feed is the only one,
+    # read from the replica the request was routed to
+    query = Post.select().bind(router.read_database)
+    if feed is not None:
+        query = query.where(Post.feeds.bin_and(1 << feed) != 0)
+    return query
+
+# The hot queries, shaped to match the post_indexed_at_cid and post_trending indexes
+# (checked by scripts/explain_feed_queries.py)
+def trending_posts_query(feed: Optional[int], since: datetime):
+    return (feed_posts(feed)
+        .where(
+            (Post.indexed_at > since) &
+            (Post.interactions >= INTERACTIONS_THRESHOLD)
+        )
+        .order_by(Post.interactions.desc(), Post.indexed_at.desc(), Post.cid.desc()))
+
+def main_posts_query(feed: Optional[int], before: Optional[tuple] = None, exclude_cids: Optional[List[str]] = None):
+    query = feed_posts(feed).order_by(Post.indexed_at.desc(), Post.cid.desc())
+    if before is not None:
+        # A row comparison is an index range bound; the equivalent OR of two conditions is not
+        query = query.where(Tuple(Post.indexed_at, Post.cid) < Tuple(*before))
+    if exclude_cids:
+        query = query.where(Post.cid.not_in(exclude_cids))
+    return query
+
+def handler(cursor: Optional[str], limit: int, feed: Optional[int] = None) -> dict:
     if not isinstance(limit, int):
         limit = int(limit)
 
     if limit == 1:
         logger.info("Returning a single main post for limit 1")
-        latest_post = Post.select().order_by(Post.indexed_at.desc(), Post.cid.desc()).first()
+        latest_post = main_posts_query(feed).first()
         return {
             'cursor': CURSOR_EOF,
             'feed': [{'post': latest_post.uri}] if latest_post else []
@@ -75,12 +104,7 @@ def handler(cursor: Optional[str], limit: int) -> dict:
 
         # Check if we've already seen all trending posts
         if trending_posts_offset > 0:
-            total_trending_posts = (Post.select()
-                .where(
-                    (Post.indexed_at > trending_threshold) &
-                    (Post.interactions >= INTERACTIONS_THRESHOLD)
-                )
-                .count())
+            total_trending_posts = trending_posts_query(feed, trending_threshold).count()
             
             if trending_posts_offset >= total_trending_posts:
                 trending_posts_offset = 0  # Reset to start
@@ -124,52 +148,25 @@ def handler(cursor: Optional[str], limit: int) -> dict:
             main_cursor = None
             trending_posts_offset = 0  # Start at the beginning
 
-        # Helper function to build cursor conditions for main_posts
-        def build_cursor_condition(cursor_value: Optional[str]):
+        # Helper function to parse the (indexed_at, cid) position of main_posts
+        def parse_cursor_position(cursor_value: Optional[str]):
             if cursor_value:
                 try:
                     indexed_at, cid = cursor_value.split('::')
-                    indexed_at = datetime.fromtimestamp(float(indexed_at)/1000, timezone.utc)
-                    return (
-                        ((Post.indexed_at == indexed_at) & (Post.cid < cid)) |
-                        (Post.indexed_at < indexed_at)
-                    )
+                    return datetime.fromtimestamp(float(indexed_at)/1000, timezone.utc), cid
                 except ValueError as e:
                     logger.error(f"Malformed cursor segment: {cursor_value}. Error: {e}")
                     return None
             return None
 
         # Fetch trending_posts using offset-based pagination
-        trending_posts_query = (
-            Post.select()
-            .where(
-                (Post.indexed_at > trending_threshold) &
-                (Post.interactions >= INTERACTIONS_THRESHOLD)
-            )
-            .order_by(Post.interactions.desc(), Post.indexed_at.desc(), Post.cid.desc())
-        )
-
-        # Apply offset for trending_posts
-        trending_posts = list(trending_posts_query.offset(trending_posts_offset).limit(limit))
+        trending_posts = list(trending_posts_query(feed, trending_threshold).offset(trending_posts_offset).limit(limit))
         logger.info(f"Fetched {len(trending_posts)} trending posts with >={INTERACTIONS_THRESHOLD} interactions starting at offset {trending_posts_offset}")
 
         trending_cids = [post.cid for post in trending_posts]
 
         # Fetch main_posts excluding trending_posts
-        main_posts_query = (
-            Post.select()
-            .order_by(Post.indexed_at.desc(), Post.cid.desc())
-        )
-
-        main_cursor_condition = build_cursor_condition(main_cursor)
-        if main_cursor_condition:
-            main_posts_query = main_posts_query.where(main_cursor_condition)
-
-        if trending_cids:
-            main_posts_query = main_posts_query.where(Post.cid.not_in(trending_cids))
-
-
-        main_posts = list(main_posts_query.limit(limit))  # Fetch up to 'limit' main posts
+        main_posts = list(main_posts_query(feed, parse_cursor_position(main_cursor), trending_cids).limit(limit))  # Fetch up to 'limit' main posts
         #logger.debug(f"Fetched {len(main_posts)} main posts excluding trending posts")
 
         # Initialize iterators
@@ -5,11 +5,46 @@ from firehose.utils import config
 from firehose.utils.logger import logger
 from web.algos import algos
 from web.auth import AuthorizationError, validate_auth
-from web.database_ro import Requests
+from web.database_ro import db, PoolExhausted, Requests, router
 
 app = Flask(__name__)
 CORS(app)
 
+# Requests that never touch the database don't take a connection out of the pool
+_NO_DATABASE_ENDPOINTS = {'index', 'did_json', 'describe_feed_generator', 'metrics'}
+# Feed reads go to a read replica when one is caught up; writes always go to the primary
+_READ_ENDPOINTS = {'get_feed_skeleton'}
+
+@app.before_request
+def _db_connect():
+    if request.endpoint in _READ_ENDPOINTS:
+        router.route()
+    elif request.endpoint not in _NO_DATABASE_ENDPOINTS:
+        db.connect(reuse_if_open=True)
+
+@app.teardown_request
+def _db_close(exc):
+    # Returns the connections to their pools; a broken one is closed there instead of reused
+    router.release()
+    if not db.is_closed():
+        db.close()
+
+@app.errorhandler(PoolExhausted)
+def pool_exhausted(e):
+    logger.warning(f'No database connection available: {e}')
+    return 'Database busy, try again', 503, {'Retry-After': '1'}
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format, like the firehose's /metrics
+    lines = []
+    for name, value in db.pool_stats().items():
+        lines.append(f'# TYPE web_db_pool_{name} gauge')
+        lines.append(f'web_db_pool_{name} {value}')
+    if router.replicas:
+        lines.extend(router.metrics())
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/')
 def index():
     return '', 302, {'Location': 'https://bsky.app/profile/did:plc:wihwdzwkb6nd3wb565kujg2f/feed/cosmere'}
@@ -46,7 +81,7 @@ def describe_feed_generator():
 @app.route('/xrpc/app.bsky.feed.getFeedSkeleton', methods=['GET'])
 def get_feed_skeleton():
     # Add timeout handling
-    if request.environ.get('wsgi.multithread'):
+    if request.environ.get('wsgi.multithread') and hasattr(request.environ['wsgi.input'], 'set_timeout'):
         request.environ['wsgi.input'].set_timeout(10)  # 10 second timeout
         
     feed = request.args.get('feed', default=None, type=str)
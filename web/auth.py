@@ -1,10 +1,10 @@
-from atproto import DidInMemoryCache, IdResolver, verify_jwt
+from atproto import verify_jwt
 from atproto.exceptions import TokenInvalidSignatureError
 from flask import Request
+from firehose.utils.did_cache import get_resolver
 
 
-_CACHE = DidInMemoryCache()
-_ID_RESOLVER = IdResolver(cache=_CACHE)
+_ID_RESOLVER = get_resolver()
 
 _AUTHORIZATION_HEADER_NAME = 'Authorization'
 _AUTHORIZATION_HEADER_VALUE_PREFIX = 'Bearer '
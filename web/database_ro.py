@@ -1,43 +1,27 @@
-from datetime import datetime, timedelta, timezone
-from firehose.utils.logger import logger
+from firehose.utils import config
 from firehose.utils.config import POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT
-import peewee
 
-db = peewee.PostgresqlDatabase(POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD, host=POSTGRES_HOST, port=POSTGRES_PORT)
+from feeddb import db, PooledDatabase, PoolExhausted, Post, Requests, SessionState, SubscriptionState
+from web.replicas import ReplicaRouter
 
-class BaseModel(peewee.Model):
-    class Meta:
-        database = db
 
+def _pool(host: str, port, read_only: bool = False) -> PooledDatabase:
+    return PooledDatabase(
+        POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD, host=host, port=port,
+        max_connections=config.DB_POOL_MAX_CONNECTIONS, max_age=config.DB_POOL_MAX_AGE,
+        timeout=config.DB_POOL_WAIT_TIMEOUT, ping_after=config.DB_POOL_PING_AFTER, read_only=read_only,
+    )
 
-class Post(BaseModel):
-    uri = peewee.CharField(index=True)
-    cid = peewee.CharField()
-    reply_parent = peewee.CharField(null=True, default=None)
-    reply_root = peewee.CharField(null=True, default=None)
-    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc), index=True)
-    author = peewee.CharField(null=True, default=None, index=True)
-    interactions = peewee.BigIntegerField(default=0, index=True)
-    text = peewee.TextField(null=True, default=None)
 
+def _replica_pool(endpoint: str) -> PooledDatabase:
+    host, _, port = endpoint.partition(':')
+    return _pool(host, port or POSTGRES_PORT, read_only=True)
 
-class SubscriptionState(BaseModel):
-    service = peewee.CharField(unique=True)
-    cursor = peewee.BigIntegerField()
-    last_indexed_at = peewee.DateTimeField(null=True, default=None)
 
-class SessionState(BaseModel):
-    service = peewee.CharField(unique=True)
-    session_string = peewee.TextField(null=True)
-
-# table for storing dids
-class Requests(BaseModel):
-    indexed_at = peewee.DateTimeField(default=datetime.now(timezone.utc), index=True)
-    did = peewee.CharField(null=True, default=None, index=True)
-
-if db.is_closed():
-    try:
-        db.connect()
-        logger.info("Web worker database connection established.")
-    except peewee.OperationalError as e:
-        logger.error(f"Failed to connect to the database in read-only mode: {e}")
+# Connections are checked out per request by the hooks in web/app.py; writes use the primary
+# through the models, feed reads go through router.read_database
+db.initialize(_pool(POSTGRES_HOST, POSTGRES_PORT))
+router = ReplicaRouter(
+    db, {endpoint: _replica_pool(endpoint) for endpoint in config.POSTGRES_REPLICA_HOSTS},
+    max_lag=config.DB_REPLICA_MAX_LAG, check_interval=config.DB_REPLICA_CHECK_INTERVAL,
+)
@@ -0,0 +1,178 @@
+import itertools
+import threading
+from datetime import datetime
+from time import sleep
+from typing import Dict, List, Optional
+
+import peewee
+
+from feeddb import PoolExhausted, SubscriptionState
+from firehose.utils.logger import logger
+
+
+class Replica:
+    """A read replica and the result of its latest lag check."""
+
+    __slots__ = ('name', 'database', 'lag', 'healthy')
+
+    def __init__(self, name: str, database: peewee.Database):
+        self.name = name
+        self.database = database
+        self.lag: Optional[float] = None  # seconds behind the primary, None until checked
+        self.healthy = False
+
+
+class ReplicaRouter:
+    """
+    Routes the feed reads of each request to a read replica, and everything else to the primary.
+
+    A background thread measures every ``check_interval`` seconds how far each replica lags
+    behind the primary. The firehose stamps its subscription state with the time of every
+    cursor checkpoint, so the lag is how much older the newest checkpoint on the replica is
+    than the one on the primary. This works for streaming replicas and YugabyteDB follower
+    reads alike, and an idle primary never looks like lag. A replica that is unreachable or
+    lags more than ``max_lag`` seconds is skipped until a later check finds it caught up again;
+    one whose connection pool is merely exhausted is skipped for that request only.
+    Reads fall back to the primary while no replica is usable.
+
+    Args:
+        primary: The database writes and fallback reads go to.
+        replicas: Read replicas by name (their host).
+        max_lag: Seconds a replica may lag behind the primary and still serve reads.
+        check_interval: Seconds between lag checks.
+    """
+
+    def __init__(self, primary: peewee.Database, replicas: Dict[str, peewee.Database],
+                 max_lag: float = 30, check_interval: float = 5):
+        self.primary = primary
+        self.replicas: List[Replica] = [Replica(name, database) for name, database in replicas.items()]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replica_reads = 0
+        self.primary_reads = 0   # reads that fell back to the primary while replicas are configured
+        self._next = itertools.count()
+        self._local = threading.local()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def read_database(self) -> peewee.Database:
+        """The database the current request reads from (the primary outside of ``route``)."""
+        return getattr(self._local, 'database', None) or self.primary
+
+    def route(self) -> peewee.Database:
+        """Pick and connect the database for the current request's reads."""
+        self._ensure_started()
+        candidates = [replica for replica in self.replicas if replica.healthy]
+        if candidates:
+            offset = next(self._next)
+            for i in range(len(candidates)):
+                replica = candidates[(offset + i) % len(candidates)]
+                try:
+                    replica.database.connect(reuse_if_open=True)
+                except PoolExhausted:
+                    # Busy, not broken: try the next replica and leave its health to the checks
+                    continue
+                except peewee.OperationalError as e:
+                    # Don't wait for the next check to stop sending requests to it
+                    replica.healthy = False
+                    logger.warning(f'Read replica {replica.name} is unavailable, skipping it: {e}')
+                    continue
+                self._local.database = replica.database
+                self.replica_reads += 1
+                return replica.database
+
+        if self.replicas:
+            self.primary_reads += 1
+        self.primary.connect(reuse_if_open=True)
+        self._local.database = self.primary
+        return self.primary
+
+    def release(self) -> None:
+        """Return the current request's read connection to its pool."""
+        database = getattr(self._local, 'database', None)
+        self._local.database = None
+        if database is not None and database is not self.primary and not database.is_closed():
+            database.close()
+
+    def _ensure_started(self) -> None:
+        # Started on first use so every gunicorn worker runs its own monitor after forking; reads
+        # go to the primary until the first check finds a replica caught up
+        if self._thread is not None or not self.replicas:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._monitor_loop, name='replica-lag', daemon=True)
+                self._thread.start()
+
+    def check(self) -> None:
+        """Measure the lag of every replica and update which ones serve reads."""
+        try:
+            primary_checkpoint = self._latest_checkpoint(self.primary)
+        except peewee.PeeweeException as e:
+            # Without the primary's checkpoint the lag is unknown; keep the last verdicts
+            logger.error(f'Failed to read the primary checkpoint for the replica lag check: {e}')
+            return
+
+        for replica in self.replicas:
+            try:
+                replica_checkpoint = self._latest_checkpoint(replica.database)
+            except PoolExhausted:
+                # All its connections are serving reads, which says nothing about its lag
+                continue
+            except peewee.PeeweeException as e:
+                lag, error = None, str(e)
+            else:
+                lag, error = self._lag(primary_checkpoint, replica_checkpoint), None
+
+            healthy = lag is not None and lag <= self.max_lag
+            if healthy != replica.healthy:
+                if healthy:
+                    logger.info(f'Read replica {replica.name} is serving reads ({lag:.1f}s behind the primary).')
+                elif error:
+                    logger.warning(f'Read replica {replica.name} is unavailable, reading from the primary instead: {error}')
+                else:
+                    logger.warning(f'Read replica {replica.name} is {lag:.1f}s behind the primary (more than '
+                                   f'{self.max_lag:.0f}s), reading from the primary instead.')
+            replica.lag = lag
+            replica.healthy = healthy
+
+    @staticmethod
+    def _latest_checkpoint(database: peewee.Database) -> Optional[datetime]:
+        with database.connection_context():
+            query = SubscriptionState.select(peewee.fn.MAX(SubscriptionState.last_indexed_at)).bind(database)
+            return query.scalar()
+
+    @staticmethod
+    def _lag(primary: Optional[datetime], replica: Optional[datetime]) -> Optional[float]:
+        if primary is None:
+            # Nothing has been ingested yet, so there is nothing to lag behind
+            return 0.0
+        if replica is None:
+            return None
+        return max(0.0, (primary - replica).total_seconds())
+
+    def _monitor_loop(self) -> None:
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f'Replica lag check failed: {e}')
+            sleep(self.check_interval)
+
+    def metrics(self) -> List[str]:
+        """Prometheus lines with the lag and state of every replica and the routed reads."""
+        lines = [
+            '# TYPE web_db_replica_reads gauge',
+            f'web_db_replica_reads {self.replica_reads}',
+            '# TYPE web_db_replica_fallback_reads gauge',
+            f'web_db_replica_fallback_reads {self.primary_reads}',
+            '# TYPE web_db_replica_lag_seconds gauge',
+        ]
+        for replica in self.replicas:
+            lag = replica.lag if replica.lag is not None else float('nan')
+            lines.append(f'web_db_replica_lag_seconds{{replica="{replica.name}"}} {lag}')
+        lines.append('# TYPE web_db_replica_healthy gauge')
+        for replica in self.replicas:
+            lines.append(f'web_db_replica_healthy{{replica="{replica.name}"}} {int(replica.healthy)}')
+        return lines